@@ -7,6 +7,9 @@ from .beams import *
 from .precond_sh import *
 from .precond_pseudoinv import *
 from .precond_pixel import *
+from .precond_multilevel import *
+from .precond_store import *
+from .precond_autotune import *
 from .mmajor import *
 from .precond_diag import *
 from .masked_solver import *
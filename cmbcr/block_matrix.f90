@@ -110,6 +110,13 @@ module block_matrix
        REAL A(LDA,*),X(*),Y(*)
      END SUBROUTINE SGEMV
 
+     SUBROUTINE DSYMV(UPLO,N,ALPHA,A,LDA,X,INCX,BETA,Y,INCY)
+       DOUBLE PRECISION ALPHA,BETA
+       INTEGER INCX,INCY,LDA,N
+       CHARACTER UPLO
+       DOUBLE PRECISION A(LDA,*),X(*),Y(*)
+     END SUBROUTINE DSYMV
+
   end interface
 
 contains
@@ -509,6 +516,106 @@ contains
 
   end subroutine block_A_x
 
+  subroutine block_A_x_rows(symmetric, bs_left, bs_right, n, &
+       indptr, indices, labels, blocks, row_indptr, row_cols, row_ptrs, x, y) bind(c)
+    ! y = y + A * x, computed in parallel over the block rows of y. Every thread
+    ! pulls the contributions to its own rows, so, unlike block_A_x, no two threads
+    ! write to the same part of y.
+    !
+    ! row_indptr/row_cols/row_ptrs give row access to the CSC matrix: the blocks of
+    ! row i are in columns row_cols(r) with CSC index row_ptrs(r), for
+    ! r = row_indptr(i)...row_indptr(i + 1) - 1.
+    !
+    ! If symmetric /= 0, only the lower half of a symmetric matrix is stored
+    ! (bs_left == bs_right), and the upper half is applied by mirroring it; in this
+    ! case only the lower triangle of the diagonal blocks is used.
+    !
+    ! Blocks are looked up through labels, as in block_A_x.
+    integer(i4b), value :: symmetric, bs_left, bs_right, n
+    integer(i4b), dimension(0:n) :: indptr, row_indptr
+    integer(i4b), dimension(0:indptr(n) - 1) :: indices, labels, row_cols, row_ptrs
+    real(dp), dimension(1_i8b:int(bs_left, i8b), 1_i8b:int(bs_right, i8b), 0:*) :: blocks
+    real(dp), dimension(1_i8b:int(bs_right, i8b), 0:int(n - 1, i8b)) :: x
+    real(dp), dimension(1_i8b:int(bs_left, i8b), 0:int(n - 1, i8b)) :: y
+    !--
+    integer(i4b) :: i, j, r, kptr, k
+
+    !$OMP parallel do default(none) schedule(dynamic, 4) &
+    !$OMP     shared(symmetric, bs_left, bs_right, n, indptr, indices, labels, blocks, &
+    !$OMP            row_indptr, row_cols, row_ptrs, x, y) &
+    !$OMP     private(i, j, r, kptr, k)
+    do i = 0, n - 1
+       do r = row_indptr(i), row_indptr(i + 1) - 1
+          j = row_cols(r)
+          if (symmetric /= 0 .and. j == i) then
+             call DSYMV('L', bs_left, 1.0_dp, blocks(:, :, labels(row_ptrs(r))), bs_left, &
+                  x(:, i), 1, 1.0_dp, y(:, i), 1)
+          else
+             call DGEMV('N', bs_left, bs_right, 1.0_dp, blocks(:, :, labels(row_ptrs(r))), bs_left, &
+                  x(:, j), 1, 1.0_dp, y(:, i), 1)
+          end if
+       end do
+       if (symmetric /= 0) then
+          ! Mirrored upper half: row i of A^T is column i of A
+          do kptr = indptr(i), indptr(i + 1) - 1
+             k = indices(kptr)
+             if (k == i) cycle
+             call DGEMV('T', bs_left, bs_right, 1.0_dp, blocks(:, :, labels(kptr)), bs_left, &
+                  x(:, k), 1, 1.0_dp, y(:, i), 1)
+          end do
+       end if
+    end do
+    !$OMP end parallel do
+  end subroutine block_A_x_rows
+
+  subroutine block_A_x_rows_sp(symmetric, bs_left, bs_right, n, &
+       indptr, indices, labels, blocks, row_indptr, row_cols, row_ptrs, x, y) bind(c)
+    ! As block_A_x_rows, but with blocks stored in single precision. x and y are in
+    ! double precision and the products are accumulated in double precision.
+    integer(i4b), value :: symmetric, bs_left, bs_right, n
+    integer(i4b), dimension(0:n) :: indptr, row_indptr
+    integer(i4b), dimension(0:indptr(n) - 1) :: indices, labels, row_cols, row_ptrs
+    real(sp), dimension(1_i8b:int(bs_left, i8b), 1_i8b:int(bs_right, i8b), 0:*) :: blocks
+    real(dp), dimension(1_i8b:int(bs_right, i8b), 0:int(n - 1, i8b)) :: x
+    real(dp), dimension(1_i8b:int(bs_left, i8b), 0:int(n - 1, i8b)) :: y
+    !--
+    integer(i4b) :: i, j, r, kptr, k, c, lab
+
+    !$OMP parallel do default(none) schedule(dynamic, 4) &
+    !$OMP     shared(symmetric, bs_left, bs_right, n, indptr, indices, labels, blocks, &
+    !$OMP            row_indptr, row_cols, row_ptrs, x, y) &
+    !$OMP     private(i, j, r, kptr, k, c, lab)
+    do i = 0, n - 1
+       do r = row_indptr(i), row_indptr(i + 1) - 1
+          j = row_cols(r)
+          lab = labels(row_ptrs(r))
+          if (symmetric /= 0 .and. j == i) then
+             ! Lower triangle, and its mirror, of diagonal block
+             do c = 1, bs_right
+                y(c, i) = y(c, i) + blocks(c, c, lab) * x(c, i)
+                y(c + 1:, i) = y(c + 1:, i) + blocks(c + 1:, c, lab) * x(c, i)
+                y(c, i) = y(c, i) + sum(blocks(c + 1:, c, lab) * x(c + 1:, i))
+             end do
+          else
+             do c = 1, bs_right
+                y(:, i) = y(:, i) + blocks(:, c, lab) * x(c, j)
+             end do
+          end if
+       end do
+       if (symmetric /= 0) then
+          do kptr = indptr(i), indptr(i + 1) - 1
+             k = indices(kptr)
+             if (k == i) cycle
+             lab = labels(kptr)
+             do c = 1, bs_right
+                y(c, i) = y(c, i) + sum(blocks(:, c, lab) * x(:, k))
+             end do
+          end do
+       end if
+    end do
+    !$OMP end parallel do
+  end subroutine block_A_x_rows_sp
+
   subroutine block_incomplete_cholesky_factor(bs, n, indptr, indices, blocks, ridge, info) bind(c)
     integer(i4b), value :: bs, n
     integer(i4b), dimension(0:n) :: indptr
@@ -641,6 +748,94 @@ contains
     end if
   end subroutine block_triangular_solve
 
+  ! Computes the level of each node in the dependency graph of a forward solve with the
+  ! lower-triangular CSC matrix given by indptr/indices: x_j depends on x_k whenever
+  ! (j, k) is a sub-diagonal entry, and level(j) = 1 + max(level(k)). All nodes on the
+  ! same level can be solved for independently. For the transposed (backward) solve
+  ! the levels can be processed in reverse order.
+  subroutine block_triangular_levels(n, indptr, indices, levels, nlevels) bind(c)
+    integer(i4b), value :: n
+    integer(i4b), dimension(0:n) :: indptr
+    integer(i4b), dimension(0:indptr(n) - 1) :: indices
+    integer(i4b), dimension(0:n - 1), intent(out) :: levels
+    integer(i4b), intent(out) :: nlevels
+    !--
+    integer(i4b) :: j, iptr, i
+
+    levels = 0
+    do j = 0, n - 1
+       ! levels(j) is final at this point, since all columns it depends on have been seen
+       do iptr = indptr(j) + 1, indptr(j + 1) - 1
+          i = indices(iptr)
+          levels(i) = max(levels(i), levels(j) + 1)
+       end do
+    end do
+    nlevels = 0
+    if (n > 0) nlevels = maxval(levels) + 1
+  end subroutine block_triangular_levels
+
+  ! Same as block_triangular_solve, but the nodes are processed level by level (see
+  ! block_triangular_levels), with the nodes within each level solved in parallel.
+  ! level_nodes(level_ptr(l):level_ptr(l+1)-1) lists the nodes on level l.
+  !
+  ! For the forward solve the updates are pulled rather than pushed, so that no two
+  ! threads write to the same part of x; that requires row access to the matrix, given
+  ! by row_indptr/row_cols/row_blockptrs: the sub-diagonal blocks of row i are
+  ! blocks(:, :, row_blockptrs(r)), in column row_cols(r), r = row_indptr(i)...
+  subroutine block_triangular_solve_levels(trans, bs, n, indptr, indices, blocks, &
+       nlevels, level_ptr, level_nodes, row_indptr, row_cols, row_blockptrs, x) bind(c)
+    integer(i4b), value :: trans ! 1 if transpose, 0 otherwise
+    integer(i4b), value :: bs, n, nlevels
+    integer(i4b), dimension(0_i8b:int(n, i8b)) :: indptr, row_indptr
+    integer(i4b), dimension(0_i8b:int(indptr(n), i8b)) :: indices
+    integer(i4b), dimension(0:nlevels) :: level_ptr
+    integer(i4b), dimension(0:n - 1) :: level_nodes
+    integer(i4b), dimension(0:row_indptr(n)) :: row_cols, row_blockptrs
+    real(dp), dimension(1_i8b:int(bs, i8b), 1_i8b:int(bs, i8b), 0_i8b:int(indptr(n), i8b)) :: blocks
+    real(dp), dimension(1_i8b:int(bs, i8b), 0_i8b:int(n, i8b)-1_i8b) :: x
+    !--
+    integer(i4b) :: level, t, i, j, r, jptr
+
+    !$OMP parallel default(none) private(level, t, i, j, r, jptr) &
+    !$OMP     shared(trans, bs, nlevels, level_ptr, level_nodes, indptr, indices, &
+    !$OMP            row_indptr, row_cols, row_blockptrs, blocks, x)
+    if (trans == 0) then
+       do level = 0, nlevels - 1
+          !$OMP do schedule(dynamic, 4)
+          do t = level_ptr(level), level_ptr(level + 1) - 1
+             i = level_nodes(t)
+             ! Pull updates from blocks in row i, x_i <- x_i - A_ij x_j
+             do r = row_indptr(i), row_indptr(i + 1) - 1
+                j = row_cols(r)
+                call DGEMV('Not transposed', bs, bs, -1.0_dp, blocks(:, :, row_blockptrs(r)), bs, &
+                     x(:, j), 1, 1.0_dp, x(:, i), 1)
+             end do
+             ! Solve for diagonal block, x_i <- A_ii^-1 x_i
+             call DTRSV('Lower', 'Not transposed', 'Not unit triangular', &
+                  bs, blocks(:, :, indptr(i)), bs, x(:, i), 1)
+          end do
+          !$OMP end do
+       end do
+    else
+       do level = nlevels - 1, 0, -1
+          !$OMP do schedule(dynamic, 4)
+          do t = level_ptr(level), level_ptr(level + 1) - 1
+             i = level_nodes(t)
+             ! Pull updates from blocks in column i of the untransposed matrix
+             do jptr = indptr(i) + 1, indptr(i + 1) - 1
+                j = indices(jptr)
+                call DGEMV('Transposed', bs, bs, -1.0_dp, blocks(:, :, jptr), bs, &
+                     x(:, j), 1, 1.0_dp, x(:, i), 1)
+             end do
+             call DTRSV('Lower', 'Transposed', 'Not unit triangular', &
+                  bs, blocks(:, :, indptr(i)), bs, x(:, i), 1)
+          end do
+          !$OMP end do
+       end do
+    end if
+    !$OMP end parallel
+  end subroutine block_triangular_solve_levels
+
 
   subroutine compute_block_norms(bs, n, blocks, norms) bind(c)
     integer(i4b), value :: bs, n
@@ -827,7 +1022,6 @@ contains
              call dpptrf('L', m, buf(0:matlen - 1), subinfo)
              if (subinfo == 0) then
                 ! Success -- now scale resulting factor L along rows by s
-                print *, 'cluster', ic, 'got ridge', ridge
                 x = 0
                 do i = 0, m - 1
                    buf(x:x + m - i - 1) = (buf(x:x + m - i - 1) * s(i:i + m - i - 1))
@@ -911,9 +1105,10 @@ contains
     !$OMP end parallel
   end subroutine csc_compressed_block_diagonal_solve
 
-  subroutine csc_make_clusters(eps, n, indptr, indices, norms, &
+  subroutine csc_make_clusters(eps, max_size, n, indptr, indices, norms, &
                                permutation, cluster_size, cluster_count) bind(c)
     real(dp), value                                             :: eps
+    integer(i4b), value                                         :: max_size  ! 0 for no limit
     integer(i4b), value                                         :: n
     integer(i4b), dimension(0_i8b:int(n, i8b))                  :: indptr
     integer(i4b), dimension(0_i8b:int(indptr(n), i8b))          :: indices
@@ -983,6 +1178,7 @@ contains
              relnorm_right = norms(iptr) / cluster_norms(cluster(i))
              relnorm = max(relnorm_up, relnorm_right)
              newsize = cluster_size(cluster(i)) + cluster_size(cluster(j))
+             if (max_size > 0 .and. newsize > max_size) cycle
              if ((relnorm > eps) .and. (newsize < best_size) .or. &
                  (newsize == best_size .and. relnorm > best_relnorm)) then
                 ok = .false.
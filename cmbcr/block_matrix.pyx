@@ -4,7 +4,17 @@ import numpy as np
 cimport numpy as cnp
 cimport cython
 
+# Number of blocks copied at the time when expanding labelled blocks, to bound
+# the size of temporaries
+EXPAND_CHUNK = 4096
+
+
 class BlockMatrix:
+    """
+    Block-sparse matrix in CSC format; the block of entry iptr (of `indices`) is
+    ``blocks[:, :, labels[iptr]]``. Blocks that are equal, e.g. because of the
+    rotational symmetry of the SymPix grid, can so be stored only once.
+    """
 
     def __init__(self, indptr, indices, blocks=None, labels=None, blockshape=None, dtype=np.double):
         self.indptr = indptr
@@ -19,6 +29,89 @@ class BlockMatrix:
     def to_dense(self, mirror=False):
         return blocks_to_dense(self.indptr, self.indices, self.blocks[:, :, self.labels], mirror=mirror)
 
+    def astype(self, dtype):
+        """
+        Returns a BlockMatrix sharing the index arrays, with the blocks converted to
+        dtype (np.double or np.float32).
+        """
+        M = BlockMatrix(self.indptr, self.indices, self.blocks.astype(dtype, order='F'), labels=self.labels)
+        M._row_index = getattr(self, '_row_index', None)
+        return M
+
+    def row_index(self):
+        """
+        Returns (row_indptr, row_cols, row_ptrs) giving row access to the blocks; the blocks
+        of block row i are in columns row_cols[r] with index row_ptrs[r] into indices/labels,
+        for r in range(row_indptr[i], row_indptr[i + 1]). Computed once and cached.
+        """
+        if getattr(self, '_row_index', None) is None:
+            n = self.indptr.shape[0] - 1
+            cols = np.repeat(np.arange(n, dtype=np.int32), np.diff(self.indptr))
+            row_ptrs = np.argsort(self.indices, kind='mergesort').astype(np.int32)
+            row_indptr = np.concatenate([[0], np.cumsum(np.bincount(self.indices, minlength=n))]).astype(np.int32)
+            self._row_index = (row_indptr, cols[row_ptrs], row_ptrs)
+        return self._row_index
+
+    def matvec(self, x, mirror=False, out=None):
+        """
+        Computes y = A x (+ out, if given; the result is then accumulated in out), in
+        parallel over block rows. `x` has shape (bs * n,) or (bs, n) (Fortran order), and
+        y is returned in the same shape.
+
+        If `mirror` is set, A is taken to be symmetric with only the lower half stored,
+        the upper half is applied by transposing the stored blocks. Blocks shared through
+        labels are never expanded, and blocks may be stored in single precision (see
+        `astype`) while x and y are double precision.
+
+        Suitable as the operator passed to cg_generator, e.g.
+        ``lambda x: A.matvec(x, mirror=True)``.
+        """
+        bs_left, bs_right = self.blocks.shape[0], self.blocks.shape[1]
+        n = self.indptr.shape[0] - 1
+        if mirror and bs_left != bs_right:
+            raise ValueError('cannot mirror non-symmetric matrix')
+        shape = x.shape
+        x = np.asfortranarray(x).reshape((bs_right, n), order='F')
+        if out is None:
+            out = np.zeros((bs_left, n), dtype=np.double, order='F')
+        y = out.reshape((bs_left, n), order='F')
+        row_indptr, row_cols, row_ptrs = self.row_index()
+        block_A_x_rows(int(mirror), self.indptr, self.indices, self.labels, self.blocks,
+                       row_indptr, row_cols, row_ptrs, x, y)
+        if len(shape) == 1:
+            return y.reshape(bs_left * n, order='F')
+        return y
+
+    def is_expanded(self):
+        """Whether there is one block stored per entry, in CSC order"""
+        nnz = self.indices.shape[0]
+        return (self.blocks.shape[2] == nnz and
+                np.array_equal(self.labels, np.arange(nnz, dtype=self.labels.dtype)))
+
+    def diagonal_blocks(self, dtype=np.double):
+        """
+        Returns a copy of the diagonal blocks, in Fortran order with shape (bs, bs, n).
+        The diagonal entry must be the first in each column (as for lower CSC matrices).
+        """
+        diag_ptrs = self.indptr[:-1]
+        if not np.all(self.indices[diag_ptrs] == np.arange(diag_ptrs.shape[0])):
+            raise ValueError('first entry of every column is not on the diagonal')
+        return np.asfortranarray(self.blocks[:, :, self.labels[diag_ptrs]], dtype=dtype)
+
+    def expand(self, dtype=np.double, out=None):
+        """
+        Returns blocks with one block per entry (in CSC order), i.e., blocks[:, :, labels],
+        but without creating temporaries of that size. If `out` is given, the blocks
+        are added to it.
+        """
+        nnz = self.indices.shape[0]
+        if out is None:
+            out = np.zeros(self.blocks.shape[:2] + (nnz,), dtype=dtype, order='F')
+        for start in range(0, nnz, EXPAND_CHUNK):
+            stop = min(start + EXPAND_CHUNK, nnz)
+            out[:, :, start:stop] += self.blocks[:, :, self.labels[start:stop]]
+        return out
+
     def diagonal(self):
         bs = self.blocks.shape[0]
         if bs != self.blocks.shape[1]:
@@ -30,6 +123,43 @@ class BlockMatrix:
         return diag
 
 
+class BlockMatrixSum:
+    """
+    Sum of BlockMatrix terms with the same sparsity pattern, e.g., a term with one
+    block per entry and a label-compressed term. Supports the same operations as
+    BlockMatrix where these can be done term by term, so that the terms never have
+    to be expanded into a common representation.
+    """
+
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self.indptr = self.terms[0].indptr
+        self.indices = self.terms[0].indices
+        for term in self.terms[1:]:
+            if not (np.array_equal(term.indptr, self.indptr) and np.array_equal(term.indices, self.indices)):
+                raise ValueError('terms do not have the same sparsity pattern')
+        # share the row index between terms
+        row_index = self.terms[0].row_index()
+        for term in self.terms[1:]:
+            term._row_index = row_index
+
+    def matvec(self, x, mirror=False, out=None):
+        for term in self.terms:
+            out = term.matvec(x, mirror=mirror, out=out)
+        return out
+
+    def diagonal_blocks(self, dtype=np.double):
+        result = self.terms[0].diagonal_blocks(dtype)
+        for term in self.terms[1:]:
+            result += term.diagonal_blocks(dtype)
+        return result
+
+    def expand(self, dtype=np.double, out=None):
+        for term in self.terms:
+            out = term.expand(dtype, out=out)
+        return out
+
+
 class NotPosDefError(Exception):
     pass
 
@@ -48,6 +178,16 @@ cdef extern:
         int32_t *indptr, int32_t *indices,
         double *blocks, double *x) nogil
 
+    void block_triangular_levels_ "block_triangular_levels"(
+        int32_t n, int32_t *indptr, int32_t *indices, int32_t *levels, int32_t *nlevels) nogil
+
+    void block_triangular_solve_levels_ "block_triangular_solve_levels"(
+        int32_t trans, int32_t bs, int32_t n,
+        int32_t *indptr, int32_t *indices, double *blocks,
+        int32_t nlevels, int32_t *level_ptr, int32_t *level_nodes,
+        int32_t *row_indptr, int32_t *row_cols, int32_t *row_blockptrs,
+        double *x) nogil
+
     void block_symm_At_D_A_ "block_symm_At_D_A"(
         int32_t bs, int32_t n,
         int32_t *A_indptr, int32_t *A_indices, double *A_blocks,
@@ -71,6 +211,18 @@ cdef extern:
         int32_t *A_indptr, int32_t *A_indices, int32_t *A_labels, double *A_blocks,
         double *x, double *y) nogil
 
+    void block_A_x_rows_ "block_A_x_rows"(
+        int32_t symmetric, int32_t bs_left, int32_t bs_right, int32_t n,
+        int32_t *indptr, int32_t *indices, int32_t *labels, double *blocks,
+        int32_t *row_indptr, int32_t *row_cols, int32_t *row_ptrs,
+        double *x, double *y) nogil
+
+    void block_A_x_rows_sp_ "block_A_x_rows_sp"(
+        int32_t symmetric, int32_t bs_left, int32_t bs_right, int32_t n,
+        int32_t *indptr, int32_t *indices, int32_t *labels, float *blocks,
+        int32_t *row_indptr, int32_t *row_cols, int32_t *row_ptrs,
+        double *x, double *y) nogil
+
     void block_diagonal_factor_ "block_diagonal_factor"(
         int32_t bs, int32_t n, double *blocks, int32_t *info) nogil
     void block_diagonal_solve_ "block_diagonal_solve"(
@@ -86,7 +238,7 @@ cdef extern:
         double *matrix, double *x) nogil
 
     void csc_make_clusters_ "csc_make_clusters"(
-        double eps, int32_t n, int32_t *indptr, int32_t *indices, double *norms,
+        double eps, int32_t max_size, int32_t n, int32_t *indptr, int32_t *indices, double *norms,
         int32_t *permutation, int32_t *cluster_size, int32_t *cluster_count) nogil
 
     void compute_block_norms_ "compute_block_norms"(
@@ -181,6 +333,83 @@ def block_triangular_solve(transpose,
         block_triangular_solve_(trans_int, bs, n, &indptr[0], &indices[0], &blocks[0,0,0], &x[0,0])
 
 
+class LevelSchedule:
+    """
+    Level scheduling of the triangular solves with a lower-triangular CSC block
+    matrix; see `block_triangular_levels` in block_matrix.f90. Also holds a
+    row-wise index of the sub-diagonal blocks, used by the forward solve.
+    """
+
+    def __init__(self, indptr, indices):
+        n = indptr.shape[0] - 1
+        self.levels = block_triangular_levels(indptr, indices)
+        self.nlevels = self.levels.max() + 1 if n > 0 else 0
+        self.level_nodes = np.argsort(self.levels, kind='mergesort').astype(np.int32)
+        self.level_ptr = np.searchsorted(self.levels[self.level_nodes],
+                                         np.arange(self.nlevels + 1)).astype(np.int32)
+
+        # Row access to the sub-diagonal blocks; row_cols and row_blockptrs get a
+        # trailing 0 so that they are never empty
+        cols = np.repeat(np.arange(n, dtype=np.int32), np.diff(indptr))
+        sub_diagonal = np.ones(indices.shape[0], dtype=bool)
+        sub_diagonal[indptr[:-1]] = False
+        ptrs = np.nonzero(sub_diagonal)[0]
+        order = np.argsort(indices[ptrs], kind='mergesort')
+        self.row_blockptrs = np.concatenate([ptrs[order], [0]]).astype(np.int32)
+        self.row_cols = cols[self.row_blockptrs]
+        self.row_indptr = np.concatenate([[0], np.cumsum(np.bincount(indices[ptrs], minlength=n))]).astype(np.int32)
+
+    def parallelism(self):
+        """Average number of nodes that can be solved for concurrently"""
+        return self.level_nodes.shape[0] / float(max(self.nlevels, 1))
+
+
+def block_triangular_levels(cnp.ndarray[int32_t, mode='fortran'] indptr,
+                            cnp.ndarray[int32_t, mode='fortran'] indices):
+    cdef int32_t n = indptr.shape[0] - 1, nlevels
+    cdef cnp.ndarray[int32_t, mode='fortran'] levels = np.zeros(n, dtype=np.int32)
+    if n == 0:
+        return levels
+    with nogil:
+        block_triangular_levels_(n, &indptr[0], &indices[0], &levels[0], &nlevels)
+    return levels
+
+
+def block_triangular_solve_levels(transpose,
+                                  cnp.ndarray[int32_t, mode='fortran'] indptr,
+                                  cnp.ndarray[int32_t, mode='fortran'] indices,
+                                  cnp.ndarray[double, ndim=3, mode='fortran'] blocks,
+                                  schedule,
+                                  cnp.ndarray[double, ndim=2, mode='fortran'] x):
+    """
+    Same as `block_triangular_solve`, but solves for the nodes on each level of
+    `schedule` (a LevelSchedule for indptr/indices) in parallel.
+    """
+    cdef int32_t bs = blocks.shape[0], n = indptr.shape[0] - 1
+    cdef int32_t trans_int, nlevels = schedule.nlevels
+    cdef cnp.ndarray[int32_t, mode='fortran'] level_ptr = schedule.level_ptr
+    cdef cnp.ndarray[int32_t, mode='fortran'] level_nodes = schedule.level_nodes
+    cdef cnp.ndarray[int32_t, mode='fortran'] row_indptr = schedule.row_indptr
+    cdef cnp.ndarray[int32_t, mode='fortran'] row_cols = schedule.row_cols
+    cdef cnp.ndarray[int32_t, mode='fortran'] row_blockptrs = schedule.row_blockptrs
+    if not (blocks.shape[0] == blocks.shape[1] == x.shape[0]):
+        raise ValueError('invalid shape on blocks arg')
+    if level_nodes.shape[0] != n or x.shape[1] != n:
+        raise ValueError('schedule or x does not conform with matrix')
+    if transpose == 'N':
+        trans_int = 0
+    elif transpose == 'T':
+        trans_int = 1
+    else:
+        raise ValueError('transpose not in ("N", "T")')
+    if n == 0:
+        return
+    with nogil:
+        block_triangular_solve_levels_(trans_int, bs, n, &indptr[0], &indices[0], &blocks[0,0,0],
+                                       nlevels, &level_ptr[0], &level_nodes[0],
+                                       &row_indptr[0], &row_cols[0], &row_blockptrs[0], &x[0,0])
+
+
 def block_At_D_B(A, B, cnp.ndarray[double, ndim=2, mode='fortran'] D, C):
     """
     C = C + A^T D B
@@ -202,6 +431,8 @@ def block_At_D_B(A, B, cnp.ndarray[double, ndim=2, mode='fortran'] D, C):
         raise ValueError()
     if (<object>D).shape[:2] != (bs_mid, A_n):
         raise ValueError()
+    if not C.is_expanded():
+        raise ValueError('C must have one block per entry; ninv breaks the symmetry between blocks')
  
     cdef cnp.ndarray[double, ndim=3, mode='fortran'] A_blocks, B_blocks, C_blocks
     cdef cnp.ndarray[int32_t, ndim=1, mode='fortran'] A_indices, A_indptr, A_labels, B_indices, B_indptr, B_labels, C_indices, C_indptr
@@ -261,6 +492,43 @@ def block_A_x(cnp.ndarray[int32_t, mode='fortran'] A_indptr,
     return y
 
 
+def block_A_x_rows(int32_t symmetric,
+                   cnp.ndarray[int32_t, mode='fortran'] indptr,
+                   cnp.ndarray[int32_t, mode='fortran'] indices,
+                   cnp.ndarray[int32_t, mode='fortran'] labels,
+                   blocks,
+                   cnp.ndarray[int32_t, mode='fortran'] row_indptr,
+                   cnp.ndarray[int32_t, mode='fortran'] row_cols,
+                   cnp.ndarray[int32_t, mode='fortran'] row_ptrs,
+                   cnp.ndarray[double, ndim=2, mode='fortran'] x,
+                   cnp.ndarray[double, ndim=2, mode='fortran'] y):
+    """
+    y += A x, see BlockMatrix.matvec. `blocks` may be double or single precision.
+    """
+    cdef cnp.ndarray[double, ndim=3, mode='fortran'] blocks_dp
+    cdef cnp.ndarray[float, ndim=3, mode='fortran'] blocks_sp
+    cdef int32_t bs_left = blocks.shape[0], bs_right = blocks.shape[1], n = indptr.shape[0] - 1
+    if x.shape[0] != bs_right or y.shape[0] != bs_left or x.shape[1] != n or y.shape[1] != n:
+        raise ValueError('x or y does not conform with matrix')
+    if labels.shape[0] != indices.shape[0] or row_ptrs.shape[0] != indices.shape[0]:
+        raise ValueError('labels or row index does not conform with matrix')
+    if n == 0 or indices.shape[0] == 0:
+        return y
+    if blocks.dtype == np.float32:
+        blocks_sp = blocks
+        with nogil:
+            block_A_x_rows_sp_(symmetric, bs_left, bs_right, n, &indptr[0], &indices[0], &labels[0],
+                               &blocks_sp[0,0,0], &row_indptr[0], &row_cols[0], &row_ptrs[0],
+                               &x[0,0], &y[0,0])
+    else:
+        blocks_dp = blocks
+        with nogil:
+            block_A_x_rows_(symmetric, bs_left, bs_right, n, &indptr[0], &indices[0], &labels[0],
+                            &blocks_dp[0,0,0], &row_indptr[0], &row_cols[0], &row_ptrs[0],
+                            &x[0,0], &y[0,0])
+    return y
+
+
 def block_diagonal_factor(cnp.ndarray[double, ndim=3, mode='fortran'] blocks):
     cdef int32_t info
     if blocks.shape[0] != blocks.shape[1]:
@@ -362,7 +630,15 @@ def csc_compressed_block_diagonal_solve(cnp.ndarray[int32_t, mode='fortran'] clu
             x=&x[0])
     return x
 
-def csc_make_clusters(double eps, object csc_norm_matrix):
+def csc_make_clusters(double eps, object csc_norm_matrix, int32_t max_size=0):
+    """
+    Greedily merges nodes of a lower-triangular CSC matrix of block norms into clusters,
+    as long as an off-diagonal norm relative to the norm of either cluster is above eps
+    and the merged cluster has no more than `max_size` nodes (0 for no limit).
+
+    Returns (permutation, cluster_size); `permutation` lists the nodes of each cluster
+    in turn.
+    """
     cdef cnp.ndarray[int32_t, mode='fortran'] indptr = csc_norm_matrix.indptr
     cdef cnp.ndarray[int32_t, mode='fortran'] indices = csc_norm_matrix.indices
     cdef cnp.ndarray[double, mode='fortran'] norms = csc_norm_matrix.data
@@ -373,7 +649,7 @@ def csc_make_clusters(double eps, object csc_norm_matrix):
     cdef int32_t cluster_count
 
     with nogil:
-        csc_make_clusters_(eps, n, &indptr[0], &indices[0], &norms[0],
+        csc_make_clusters_(eps, max_size, n, &indptr[0], &indices[0], &norms[0],
                            &permutation[0], &cluster_size[0], &cluster_count)
     return permutation, cluster_size[:cluster_count]
 
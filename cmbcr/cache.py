@@ -1,26 +1,171 @@
 """
 Load from given FITS file, but if file has already been loaded in running process, return it
 from cache instead. Use a seperte module so that reload() seldom/never needs to touch it.
+
+The in-process cache is bounded by a byte budget (see `set_cache_limit`) and evicts the
+least recently used entries first. Arrays are handed out as read-only views, so callers
+that need to mutate the result must copy it themselves.
 """
 import logging
-from functools import wraps
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps, partial
 import joblib
+import numpy as np
+
+
+# number of active disk_cache_bypassed() contexts
+_disk_cache_bypass = [0]
+_disk_cache_bypass_lock = threading.Lock()
+
+
+class Memory(joblib.Memory):
+    """
+    joblib.Memory whose cached functions call straight through to the underlying
+    function, neither reading nor writing the disk cache, while in a
+    `disk_cache_bypassed()` block.
+    """
+    def cache(self, func=None, **kw):
+        if func is None:
+            return partial(self.cache, **kw)
+        memorized = joblib.Memory.cache(self, func, **kw)
+
+        @wraps(func)
+        def replacement(*args, **kwargs):
+            if _disk_cache_bypass[0]:
+                return func(*args, **kwargs)
+            return memorized(*args, **kwargs)
+        replacement.memorized = memorized
+        return replacement
+
+
+memory = Memory(cachedir='cache')
+
+
+@contextmanager
+def disk_cache_bypassed():
+    """
+    Within this block, functions cached with `memory.cache` are recomputed, e.g. in
+    order to time them; this applies to all threads.
+    """
+    with _disk_cache_bypass_lock:
+        _disk_cache_bypass[0] += 1
+    try:
+        yield
+    finally:
+        with _disk_cache_bypass_lock:
+            _disk_cache_bypass[0] -= 1
+
+
+DEFAULT_CACHE_LIMIT = 4 * 1024**3
+
+
+class MapCache(object):
+    """
+    LRU cache keyed on filename, bounded by the total `nbytes` of the cached values.
+    Values are stored read-only and returned as read-only views.
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_LIMIT):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, loader):
+        with self.lock:
+            x = self.entries.pop(key, None)
+            if x is not None:
+                # re-insert to mark as most recently used
+                self.entries[key] = x
+                self.hits += 1
+                return _readonly_view(x)
+            self.misses += 1
+        logging.info('Loading {}'.format(key))
+        x = loader(key)
+        if isinstance(x, np.ndarray):
+            x.flags.writeable = False
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = x
+                self.nbytes += _nbytes_of(x)
+                self._evict()
+        return _readonly_view(x)
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self.entries:
+            key, x = self.entries.popitem(last=False)
+            self.nbytes -= _nbytes_of(x)
+            self.evictions += 1
+            logging.info('Evicting {} from map cache'.format(key))
+
+    def evict(self, keys):
+        with self.lock:
+            for key in keys:
+                x = self.entries.pop(key, None)
+                if x is not None:
+                    self.nbytes -= _nbytes_of(x)
+                    self.evictions += 1
+
+    def set_limit(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        count=len(self.entries), nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+
+def _nbytes_of(x):
+    return getattr(x, 'nbytes', 0)
+
+
+def _readonly_view(x):
+    if isinstance(x, np.ndarray):
+        x = x.view()
+        x.flags.writeable = False
+    return x
+
+
+_cache = MapCache()
+
+
+def set_cache_limit(max_bytes):
+    _cache.set_limit(max_bytes)
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+def clear_cache():
+    _cache.clear()
 
 
-memory = joblib.Memory(cachedir='cache')
+def evict_cached(keys):
+    """
+    Drop the entries for `keys` from the in-process cache; missing keys are ignored.
+    """
+    _cache.evict(keys)
 
 
-_cache = {}
+def get_cached(key, loader):
+    """
+    Look up `key` in the in-process cache, calling `loader(key)` on a miss.
+    """
+    return _cache.get(key, loader)
 
-#def cached(func, copy=lambda x: x.copy()):
-#    return func
 
-def cached(func, copy=lambda x: x.copy()):
+def cached(func):
     @wraps(func)
     def replacement(filename):
-        x = _cache.get(filename, None)
-        if x is None:
-            logging.info('Loading {}'.format(filename))
-            x = _cache[filename] = func(filename)
-        return x
+        return _cache.get(filename, func)
     return replacement
@@ -1,17 +1,19 @@
 import numpy as np
 import os
 import logging
+from multiprocessing.pool import ThreadPool
 
 import healpy
 
 
 
 from .data_utils import load_map, load_beam
-from .cache import cached, memory
+from .cache import cached, get_cached, evict_cached, cache_stats, memory
+from .map_store import MapStore, DEFAULT_STORE_PATH
 from .rotate_alm import rotate_alm
 from .mmajor import scatter_l_to_lm
 from . import sharp
-from .utils import timed, pad_or_truncate_alm
+from .utils import timed, format_duration, format_bytes, pad_or_truncate_alm
 from .healpix import nside_of
 from .beams import fwhm_to_sigma
 
@@ -20,6 +22,61 @@ __all__ = ['CrSystem', 'downgrade_system']
 load_map_cached = cached(lambda filename: load_map('raw', filename))
 load_beam_cached = cached(load_beam)
 
+
+def map_cache_key(filename, nside=None, power=0):
+    """
+    The key under which `load_map_stored` caches a map read from FITS.
+    """
+    return filename if nside is None else (filename, nside, power)
+
+
+def load_map_stored(store, filename, nside=None, power=0):
+    """
+    Load a map from the memory-mapped map store if it has a current entry for it,
+    otherwise from FITS through the in-process cache. If `nside` is given the map is
+    ud_graded to that resolution; in that case only the ud_graded map is cached and
+    the full resolution map is dropped as soon as it has been downgraded.
+    """
+    x = store.load(filename, nside=nside, power=power)
+    if x is not None:
+        return x
+    elif nside is None:
+        return load_map_cached(filename)
+    else:
+        def load_and_udgrade(key):
+            return healpy.ud_grade(load_map('raw', filename), order_in='RING', order_out='RING',
+                                   nside_out=nside, power=power)
+        return get_cached(map_cache_key(filename, nside, power), load_and_udgrade)
+
+
+def load_beam_stored(store, filename):
+    x = store.load(filename)
+    if x is None:
+        x = load_beam_cached(filename)
+    return x
+
+
+def iterate_config_files(config_doc):
+    """
+    Yields (kind, key, filename, udgrade_power) for every map and beam file that
+    `CrSystem.from_config` reads. kind is one of 'mask', 'beam', 'rms', 'mixing';
+    key is None for the mask, the band index for beams and rms maps, and
+    (band index, component index) for mixing maps.
+    """
+    model = config_doc['model']
+    if model.get('mask', ''):
+        yield 'mask', None, model['mask'], 0
+    nu = 0
+    for dataset in config_doc['datasets']:
+        path = dataset['path']
+        for band in dataset['bands']:
+            assert isinstance(band['name'], basestring), 'You need to surround band names with quotes'
+            yield 'beam', nu, os.path.join(path, dataset['beam_template'].format(band=band)), None
+            yield 'rms', nu, os.path.join(path, dataset['rms_template'].format(band=band)), 1
+            for k, component in enumerate(model['components']):
+                yield 'mixing', (nu, k), model['mixing_maps_template'].format(band=band, component=component), 0
+            nu += 1
+
 @memory.cache
 def rotate_ninv(lmax_ninv, ninv_map, rot_ang):
     winv_ninv_sh = sharp.sh_adjoint_synthesis(lmax_ninv, ninv_map)
@@ -31,7 +88,8 @@ def rotate_ninv(lmax_ninv, ninv_map, rot_ang):
 
 @memory.cache
 def rotate_mixing(lmax_pix, mixing_map, rot_ang):
-    mixing_map_sh = sharp.sh_analysis(lmax_pix, mixing_map)
+    # maps from the map cache are read-only, libsharp wants a writeable buffer
+    mixing_map_sh = sharp.sh_analysis(lmax_pix, np.require(mixing_map, requirements='W'))
     if rot_ang != (0, 0, 0):
         rotate_alm(lmax_pix, mixing_map_sh, *rot_ang)
     p = sharp.RealMmajorGaussPlan(lmax_pix, lmax_pix)
@@ -113,6 +171,8 @@ class CrSystem(object):
         self.x_lengths = [(lmax + 1)**2 for lmax in self.lmax_list]
         self.x_offsets = np.concatenate([[0], np.cumsum(self.x_lengths)])
         self.mask = mask
+        # kind ('rms' or 'mixing') -> keys of the maps from_config read into the map cache
+        self.map_cache_keys = {}
 
     def stack(self, x_lst):
         for k, x in enumerate(x_lst):
@@ -150,12 +210,13 @@ class CrSystem(object):
 
         # Estimates of Ni level for prior construction in demos; *note* that we *include* component_scale
         # here...
+        self.ninv_tau_lst = [
+            ninv_map.mean() * ninv_map.shape[0] / (4 * np.pi) for ninv_map in self.ninv_maps]
         self.ni_approx_by_comp_lst = []
         for k in range(self.comp_count):
             ni_approx = 0
             for nu in range(self.band_count):
-                tau = self.ninv_maps[nu].mean() * self.ninv_maps[nu].shape[0] / (4 * np.pi)
-                ni_approx += self.mixing_scalars[nu, k]**2 * tau * self.bl_list[nu][:self.lmax_list[k] + 1]**2
+                ni_approx += self.mixing_scalars[nu, k]**2 * self.ninv_tau_lst[nu] * self.bl_list[nu][:self.lmax_list[k] + 1]**2
             self.ni_approx_by_comp_lst.append(ni_approx)
         # Prepare prior
         if set_wl_dl:
@@ -175,7 +236,21 @@ class CrSystem(object):
     def set_wl_list(self, wl_list):
         self.wl_list = wl_list
 
-    def prepare(self, use_healpix=False, use_healpix_mixing=False, mixing_nside=None):
+    def prepare(self, use_healpix=False, use_healpix_mixing=False, mixing_nside=None,
+                low_memory=False, mixing_dtype=np.double, constant_mixing_rtol=1e-4):
+        """
+        Set up the plans and derived maps used by `matvec`.
+
+        Mixing maps whose relative standard deviation is below `constant_mixing_rtol`
+        (or all of them, if `flat_mixing` was set) are applied as scalars in harmonic
+        space rather than in pixel space; pass None to always mix in pixel space.
+        Systems with a mask are always mixed in pixel space, where the mask is applied.
+
+        If `low_memory` is set, the original mixing maps are dropped once the mixing
+        maps used by `matvec` have been derived from them; call `release_intermediates`
+        after the preconditioners have been built to free the rest. `mixing_dtype` can
+        be set to np.float32 to store the derived mixing maps in single precision.
+        """
         # Make G-L ninv-maps, possibly rotated
         self.ninv_gauss_lst = []
         self.winv_ninv_sh_lst = []
@@ -203,6 +278,11 @@ class CrSystem(object):
             self.ni_approx_by_comp_lst[k] *= self.component_scale[k]**2
 
         self.mixing_maps_ugrade = {}
+        self.mixing_nside = mixing_nside
+        self.mixing_dtype = mixing_dtype
+        self.constant_mixing_rtol = constant_mixing_rtol
+        # Bumped by `update_mixing`; preconditioners record it to detect stale data
+        self.mixing_version = 0
 
         if self.use_healpix_mixing:
             from cmbcr.healpix_data import get_ring_weights_T
@@ -215,15 +295,7 @@ class CrSystem(object):
 
             for nu in range(self.band_count):
                 for k in range(self.comp_count):
-
-                    self.mixing_maps_ugrade[nu, k] = healpy.ud_grade(
-                        self.mixing_maps[nu, k],
-                        order_in='RING',
-                        order_out='RING',
-                        nside_out=mixing_nside,
-                        power=0)
-                if self.mask is not None:
-                    self.mixing_maps_ugrade[nu, k] *= self.mask_dg
+                    self.mixing_maps_ugrade[nu, k] = self.derive_mixing_map(k, self.mixing_maps[nu, k])
 
             weights = get_ring_weights_T(mixing_nside)
             self.plan_outer_lst = [
@@ -233,7 +305,7 @@ class CrSystem(object):
         else:
             # Resample mask to Gauss-Legendre grid
             if self.mask is not None:
-                mask_lm = sharp.sh_analysis(self.lmax_mixing_pix, self.mask)
+                mask_lm = sharp.sh_analysis(self.lmax_mixing_pix, np.require(self.mask, requirements='W'))
                 self.mask_gauss_grid = sharp.sh_synthesis_gauss(self.lmax_mixing_pix, mask_lm)
                 self.mask_gauss_grid[self.mask_gauss_grid < 0.8] = 0
                 self.mask_gauss_grid[self.mask_gauss_grid >= 0.8] = 1
@@ -243,63 +315,222 @@ class CrSystem(object):
             for nu in range(self.band_count):
                 for k in range(self.comp_count):
                     with timed('mixing'):
-                        self.mixing_maps_ugrade[nu, k] = (
-                            rotate_mixing(self.lmax_mixing_pix, self.mixing_maps[nu, k], self.rot_ang)
-                            * self.component_scale[k])
+                        self.mixing_maps_ugrade[nu, k] = self.derive_mixing_map(k, self.mixing_maps[nu, k])
 
-                        if self.mask_gauss_grid is not None:
-                            self.mixing_maps_ugrade[nu, k] *= self.mask_gauss_grid
-
-                        self.mixing_maps[nu, k] *= self.component_scale[k]
-                        if self.flat_mixing:
-                            assert False
-                            self.mixing_maps_ugrade[nu, k][:] = self.mixing_maps_ugrade[nu, k].mean()
+                        # mixing_maps may be read-only views into the map cache
+                        if self.component_scale[k] != 1:
+                            self.mixing_maps[nu, k] = self.mixing_maps[nu, k] * self.component_scale[k]
 
             self.plan_outer_lst = [
                 sharp.RealMmajorGaussPlan(self.lmax_mixing_pix, lmax)
                 for lmax in self.lmax_list]
             self.plan_mixed = sharp.RealMmajorGaussPlan(self.lmax_mixing_pix, self.lmax_mixed) # lmax_mixing(pix) -> lmax_mixing(sh)
 
+        self.find_constant_mixing(constant_mixing_rtol)
+        self.convert_mixing_dtype(self.mixing_maps_ugrade.keys())
+
+        if low_memory:
+            self.release_intermediates(keep=['winv_ninv_sh_lst', 'ninv_gauss_lst', 'ninv_maps'])
+
+    def derive_mixing_map(self, k, mixing_map):
+        """
+        Resamples the mixing map of a pair with component `k` to the grid used by
+        `matvec`; `mixing_map` is not rescaled by `component_scale`.
+        """
+        if self.use_healpix_mixing:
+            q = healpy.ud_grade(mixing_map, order_in='RING', order_out='RING',
+                                nside_out=self.mixing_nside, power=0)
+            if self.mask is not None:
+                q = q * self.mask_dg
+        else:
+            q = rotate_mixing(self.lmax_mixing_pix, mixing_map, self.rot_ang) * self.component_scale[k]
+            if self.mask_gauss_grid is not None:
+                q *= self.mask_gauss_grid
+        return q
+
+    def convert_mixing_dtype(self, keys):
+        if self.mixing_dtype != np.double:
+            for key in keys:
+                if key in self.mixing_maps_ugrade:
+                    self.mixing_maps_ugrade[key] = self.mixing_maps_ugrade[key].astype(self.mixing_dtype)
+
+    def update_mixing(self, mixing_updates):
+        """
+        Replace the mixing maps of some (band, component) pairs after `prepare` has been
+        called, given as a dict {(nu, k): mixing_map}. Only the quantities derived from
+        those pairs are recomputed (`mixing_scalars`, the mixing maps used by `matvec`
+        and `ni_approx_by_comp_lst`); the noise maps, plans and priors are left alone.
+
+        Preconditioners depend on `mixing_scalars` and record `mixing_version`, which is
+        bumped here; those built before the update report `is_stale()` and should be
+        rebuilt. Note that `dl_list` is not recomputed, even for priors with a `cross`
+        spec which depend on `ni_approx_by_comp_lst`.
+        """
+        for (nu, k), q in mixing_updates.items():
+            self.mixing_scalars[nu, k] = (q[q != 0]).mean() * self.component_scale[k]
+            self.mixing_maps_ugrade[nu, k] = self.derive_mixing_map(k, q)
+            # mixing_maps is None if dropped by release_intermediates
+            if self.mixing_maps is not None:
+                self.mixing_maps[nu, k] = q * self.component_scale[k] if self.component_scale[k] != 1 else q
+            self.constant_mixing.pop((nu, k), None)
+
+        for k in set(k for nu, k in mixing_updates):
+            self.ni_approx_by_comp_lst[k] = sum(
+                self.mixing_scalars[nu, k]**2 * self.ninv_tau_lst[nu] * self.bl_list[nu][:self.lmax_list[k] + 1]**2
+                for nu in range(self.band_count))
+
+        self.find_constant_mixing(self.constant_mixing_rtol, keys=list(mixing_updates.keys()))
+        self.convert_mixing_dtype(mixing_updates.keys())
+        self.mixing_version += 1
+
+    def find_constant_mixing(self, rtol, keys=None):
+        """
+        Find the (band, component) pairs with a constant mixing map, to within relative
+        tolerance `rtol` (all pairs if `flat_mixing` is set). These are moved from
+        `mixing_maps_ugrade` to `constant_mixing` and are applied as a scalar in
+        harmonic space by `matvec`, which saves two SHTs per band whose mixing maps are
+        all constant. If `keys` is given, only those pairs are (re-)classified.
+
+        With a mask, the mask is applied through the mixing maps, so all pairs are
+        mixed in pixel space; `flat_mixing` is not supported in that case.
+        """
+        if keys is None:
+            self.constant_mixing = {}
+            keys = list(self.mixing_maps_ugrade.keys())
+        if self.mask is not None:
+            if self.flat_mixing:
+                raise ValueError('flat_mixing is not supported for systems with a mask')
+            keys = []
+        for key in keys:
+            q = self.mixing_maps_ugrade[key]
+            # same convention as mixing_scalars
+            mean = float(q[q != 0].mean()) if np.any(q) else 0.
+            if self.flat_mixing or (rtol is not None and q.std() <= rtol * abs(mean)):
+                self.constant_mixing[key] = mean
+                del self.mixing_maps_ugrade[key]
+
+        # components mixed in pixel space, per band
+        self.pixel_mixing_comps = [
+            [k for k in range(self.comp_count) if (nu, k) in self.mixing_maps_ugrade]
+            for nu in range(self.band_count)]
+        # components that need to be synthesized to the mixing grid
+        self.pixel_mixed_comps = sorted(set(sum(self.pixel_mixing_comps, [])))
+        logging.info('Mixing {} of {} (band, component) pairs as scalars'.format(
+            len(self.constant_mixing), self.band_count * self.comp_count))
+
+    def release_intermediates(self, keep=(), ninv_dtype=np.double):
+        """
+        Drop the attributes computed during setup that `matvec` does not use; the
+        preconditioners need some of them, so call this after building those.
+        Attribute names in `keep` are left in place. The noise maps used by `matvec`
+        are converted to `ninv_dtype`.
+
+        The maps read by `from_config` are also held by the in-process map cache, so
+        their cache entries are evicted as well: those of the rms maps, which are only
+        used to compute the noise maps, and those of the mixing maps unless kept.
+        """
+        drop = ['mixing_maps', 'winv_ninv_sh_lst']
+        drop.append('ninv_gauss_lst' if self.use_healpix else 'ninv_maps')
+        for name in drop:
+            if name not in keep:
+                setattr(self, name, None)
+
+        evict = list(self.map_cache_keys.get('rms', []))
+        if 'mixing_maps' not in keep:
+            evict.extend(self.map_cache_keys.get('mixing', []))
+        evict_cached(evict)
+
+        if ninv_dtype != np.double:
+            name = 'ninv_maps' if self.use_healpix else 'ninv_gauss_lst'
+            setattr(self, name, [x.astype(ninv_dtype) for x in getattr(self, name)])
+
+    def memory_report(self):
+        """
+        Returns a list of (attribute name, nbytes) for the array data held by the
+        system, largest first, and logs it. Lists and dicts of arrays are summed.
+        Memory-mapped arrays are listed but are not resident until touched. The
+        in-process map cache is listed as 'map cache'; arrays that are both cached and
+        held by the system are counted in both.
+        """
+        def nbytes_of(x):
+            if isinstance(x, np.ndarray):
+                return x.nbytes
+            elif isinstance(x, (list, tuple)):
+                return sum(nbytes_of(y) for y in x)
+            elif isinstance(x, dict):
+                return sum(nbytes_of(y) for y in x.values())
+            else:
+                return 0
+
+        report = [(name, nbytes_of(x)) for name, x in vars(self).items()]
+        report.append(('map cache', cache_stats()['nbytes']))
+        report = sorted([(name, n) for name, n in report if n > 0], key=lambda item: -item[1])
+        for name, n in report:
+            logging.info('{:>24}: {}'.format(name, format_bytes(n)))
+        logging.info('{:>24}: {}'.format('total', format_bytes(sum(n for name, n in report))))
+        return report
+
+    def apply_band_noise(self, nu, y):
+        """
+        Applies B N^{-1} B (beam, inverse noise weighting, beam) of band `nu` to
+        the spherical harmonic coefficients `y`.
+        """
+        # Instrumental beam
+        y = y * scatter_l_to_lm(self.bl_list[nu][:self.lmax_mixed + 1])
+        # Inverse noise weighting
+        if self.use_healpix:
+            u = sharp.sh_synthesis(nside_of(self.ninv_maps[nu]), y)
+            u *= self.ninv_maps[nu]
+            y = sharp.sh_adjoint_synthesis(self.lmax_mixed, u)
+        else:
+            # gauss-legendre mode
+            u = self.plan_ninv.synthesis(y)
+            u *= self.ninv_gauss_lst[nu]
+            y = self.plan_ninv.adjoint_synthesis(u)
+        y *= scatter_l_to_lm(self.bl_list[nu][:self.lmax_mixed + 1])
+        return y
+
     def matvec(self, x_lst, skip_prior=False):
         assert len(x_lst) == self.comp_count
 
+        x_lst_w = [x_lst[k] * scatter_l_to_lm(self.wl_list[k]) for k in range(self.comp_count)]
         x_pix_lst = [
-            plan.synthesis(x_lst[k] * scatter_l_to_lm(self.wl_list[k]))
-            for k, plan in enumerate(self.plan_outer_lst)
+            self.plan_outer_lst[k].synthesis(x_lst_w[k]) if k in self.pixel_mixed_comps else None
+            for k in range(self.comp_count)
             ]
         z_pix_lst = [0] * self.comp_count
+        z_lst = [0] * self.comp_count
 
         for nu in range(self.band_count):
-            # Mix components together
-            y = np.zeros(self.mixing_maps_ugrade[0,0].shape[0])
-            for k in range(self.comp_count):
-                u = x_pix_lst[k] * self.mixing_maps_ugrade[nu, k]
-                y += u
-            y = self.plan_mixed.analysis(y)
-            # Instrumental beam
-            y *= scatter_l_to_lm(self.bl_list[nu][:self.lmax_mixed + 1])
-            # Inverse noise weighting
-            if self.use_healpix:
-                u = sharp.sh_synthesis(nside_of(self.ninv_maps[nu]), y)
-                u *= self.ninv_maps[nu]
-                y = sharp.sh_adjoint_synthesis(self.lmax_mixed, u)
+            pixel_comps = self.pixel_mixing_comps[nu]
+            # Mix components together; components with spatially varying mixing maps
+            # are mixed in pixel space, constant ones directly in harmonic space
+            if pixel_comps:
+                y = np.zeros(self.plan_mixed.npix_local)
+                for k in pixel_comps:
+                    u = x_pix_lst[k] * self.mixing_maps_ugrade[nu, k]
+                    y += u
+                y = self.plan_mixed.analysis(y)
             else:
-                # gauss-legendre mode
-                u = self.plan_ninv.synthesis(y)
-                u *= self.ninv_gauss_lst[nu]
-                y = self.plan_ninv.adjoint_synthesis(u)
+                y = np.zeros((self.lmax_mixed + 1)**2)
+            for k in range(self.comp_count):
+                if (nu, k) in self.constant_mixing:
+                    y += pad_or_truncate_alm(x_lst_w[k], self.lmax_mixed) * self.constant_mixing[nu, k]
+            y = self.apply_band_noise(nu, y)
             # Transpose our way out, accumulate result in z_list[icomp];
             # note that z_list will get result from all bands
-            y *= scatter_l_to_lm(self.bl_list[nu][:self.lmax_mixed + 1])
-            y = self.plan_mixed.adjoint_analysis(y)
             for k in range(self.comp_count):
-                u = y * self.mixing_maps_ugrade[nu, k]
-                z_pix_lst[k] += u
-
-        z_lst = [
-            plan.adjoint_synthesis(z_pix_lst[k]) * scatter_l_to_lm(self.wl_list[k])
-            for k, plan in enumerate(self.plan_outer_lst)
-            ]
+                if (nu, k) in self.constant_mixing:
+                    z_lst[k] += pad_or_truncate_alm(y, self.lmax_list[k]) * self.constant_mixing[nu, k]
+            if pixel_comps:
+                y = self.plan_mixed.adjoint_analysis(y)
+                for k in pixel_comps:
+                    u = y * self.mixing_maps_ugrade[nu, k]
+                    z_pix_lst[k] += u
+
+        for k in self.pixel_mixed_comps:
+            z_lst[k] += self.plan_outer_lst[k].adjoint_synthesis(z_pix_lst[k])
+        z_lst = [z_lst[k] * scatter_l_to_lm(self.wl_list[k]) for k in range(self.comp_count)]
 
         if not skip_prior:
             for k in range(self.comp_count):
@@ -317,23 +548,11 @@ class CrSystem(object):
             y = np.zeros((self.lmax_mixed + 1)**2)
             for k in range(self.comp_count):
                 y += pad_or_truncate_alm(x_lst[k], self.lmax_mixed) * self.mixing_scalars[nu, k]
-            # Instrumental beam
-            y *= scatter_l_to_lm(self.bl_list[nu][:self.lmax_mixed + 1])
-            # Inverse noise weighting
-            if self.use_healpix:
-                u = sharp.sh_synthesis(nside_of(self.ninv_maps[nu]), y)
-                u *= self.ninv_maps[nu]
-                y = sharp.sh_adjoint_synthesis(self.lmax_mixed, u)
-            else:
-                # gauss-legendre mode
-                u = self.plan_ninv.synthesis(y)
-                u *= self.ninv_gauss_lst[nu]
-                y = self.plan_ninv.adjoint_synthesis(u)
+            y = self.apply_band_noise(nu, y)
             # Transpose our way out, accumulate result in z_list[icomp];
             # note that z_list will get result from all bands
-            y *= scatter_l_to_lm(self.bl_list[nu][:self.lmax_mixed + 1])
             for k in range(self.comp_count):
-                z_lst[k] = pad_or_truncate_alm(y, self.lmax_list[k]) * self.mixing_scalars[nu, k]
+                z_lst[k] += pad_or_truncate_alm(y, self.lmax_list[k]) * self.mixing_scalars[nu, k]
 
         for k in range(self.comp_count):
             z_lst[k] += scatter_l_to_lm(self.dl_list[k]) * x_lst[k]
@@ -341,59 +560,70 @@ class CrSystem(object):
 
 
     @classmethod
-    def from_config(cls, config_doc, rms_treshold=0, mask_eps=0.1, mask=None, udgrade=None):
-        ninv_maps = []
-        bl_list = []
-        prior_list = []
-
-        mixing_maps_template = config_doc['model']['mixing_maps_template']
+    def from_config(cls, config_doc, rms_treshold=0, mask_eps=0.1, mask=None, udgrade=None,
+                    mixing_udgrade=None, nthreads=8):
+        """
+        Load a system from a config document. Files are read concurrently on a pool of
+        `nthreads` threads. If `udgrade` is given the rms maps are ud_graded to that nside,
+        and if `mixing_udgrade` is given the mask and mixing maps are; each map is
+        downgraded as soon as it is read so that the full resolution maps are not kept.
+        """
+        # Use pre-converted maps if they are present in the map store
+        store = MapStore(config_doc['model'].get('map_store', DEFAULT_STORE_PATH))
+
+        # Maps from the cache and store are read-only; only copy where we need to mutate
+        def load_file(task):
+            kind, key, filename, power = task
+            nside = udgrade if kind == 'rms' else mixing_udgrade
+            with timed(None) as t:
+                if kind == 'beam':
+                    # beams are small and are passed on to typed Cython buffers, which need writeable arrays
+                    x = load_beam_stored(store, filename).copy()
+                elif kind == 'rms':
+                    rms = load_map_stored(store, filename, nside=nside, power=power)
+                    alpha = np.percentile(rms, rms_treshold)
+                    x = 1 / np.maximum(rms, alpha)**2
+                else:
+                    x = load_map_stored(store, filename, nside=nside, power=power)
+            logging.info('Loaded {} in {}'.format(filename, format_duration(t.dt)))
+            return kind, key, x, map_cache_key(filename, nside, power)
+
+        tasks = list(iterate_config_files(config_doc))
+        with timed(None) as t:
+            pool = ThreadPool(nthreads)
+            try:
+                results = pool.map(load_file, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        logging.info('Loaded {} files in {}'.format(len(tasks), format_duration(t.dt)))
+
+        mask = None
+        ninv_maps = {}
+        bl_list = {}
         mixing_maps = {}
+        map_cache_keys = {'rms': [], 'mixing': []}
+        for kind, key, x, cache_key in results:
+            if kind in map_cache_keys:
+                map_cache_keys[kind].append(cache_key)
+            if kind == 'mask':
+                mask = x
+            elif kind == 'beam':
+                bl_list[key] = x
+            elif kind == 'rms':
+                ninv_maps[key] = x
+            else:
+                mixing_maps[key] = x
+        ninv_maps = [ninv_maps[nu] for nu in range(len(ninv_maps))]
+        bl_list = [bl_list[nu] for nu in range(len(bl_list))]
 
-        mask = config_doc['model'].get('mask', '')
-
-
-        if mask:
-            mask = load_map_cached(mask)
-            mask = mask.copy()
-        else:
-            mask = None
-        
-        
-        nu = 0
-        for dataset in config_doc['datasets']:
-            path = dataset['path']
-
-            for band in dataset['bands']:
-                assert isinstance(band['name'], basestring), 'You need to surround band names with quotes'
-                map_filename = os.path.join(path, dataset['map_template'].format(band=band))
-                rms_filename = os.path.join(path, dataset['rms_template'].format(band=band))
-                beam_filename = os.path.join(path, dataset['beam_template'].format(band=band))
-
-                bl = load_beam_cached(os.path.join(path, dataset['beam_template'].format(band=band)))
-                bl_list.append(bl)
-
-                rms = load_map_cached(rms_filename)
-                rms = rms.copy()
-
-                if udgrade is not None:
-                    rms = healpy.ud_grade(rms, order_in='RING', order_out='RING', nside_out=udgrade, power=1)
-
-                alpha = np.percentile(rms, rms_treshold)
-                rms[rms < alpha] = alpha
-                ninv_map = 1 / rms**2
-
-                ninv_maps.append(ninv_map)
-
-                for k, component in enumerate(config_doc['model']['components']):
-                    mixing_maps[nu, k] = load_map_cached(mixing_maps_template.format(band=band, component=component))
-                    mixing_maps[nu, k] = mixing_maps[nu, k].copy()
-
-                nu += 1
-
+        prior_list = []
         for component in config_doc['model']['components']:
             prior_list.append(HarmonicPrior(component['lmax'], component['prior']))
 
-        return cls(ninv_maps=ninv_maps, bl_list=bl_list, mixing_maps=mixing_maps, prior_list=prior_list, mask=mask)
+        system = cls(ninv_maps=ninv_maps, bl_list=bl_list, mixing_maps=mixing_maps, prior_list=prior_list, mask=mask)
+        system.map_cache_keys = map_cache_keys
+        return system
 
     def plot(self, lmax=None):
         from matplotlib import pyplot as plt
@@ -183,8 +183,11 @@ contains
 
   end subroutine compute_real_Yh_D_Y_block_on_diagonal
 
-  subroutine construct_banded_preconditioner(lmax, ncomp, ntheta, thetas, phase_maps, bl, dl, out) bind(c)
-    integer(i4b), value :: lmax, ncomp, ntheta
+  ! Only the m-blocks m = mmin..lmax are constructed, factored and solved for by
+  ! construct_, factor_ and solve_banded_preconditioner; the columns of the
+  ! m-blocks below mmin are left untouched, and so are those parts of x in solve.
+  subroutine construct_banded_preconditioner(lmax, ncomp, ntheta, thetas, phase_maps, bl, dl, mmin, out) bind(c)
+    integer(i4b), value :: lmax, ncomp, ntheta, mmin
     real(dp), dimension(1:ntheta) :: thetas
     real(dp), dimension(0:lmax) :: bl
     real(dp), dimension(0:lmax, 1:ncomp) :: dl
@@ -213,10 +216,10 @@ contains
     end do
 
     !$OMP parallel default(none) &
-    !$OMP     shared(out,lmax,offsets,dl,bl,thetas,phase_maps,ntheta,ncomp) &
+    !$OMP     shared(out,lmax,mmin,offsets,dl,bl,thetas,phase_maps,ntheta,ncomp) &
     !$OMP     private(m,neg,odd,val,block_col,mblock,j,l,fac,iband)
     !$OMP do schedule(dynamic,1)
-    do m = 0, lmax
+    do m = mmin, lmax
        block_col = offsets(m)
 
        allocate(mblock(0:merge(lmax - m, 2 * (lmax - m) + 1, m == 0), &
@@ -309,8 +312,8 @@ contains
   end subroutine construct_banded_preconditioner
 
 
-  subroutine factor_banded_preconditioner(lmax, ncomp, data, global_info) bind(c)
-    integer(i4b), value :: lmax, ncomp
+  subroutine factor_banded_preconditioner(lmax, ncomp, mmin, data, global_info) bind(c)
+    integer(i4b), value :: lmax, ncomp, mmin
     real(sp), dimension(5 * ncomp, ncomp * (lmax + 1)**2), intent(inout) :: data
     integer(i4b), intent(out) :: global_info
     !--
@@ -327,10 +330,10 @@ contains
     global_info = 0
 
     !$OMP parallel default(none) &
-    !$OMP     shared(data,global_info,lmax,offsets,ncomp) &
+    !$OMP     shared(data,global_info,lmax,mmin,offsets,ncomp) &
     !$OMP     private(m,neg,idx,info,len)
     !$OMP do schedule(dynamic,1)
-    do m = 0, lmax
+    do m = mmin, lmax
        idx = offsets(m)
        do neg = 0, 1
           if (m /= 0 .or. neg == 0) then ! avoid doing the negative case for m=0
@@ -364,8 +367,8 @@ contains
 
   end subroutine factor_banded_preconditioner
 
-  subroutine solve_banded_preconditioner(lmax, ncomp, data, x) bind(c)
-    integer(i4b), value :: lmax, ncomp
+  subroutine solve_banded_preconditioner(lmax, ncomp, mmin, data, x) bind(c)
+    integer(i4b), value :: lmax, ncomp, mmin
     real(sp), dimension(5 * ncomp, 0:ncomp * (lmax + 1)**2-1), intent(in) :: data
     real(sp), dimension((lmax + 1)**2, 0:ncomp - 1), intent(inout) :: x
     !--
@@ -383,12 +386,12 @@ contains
 
     global_info = 0
     !$OMP parallel default(none) &
-    !$OMP     shared(x,data,global_info,lmax,offsets,ncomp) &
+    !$OMP     shared(x,data,global_info,lmax,mmin,offsets,ncomp) &
     !$OMP     private(m,fac,neg,odd_len,even_len,buf,data_idx,x_idx,info)
     allocate(buf(0:ncomp * (lmax / 2 + 1) - 1))
 
     !$OMP do schedule(dynamic,1)
-    do m = 0, lmax
+    do m = mmin, lmax
        x_idx = offsets(m) + 1
        data_idx = offsets(m) * ncomp
        fac = merge(1, 2, m == 0)
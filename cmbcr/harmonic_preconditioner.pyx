@@ -12,9 +12,11 @@ def k_kp_idx(k, kp):
 cdef extern:
      void construct_banded_preconditioner_ "construct_banded_preconditioner"(
           int32_t lmax, int32_t ncomp, int32_t ntheta, double *thetas,
-          double complex *phase_map, double *bl, double *dl, float *out) nogil
-     void factor_banded_preconditioner_ "factor_banded_preconditioner"(int32_t lmax, int32_t ncomp, float *data, int32_t *info) nogil
-     void solve_banded_preconditioner_ "solve_banded_preconditioner"(int32_t lmax, int32_t ncomp, float *data, float *x) nogil
+          double complex *phase_map, double *bl, double *dl, int32_t mmin, float *out) nogil
+     void factor_banded_preconditioner_ "factor_banded_preconditioner"(int32_t lmax, int32_t ncomp, int32_t mmin,
+          float *data, int32_t *info) nogil
+     void solve_banded_preconditioner_ "solve_banded_preconditioner"(int32_t lmax, int32_t ncomp, int32_t mmin,
+          float *data, float *x) nogil
 
      void compute_real_Yh_D_Y_block_on_diagonal_ "compute_real_yh_d_y_block_on_diagonal"(int32_t m, int32_t lmax,
          int32_t ntheta, double *thetas, double complex *phase_map, double *out) nogil
@@ -42,7 +44,8 @@ def construct_banded_preconditioner(
         cnp.ndarray[double complex, ndim=3, mode='fortran'] phase_map,
         cnp.ndarray[double, ndim=1, mode='fortran'] bl,
         cnp.ndarray[double, ndim=2, mode='fortran'] dl,
-        out=None):
+        out=None,
+        int32_t mmin=0):
     cdef cnp.ndarray[float, ndim=2, mode='fortran'] out_
     if out is None:
         out = np.zeros((5 * ncomp, ncomp * (lmax + 1)**2), dtype=np.float32, order='F')
@@ -55,21 +58,27 @@ def construct_banded_preconditioner(
     if dl.shape[1] != ncomp:
         raise ValueError('dl wrong shape')
     with nogil:
-        construct_banded_preconditioner_(lmax, ncomp, thetas.shape[0], &thetas[0], &phase_map[0, 0, 0], &bl[0], &dl[0, 0], &out_[0, 0])
+        construct_banded_preconditioner_(lmax, ncomp, thetas.shape[0], &thetas[0], &phase_map[0, 0, 0], &bl[0], &dl[0, 0], mmin, &out_[0, 0])
     return out
 
 
-def factor_banded_preconditioner(int32_t lmax, int32_t ncomp, cnp.ndarray[float, ndim=2, mode='fortran'] data):
+def factor_banded_preconditioner(int32_t lmax, int32_t ncomp, cnp.ndarray[float, ndim=2, mode='fortran'] data,
+                                 int32_t mmin=0):
     cdef int32_t info
     with nogil:
-        factor_banded_preconditioner_(lmax, ncomp, &data[0, 0], &info)
+        factor_banded_preconditioner_(lmax, ncomp, mmin, &data[0, 0], &info)
     if info != 0:
         raise ValueError('factor_banded_preconditioner: SPBTRF error: %d' % info)
     return data
 
 
-def solve_banded_preconditioner(int32_t lmax, int32_t ncomp, cnp.ndarray[float, ndim=2, mode='fortran'] data, x):
+def solve_banded_preconditioner(int32_t lmax, int32_t ncomp, cnp.ndarray[float, ndim=2, mode='fortran'] data, x,
+                                int32_t mmin=0):
+    """
+    Solves in place with the m-blocks m >= mmin of the factored banded matrix;
+    the parts of `x` with m < mmin are left as they are.
+    """
     cdef cnp.ndarray[float, ndim=2, mode='fortran'] x_ = x
     with nogil:
-        solve_banded_preconditioner_(lmax, ncomp, &data[0, 0], &x_[0,0])
+        solve_banded_preconditioner_(lmax, ncomp, mmin, &data[0, 0], &x_[0,0])
     return x
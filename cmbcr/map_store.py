@@ -0,0 +1,146 @@
+"""
+Store of HEALPix maps and beams as native-endian .npy files that can be memory-mapped,
+so that the FITS decoding, byte-swapping and reordering done in `data_utils` happens
+once rather than on every process start. Since the arrays are mapped read-only, the
+pages are shared between all processes on a node that use the same store.
+
+The store is a directory with one entry (sub-directory) per source file:
+
+    meta.yaml            source filename, size and mtime, and the shape/nside of the data
+    data.npy             the data at full resolution, as `load_map` / `load_beam` return it
+    nside{N}_p{P}.npy    optional `healpy.ud_grade` of the map to nside N with power P
+
+Use `build_store_from_config` (or scripts/build_map_store.py) to populate a store.
+"""
+from __future__ import division
+import os
+import hashlib
+import logging
+import yaml
+import numpy as np
+import healpy
+
+from .data_utils import load_map, load_beam
+from .utils import makedirs
+
+__all__ = ['MapStore', 'DEFAULT_STORE_PATH', 'build_store_from_config']
+
+DEFAULT_STORE_PATH = os.path.join('cache', 'maps')
+
+
+def _save_atomic(filename, arr):
+    # write to a temporary file and rename, so that concurrent readers never see partial files
+    tmp_filename = '{}.tmp{}.npy'.format(filename[:-len('.npy')], os.getpid())
+    np.save(tmp_filename, np.ascontiguousarray(arr))
+    os.rename(tmp_filename, filename)
+
+
+def _source_info(filename):
+    st = os.stat(filename)
+    return dict(size=int(st.st_size), mtime=float(st.st_mtime))
+
+
+class MapStore(object):
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+
+    def entry_path(self, filename):
+        filename = os.path.abspath(filename)
+        h = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:10]
+        return os.path.join(self.path, '{}-{}'.format(os.path.basename(filename), h))
+
+    def read_meta(self, filename):
+        meta_filename = os.path.join(self.entry_path(filename), 'meta.yaml')
+        if not os.path.exists(meta_filename):
+            return None
+        with open(meta_filename) as f:
+            return yaml.safe_load(f)
+
+    def is_current(self, filename):
+        """
+        Whether `filename` has an entry in the store that is at least as new as the
+        source file. If the source file is not present the entry is trusted.
+        """
+        meta = self.read_meta(filename)
+        if meta is None:
+            return False
+        if not os.path.exists(filename):
+            return True
+        info = _source_info(filename)
+        return info['size'] == meta['source_size'] and info['mtime'] <= meta['source_mtime']
+
+    def add_map(self, filename, map_type='raw', udgrades=()):
+        """
+        Convert a FITS map to the store. `udgrades` is a list of (nside, power) pairs
+        for which to also store a precomputed `healpy.ud_grade`.
+        """
+        data = load_map(map_type, filename)
+        self._write_entry(filename, data, kind='map', nside=int(np.sqrt(data.shape[0] // 12)))
+        for nside, power in udgrades:
+            self.add_udgrade(filename, nside, power, data=data)
+
+    def add_beam(self, filename):
+        self._write_entry(filename, load_beam(filename), kind='beam')
+
+    def add_udgrade(self, filename, nside, power=0, data=None):
+        if data is None:
+            data = self.load(filename)
+        udgraded = healpy.ud_grade(data, order_in='RING', order_out='RING', nside_out=nside, power=power)
+        _save_atomic(self._udgrade_filename(filename, nside, power), udgraded)
+
+    def load(self, filename, nside=None, power=0, mmap=True):
+        """
+        Returns the data stored for `filename`, memory-mapped read-only if `mmap`, or
+        None if the store has no current entry for it. If `nside` is given the map is
+        returned ud_graded to that resolution, using the precomputed version if present.
+        """
+        if not self.is_current(filename):
+            return None
+        mmap_mode = 'r' if mmap else None
+        entry = self.entry_path(filename)
+        if nside is not None:
+            udgrade_filename = self._udgrade_filename(filename, nside, power)
+            if os.path.exists(udgrade_filename):
+                return np.load(udgrade_filename, mmap_mode=mmap_mode)
+        data = np.load(os.path.join(entry, 'data.npy'), mmap_mode=mmap_mode)
+        if nside is not None:
+            data = healpy.ud_grade(data, order_in='RING', order_out='RING', nside_out=nside, power=power)
+        return data
+
+    def _udgrade_filename(self, filename, nside, power):
+        return os.path.join(self.entry_path(filename), 'nside{:05d}_p{}.npy'.format(nside, power))
+
+    def _write_entry(self, filename, data, **meta):
+        entry = self.entry_path(filename)
+        makedirs(entry)
+        _save_atomic(os.path.join(entry, 'data.npy'), data)
+        info = _source_info(filename)
+        meta.update(
+            source=os.path.abspath(filename),
+            source_size=info['size'],
+            source_mtime=info['mtime'],
+            shape=list(data.shape),
+            dtype=str(data.dtype))
+        # meta.yaml is written last; an entry without it is never used
+        meta_filename = os.path.join(entry, 'meta.yaml')
+        with open(meta_filename + '.tmp', 'w') as f:
+            yaml.safe_dump(meta, f, default_flow_style=False)
+        os.rename(meta_filename + '.tmp', meta_filename)
+        logging.info('Stored {} in {}'.format(filename, entry))
+
+
+def build_store_from_config(config_doc, store=None, nsides=()):
+    """
+    Convert all maps and beams referenced by a config document to the map store, with
+    ud_grades precomputed for each of `nsides` (as used by `CrSystem.from_config`).
+    """
+    from .cr_system import iterate_config_files
+
+    if store is None:
+        store = MapStore(config_doc['model'].get('map_store', DEFAULT_STORE_PATH))
+    for kind, key, filename, power in iterate_config_files(config_doc):
+        if kind == 'beam':
+            store.add_beam(filename)
+        else:
+            store.add_map(filename, udgrades=[(nside, power) for nside in nsides])
+    return store
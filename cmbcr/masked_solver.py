@@ -1,15 +1,22 @@
 from __future__ import division
+import logging
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from scipy.sparse import dok_matrix
 import scipy
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.csgraph
 import healpy
 
-from .beams import standard_needlet_by_l, fourth_order_beam, gaussian_beam_by_l
+from .beams import standard_needlet_by_l, fourth_order_beam, gaussian_beam_by_l, beam_by_cos_theta
 from . import sharp
-from .cg import cg_generator
-from .utils import scatter_l_to_lm, hammer, pad_or_truncate_alm
+from .utils import scatter_l_to_lm, hammer, pad_or_truncate_alm, pad_or_trunc, ridged_cho_factor
 from .cache import memory
 from .healpix import nside_of
+from .healpix_data import get_ring_weights_T
+from .multigrid import (DEFAULT_NAPPLY, MAX_DENSE_N, check_cycle, coarse_cycles, choose_coarsening_depth,
+                        smoother_matvecs, estimate_max_eigenvalue, chebyshev_smooth, solve_mask_cg)
 
 
 def coarsen(level, next_level, u):
@@ -47,104 +54,304 @@ def v_cycle(ilevel, levels, smoothers, b):
         return x
 
 
-def v_cycle_combined_shts(ilevel, levels, smoothers, b):
-    # like the above, but inline coarsen/interpolate in order to remove redundant SHTs
+class CycleLevel(object):
+    """
+    One level of the multigrid cycle for a batch of spectra on the same mask hierarchy;
+    `levels[k]` and `smoothers[k]` are the Level and smoother of spectrum k on this
+    level. Owns the SHT plans, expanded filters and work buffers, so that `cycle`
+    only spends time in transforms (and the smoothers).
+
+    The inputs and outputs of `cycle` have one row per spectrum; the SHTs of all
+    spectra are done in the same libsharp calls. Coarsening and interpolation are
+    inlined with the first pre- and post-smoothing steps in order to remove redundant
+    SHTs; further smoothing steps cost a full matvec each.
+    """
+
+    def __init__(self, levels, smoothers, coarser=None, pre_smooth=1, post_smooth=1):
+        level = levels[0]
+        self.geometry = geometry = level.geometry
+        self.smoothers = smoothers
+        self.coarser = coarser
+        self.pre_smooth = pre_smooth
+        self.post_smooth = post_smooth
+        self.nbatch = nbatch = len(levels)
+        self.lmax = level.lmax
+        self.n = geometry.n
+        self.pick_indices = np.nonzero(geometry.pick)[0]
+
+        self.x = np.zeros((nbatch, self.n))
+        self.M_b = np.zeros((nbatch, self.n))
+        self.pix_buf = np.zeros((nbatch, self.n))
+        self.smooth_buf = np.zeros((nbatch, self.n))
+        # pad_buf is zero outside of pick_indices at all times; map_buf is scratch space
+        self.pad_buf = np.zeros((nbatch, geometry.npix))
+        self.map_buf = np.zeros((nbatch, geometry.npix))
+
+        self.plan = geometry.plan(self.lmax)
+        self.dl_lm = np.array([lev.dl_lm for lev in levels])
+        self.alm_buf = np.zeros((nbatch, (self.lmax + 1)**2))
+
+        if all(isinstance(smoother, ChebyshevSmoother) for smoother in smoothers):
+            self.chebyshev = True
+            self.inv_diag = np.array([[smoother.inv_diag] for smoother in smoothers])
+            self.eig_min = np.array([[smoother.eig_min] for smoother in smoothers])
+            self.eig_max = np.array([[smoother.eig_max] for smoother in smoothers])
+            self.degree = smoothers[0].degree
+            self.cheb_bufs = [np.zeros((nbatch, self.n)) for i in range(3)]
+        else:
+            self.chebyshev = False
+
+        if coarser is not None:
+            lmax_restrict = self.lmax // 2
+            self.restrict_plan = geometry.plan(lmax_restrict)
+            self.coarse_plan = coarser.geometry.plan(lmax_restrict)
+
+            self.restrict_lm = level.restrict_lm
+            s = np.zeros(self.lmax + 1)
+            s[:lmax_restrict + 1] = 1
+            self.restrict_indices = np.nonzero(scatter_l_to_lm(s))[0]
+
+            self.alm_u = np.zeros((nbatch, (self.lmax + 1)**2))
+            # alm_pad is zero outside of restrict_indices at all times
+            self.alm_pad = np.zeros((nbatch, (self.lmax + 1)**2))
+            self.alm_lo = np.zeros((nbatch, (lmax_restrict + 1)**2))
+            self.alm_lo_buf = np.zeros((nbatch, (lmax_restrict + 1)**2))
+            self.r_H = np.zeros((nbatch, coarser.n))
+            self.c_H = np.zeros((nbatch, coarser.n))
 
-    M_b = smoothers[ilevel].apply(b)
-    
-    if ilevel == len(levels) - 1:
-        return M_b
-    else:
-        level = levels[ilevel]
-        next_level = levels[ilevel + 1]
-        lmax_restrict = level.lmax // 2
-
-
-        def Yt_h(v):
-            return sharp.sh_adjoint_synthesis(level.lmax, level.padvec(v))
-
-        def Ytw_h(v):
-            # use lmax_restrict as the output is passed to R
-            return sharp.sh_analysis(lmax_restrict, level.padvec(v))
-        
-        def WY_h(v):
-            return level.pickvec(sharp.sh_adjoint_analysis(level.nside, v))
-
-        def Ytw_H(v):
-            return sharp.sh_analysis(level.lmax, next_level.padvec(v))
-        
-        def Yt_H(v):
-            return sharp.sh_adjoint_synthesis(lmax_restrict, next_level.padvec(v))
-        
-        def Y_H(v):
-            return next_level.pickvec(sharp.sh_synthesis(next_level.nside, v))
-        
-        def Y_h(v):
-            return level.pickvec(sharp.sh_synthesis(level.nside, v))
-
-        def R(v):
-            v = pad_or_truncate_alm(v, lmax_restrict)
-            return scatter_l_to_lm(level.restrict_l[:lmax_restrict + 1]) * v
-
-        def Rt(v):
-            v = scatter_l_to_lm(level.restrict_l[:lmax_restrict + 1]) * v
-            return pad_or_truncate_alm(v, level.lmax)
-        
-        def D(v):
-            return scatter_l_to_lm(level.dl) * v
+    def padvec(self, u):
+        self.pad_buf[:, self.pick_indices] = u
+        return self.pad_buf
+
+    def pickvec(self, u, out):
+        return np.take(u, self.pick_indices, axis=1, out=out)
+
+    def matvec(self, u, out):
+        self.plan.adjoint_synthesis_multi(self.padvec(u), out=self.alm_buf)
+        self.alm_buf *= self.dl_lm
+        self.plan.synthesis_multi(self.alm_buf, out=self.map_buf)
+        return self.pickvec(self.map_buf, out=out)
+
+    def residual(self, b, x, out):
+        self.matvec(x, out)
+        return np.subtract(b, out, out=out)
+
+    def smooth(self, b, out):
+        if self.chebyshev:
+            res, d, Ad = self.cheb_bufs
+            return chebyshev_smooth(self.matvec, self.inv_diag, self.eig_min, self.eig_max, self.degree,
+                                    b, out, res, d, Ad)
+        for k in range(self.nbatch):
+            self.smoothers[k].apply(b[k], out=out[k])
+        return out
+
+    def cycle(self, b, cycle_type='V'):
+        """
+        Runs a cycle of type `cycle_type` ('V', 'W' or 'F') from this level down.
+        Returns the result in a buffer that is overwritten by the next call.
+        """
+        if self.coarser is None:
+            return self.smooth(b, self.x)
+
+        x, M_b, alm_u, alm_buf, alm_lo, alm_lo_buf = (
+            self.x, self.M_b, self.alm_u, self.alm_buf, self.alm_lo, self.alm_lo_buf)
+
+        # pre-smoothing
+        self.smooth(b, M_b)
+        if self.pre_smooth > 0:
+            x[...] = M_b
+        else:
+            x[...] = 0
+        for i in range(self.pre_smooth - 1):
+            x += self.smooth(self.residual(b, x, self.pix_buf), self.smooth_buf)
+
+        # u = Y_h^T x
+        self.plan.adjoint_synthesis_multi(self.padvec(x), out=alm_u)
+
+        # r_H = Y_H R (Y_h^T W_h b - D u), truncated to the coarse lmax
+        self.restrict_plan.analysis_multi(self.padvec(b), out=alm_lo)
+        np.multiply(self.dl_lm, alm_u, out=alm_buf)
+        np.take(alm_buf, self.restrict_indices, axis=1, out=alm_lo_buf)
+        alm_lo -= alm_lo_buf
+        alm_lo *= self.restrict_lm
+        self.coarse_plan.synthesis_multi(alm_lo, out=self.coarser.map_buf)
+        self.coarser.pickvec(self.coarser.map_buf, out=self.r_H)
+
+        # coarse-grid correction c_H
+        c_H = self.c_H
+        coarse_types = coarse_cycles(cycle_type, self.coarser.coarser is None)
+        c_H[...] = self.coarser.cycle(self.r_H, coarse_types[0])
+        if len(coarse_types) == 2:
+            self.r_H -= self.coarser.matvec(c_H, self.coarser.pix_buf)
+            c_H += self.coarser.cycle(self.r_H, coarse_types[1])
+
+        # v = R Y_H^T c_H
+        self.coarse_plan.adjoint_synthesis_multi(self.coarser.padvec(c_H), out=alm_lo)
+        alm_lo *= self.restrict_lm
+
+        # x += W_h Y_h v
+        self.restrict_plan.adjoint_analysis_multi(alm_lo, out=self.map_buf)
+        x += self.pickvec(self.map_buf, out=self.pix_buf)
+
+        # post-smoothing; the first step is x += M b - M Y_h D (u + v)
+        if self.post_smooth > 0:
+            x += M_b
+            self.alm_pad[:, self.restrict_indices] = alm_lo
+            alm_u += self.alm_pad
+            alm_u *= self.dl_lm
+            self.plan.synthesis_multi(alm_u, out=self.map_buf)
+            x -= self.smooth(self.pickvec(self.map_buf, out=self.pix_buf), self.smooth_buf)
+        for i in range(self.post_smooth - 1):
+            x += self.smooth(self.residual(b, x, self.pix_buf), self.smooth_buf)
 
-        def M(v):
-            return smoothers[ilevel].apply(v)
+        return x
 
-        def approx_I(v):
-            return v
-            #return Ytw_h(Y_h(v))
-        
-        x = M_b.copy()
 
-        u = Yt_h(x)
+def make_cycle_levels(levels_lst, smoothers_lst, pre_smooth=1, post_smooth=1):
+    """
+    Returns the finest CycleLevel for the batch of spectra with Level lists `levels_lst`
+    and smoother lists `smoothers_lst`, which must share their mask hierarchy.
+    """
+    cycle_level = None
+    for ilevel in range(len(levels_lst[0]) - 1, -1, -1):
+        cycle_level = CycleLevel(
+            [levels[ilevel] for levels in levels_lst],
+            [smoothers[ilevel] for smoothers in smoothers_lst],
+            coarser=cycle_level, pre_smooth=pre_smooth, post_smooth=post_smooth)
+    return cycle_level
+
+
+def shts_per_visit(pre_smooth=1, post_smooth=1, smoother='diagonal', degree=2):
+    """
+    Number of SHTs (on this or the next coarser level) spent in one visit to a
+    non-coarsest level by CycleLevel.cycle.
+    """
+    nsmooth = max(pre_smooth, 1) + post_smooth
+    nmatvec = max(pre_smooth - 1, 0) + max(post_smooth - 1, 0)
+    nmatvec += nsmooth * smoother_matvecs(smoother, degree)
+    return 6 + 2 * nmatvec
+
+
+class MaskLevel(object):
+    """
+    Geometry of one level of the multigrid hierarchy: the mask, which pixels are
+    solved for, and SHT plans. It does not depend on the spectrum, and so can be
+    shared between solvers for several spectra on the same mask.
+    """
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.nside = nside_of(mask)
+        self.npix = 12 * self.nside**2
+        self.pick = (mask == 0)
+        self.n = int(self.pick.sum())
+        self.coarser = None
+        self._plans = {}
 
-        r_H = Y_H( R( Ytw_h(b) - pad_or_truncate_alm( D( u ) , lmax_restrict) ) )
+    def plan(self, lmax):
+        plan = self._plans.get(lmax)
+        if plan is None:
+            weights = get_ring_weights_T(self.nside)
+            plan = self._plans[lmax] = sharp.RealMmajorHealpixPlan(self.nside, lmax, weights=weights)
+        return plan
 
-        c_H = v_cycle_combined_shts(ilevel + 1, levels, smoothers, r_H)
+    def pickvec(self, u):
+        return u[..., self.pick]
 
-        assert c_H.shape[0] == next_level.n
-        
-        v_lo = Rt ( Yt_H ( c_H ) )
-        v = pad_or_truncate_alm(v_lo, level.lmax)
-        x += M_b + WY_h ( v_lo ) - M( Y_h( D( u + approx_I(v) ) ))
-        
-        return x
+    def padvec(self, u):
+        u_pad = np.zeros(u.shape[:-1] + (self.npix,))
+        u_pad[..., self.pick] = u
+        return u_pad
 
+    def coarsen(self):
+        mask_H = healpy.ud_grade(self.mask, order_in='RING', order_out='RING', nside_out=self.nside // 2, power=0)
+        mask_H[mask_H != 0] = 1
+        self.coarser = MaskLevel(mask_H)
+        return self.coarser
+
+
+def hierarchy_from_masks(masks):
+    """
+    Rebuilds a list of MaskLevel from the masks of its levels, fine to coarse.
+    """
+    hierarchy = [MaskLevel(mask) for mask in masks]
+    for fine, coarse in zip(hierarchy[:-1], hierarchy[1:]):
+        fine.coarser = coarse
+    return hierarchy
+
+
+def make_mask_hierarchy(mask, lmax, cycle='V', shts_per_visit=6, napply=DEFAULT_NAPPLY,
+                        max_dense_n=MAX_DENSE_N, min_coarse_n=50):
+    """
+    Returns the list of MaskLevel from fine to coarse to use for solving with a spectrum
+    of the given `lmax` (halved on every level). Candidate levels are made by coarsening
+    `mask` until there are at most `min_coarse_n` pixels to solve for; the depth is then
+    picked by `multigrid.choose_coarsening_depth`, weighing the SHTs spent on each level
+    against assembling, factoring and applying the dense coarsest level.
+    """
+    hierarchy = [MaskLevel(mask)]
+    while hierarchy[-1].n > min_coarse_n and hierarchy[-1].nside > 1:
+        hierarchy.append(hierarchy[-1].coarsen())
+
+    visit_costs, dense_ns, dense_setup_costs = [], [], []
+    for ilevel, geometry in enumerate(hierarchy):
+        lmax_level = lmax // 2**ilevel
+        # Legendre transforms dominate: (lmax + 1)**2 coefficients on 4 * nside rings
+        visit_costs.append(shts_per_visit * 4 * geometry.nside * (lmax_level + 1)**2)
+        dense_ns.append(geometry.n)
+        dense_setup_costs.append(geometry.n**3 / 3 + 3 * geometry.n**2 * (lmax_level + 1))
+    nlevels = choose_coarsening_depth(visit_costs, dense_ns, dense_setup_costs, cycle=cycle,
+                                      napply=napply, max_dense_n=max_dense_n)
+    return hierarchy[:nlevels]
 
 
 class SinvSolver(object):
-
-    def __init__(self, dl, mask):
+    """
+    Multigrid solver for S^{-1} restricted to the pixels where `mask` is 0.
+
+    `cycle` is 'V', 'W' or 'F', and `pre_smooth`/`post_smooth` the number of smoothing
+    steps on each level. `smoother` is either 'diagonal' (damped Jacobi with the given
+    `damping`) or 'chebyshev' (a Chebyshev polynomial of the given `degree`, with the
+    spectral bounds estimated by power iteration). The number of levels is chosen by a
+    cost model assuming the setup is amortized over `napply` preconditioner applications;
+    pass `hierarchy` to use an existing list of MaskLevel instead, and `dense_cho`
+    to use an existing factor of the coarsest level.
+    """
+
+    def __init__(self, dl, mask, hierarchy=None, cycle='V', pre_smooth=1, post_smooth=1,
+                 smoother='diagonal', damping=0.2, degree=2, napply=DEFAULT_NAPPLY, dense_cho=None):
+        check_cycle(cycle)
         self.dl = dl
         self.lmax = self.dl.shape[0] - 1
         self.mask = mask
         self.nside = nside_of(mask)
+        self.cycle = cycle
 
-        root_level = Level(dl, mask)
-        self.levels = [root_level]
-
-        cur_level = root_level
-        while cur_level.n > 1000:
-            cur_level = coarsen_level(cur_level)
-            self.levels.append(cur_level)
+        if hierarchy is None:
+            hierarchy = make_mask_hierarchy(
+                mask, self.lmax, cycle=cycle, napply=napply,
+                shts_per_visit=shts_per_visit(pre_smooth, post_smooth, smoother, degree))
+        self.hierarchy = hierarchy
 
+        root_level = Level(dl, hierarchy[0])
+        self.levels = [root_level]
+        for geometry in hierarchy[1:]:
+            self.levels.append(coarsen_level(self.levels[-1]))
+            assert self.levels[-1].geometry is geometry
 
-        self.smoothers = [DiagonalSmoother(level) for level in self.levels[:-1]]
-        self.smoothers.append(DenseSmoother(self.levels[-1]))
+        self.smoothers = [make_smoother(level, smoother, damping=damping, degree=degree)
+                          for level in self.levels[:-1]]
+        self.smoothers.append(DenseSmoother(self.levels[-1], cho=dense_cho))
 
-        self.n = int((self.mask == 0).sum())
+        self.n = hierarchy[0].n
+        self.plan = hierarchy[0].plan(self.lmax)
+        self.cycle_root = make_cycle_levels([self.levels], [self.smoothers], pre_smooth, post_smooth)
 
     def restrict(self, u):
-        return self.pickvec(sharp.sh_synthesis(self.nside, u))
+        return self.pickvec(self.plan.synthesis(u))
 
     def prolong(self, u):
-        return sharp.sh_adjoint_synthesis(self.lmax, self.padvec(u))
+        return self.plan.adjoint_synthesis(self.padvec(u))
             
     def pickvec(self, u):
         return self.levels[0].pickvec(u)
@@ -154,62 +361,37 @@ class SinvSolver(object):
 
     def precond(self, b):
         #return v_cycle(0, self.levels, self.smoothers, b)
-        return v_cycle_combined_shts(0, self.levels, self.smoothers, b)
+        return self.cycle_root.cycle(b[None, :], self.cycle)[0, :].copy()
 
     def solve_mask(self, b, x0=None, rtol=1e-6, maxit=50):
         """
-        Returns (x, reslst, errlst)
-
-        If x0 is supplied, compute the errors and return errlst; otherwise errlst is empt
+        Returns (x, reslst, errlst); see `multigrid.solve_mask_cg`.
         """
-        solver = cg_generator(
-            self.levels[0].matvec,
-            b=b,
-            M=self.precond,
-            x0=np.zeros_like(b)
-            )
-
-        reslst = []
-        errlst = []
-        if x0 is not None:
-            x0_norm = np.linalg.norm(x0)
-        b_norm = np.linalg.norm(b)
-
-        for i, (x, r, delta_new) in enumerate(solver):
-            r = np.linalg.norm(r) / b_norm
-            reslst.append(r)
-            if x0 is not None:
-                e = np.linalg.norm(x0 - x) / x0_norm
-                errlst.append(e)
-                print 'iteration {}, res={}, err={}'.format(i, r, e)
-            else:
-                pass
-                print 'iteration {}, res={}'.format(i, r)
-            if r < rtol or i > maxit:
-                print 'breaking', r, repr(rtol), i, maxit
-                break
-
-        return x, reslst, errlst
+        return solve_mask_cg(self.levels[0].matvec, self.precond, b, x0=x0, rtol=rtol, maxit=maxit, verbose=True)
 
 
     
 
 class Level(object):
 
-    def __init__(self, dl, mask):
-        self.mask = mask
+    def __init__(self, dl, geometry):
+        self.geometry = geometry
+        self.mask = geometry.mask
         self.lmax = dl.shape[0] - 1
-        self.nside = nside_of(mask)
-        self.npix = 12 * self.nside**2
+        self.nside = geometry.nside
+        self.npix = geometry.npix
         self.dl = dl
 
-        self.pick = (mask == 0)
-        self.n = int(self.pick.sum())
+        self.pick = geometry.pick
+        self.n = geometry.n
 
         pw = 2
         self.restrict_l = gaussian_beam_by_l(self.lmax, 2 * np.pi / (4 * self.nside) * pw)
         ##self.restrict_l = fourth_order_beam(self.lmax, self.lmax // 2, 0.05)
 
+        self.dl_lm = scatter_l_to_lm(self.dl)
+        self.restrict_lm = scatter_l_to_lm(self.restrict_l[:self.lmax // 2 + 1])
+
         
     def compute_diagonal(self):
         u = np.zeros(self.npix)
@@ -218,21 +400,24 @@ class Level(object):
         return u[self.npix // 2]
 
     def pickvec(self, u):
-        return u[self.pick]
+        return self.geometry.pickvec(u)
 
     def padvec(self, u):
-        u_pad = np.zeros(self.npix)
-        u_pad[self.pick] = u
-        return u_pad
+        return self.geometry.padvec(u)
 
     def matvec_padded(self, u):
-        u = sharp.sh_adjoint_synthesis(self.lmax, u)
-        u *= scatter_l_to_lm(self.dl)
-        u = sharp.sh_synthesis(self.nside, u)
+        plan = self.geometry.plan(self.lmax)
+        u = plan.adjoint_synthesis(u)
+        u *= self.dl_lm
+        u = plan.synthesis(u)
         return u
 
-    def matvec(self, u):
-        return self.pickvec(self.matvec_padded(self.padvec(u)))
+    def matvec(self, u, out=None):
+        u = self.pickvec(self.matvec_padded(self.padvec(u)))
+        if out is not None:
+            out[...] = u
+            u = out
+        return u
 
     def matvec_coarsened(self, u):
         # do matvec on the next, coarser level. This is just done once, to create the operator on the next level
@@ -240,37 +425,96 @@ class Level(object):
 
     def coarsen_padded(self, u):
         lmax_restrict = self.lmax // 2
-        alm = sharp.sh_analysis(lmax_restrict, u)
-        alm *= scatter_l_to_lm(self.restrict_l[:lmax_restrict + 1])
-        u = sharp.sh_synthesis(self.nside // 2, alm)
+        alm = self.geometry.plan(lmax_restrict).analysis(u)
+        alm *= self.restrict_lm
+        u = self.geometry.coarser.plan(lmax_restrict).synthesis(alm)
         return u
 
     def interpolate_padded(self, u):
         lmax_restrict = self.lmax // 2
-        alm = sharp.sh_adjoint_synthesis(lmax_restrict, u)
-        alm *= scatter_l_to_lm(self.restrict_l[:lmax_restrict + 1])
-        u = sharp.sh_adjoint_analysis(self.nside, alm)
+        alm = self.geometry.coarser.plan(lmax_restrict).adjoint_synthesis(u)
+        alm *= self.restrict_lm
+        u = self.geometry.plan(lmax_restrict).adjoint_analysis(alm)
         return u
 
 
 class DiagonalSmoother(object):
-    def __init__(self, level):
+    def __init__(self, level, damping=0.2):
         self.level = level
+        self.damping = damping
 
         self.diag = level.compute_diagonal()
         self.inv_diag = 1 / self.diag
 
-    def apply(self, u):
-        return 0.2 * self.inv_diag * u
+    def apply(self, u, out=None):
+        return np.multiply(self.damping * self.inv_diag, u, out=out)
 
 
-class DenseSmoother(object):
-    def __init__(self, level):
-        self.matrix = hammer(level.matvec, level.n)
-        self.inv_matrix = np.linalg.pinv(self.matrix)
+class ChebyshevSmoother(object):
+    """
+    Chebyshev polynomial in D^{-1} A, D being the (constant) diagonal of the level
+    operator A, damping the eigenvalues in [eig_max / eig_ratio, eig_max]. eig_max
+    is estimated with `power_its` power iterations, plus a 10% margin.
+    """
+    def __init__(self, level, degree=2, eig_ratio=30., power_its=10):
+        self.level = level
+        self.degree = degree
+
+        self.diag = level.compute_diagonal()
+        self.inv_diag = 1 / self.diag
+        self.eig_max = 1.1 * estimate_max_eigenvalue(level.matvec, self.inv_diag, level.n, nits=power_its, seed=0)
+        self.eig_min = self.eig_max / eig_ratio
+        self.bufs = None
+
+    def apply(self, u, out=None):
+        if self.bufs is None:
+            self.bufs = [np.zeros(self.level.n) for i in range(3)]
+        if out is None:
+            out = np.zeros(self.level.n)
+        res, d, Ad = self.bufs
+        return chebyshev_smooth(self.level.matvec, self.inv_diag, self.eig_min, self.eig_max, self.degree,
+                                u, out, res, d, Ad)
+
+
+def make_smoother(level, smoother, damping=0.2, degree=2):
+    if smoother == 'diagonal':
+        return DiagonalSmoother(level, damping=damping)
+    elif smoother == 'chebyshev':
+        return ChebyshevSmoother(level, degree=degree)
+    else:
+        raise ValueError('Unknown smoother: {}'.format(smoother))
+
+
+def dense_operator_matrix(dl, nside, pixels):
+    """
+    Assembles Y D Y^T, restricted to the given pixel indices of a HEALPix map, directly
+    from the Legendre series of `dl` evaluated on the angles between the pixel pairs.
+    """
+    vecs = np.array(healpy.pix2vec(nside, pixels))
+    cos_thetas = np.clip(np.dot(vecs.T, vecs), -1, 1)
+    return beam_by_cos_theta(dl, cos_thetas.ravel()).reshape(cos_thetas.shape)
+
 
-    def apply(self, u):
-        return np.dot(self.inv_matrix, u)
+@memory.cache
+def dense_operator_cho_factor(dl, mask):
+    matrix = dense_operator_matrix(dl, nside_of(mask), np.nonzero(mask == 0)[0])
+    cho, ridge = ridged_cho_factor(matrix)
+    if ridge != 0:
+        logging.info('Coarsest level of masked solver needed ridge {}'.format(ridge))
+    return cho
+
+
+class DenseSmoother(object):
+    def __init__(self, level, cho=None):
+        # `cho` is a factor from dense_operator_cho_factor saved earlier
+        self.cho = dense_operator_cho_factor(level.dl, level.mask) if cho is None else cho
+
+    def apply(self, u, out=None):
+        x = scipy.linalg.cho_solve(self.cho, u)
+        if out is not None:
+            out[...] = x
+            x = out
+        return x
     
 
 def operator_image_to_power_spectrum(lmax, unitvec, opimage):
@@ -295,6 +539,210 @@ def coarsen_level(level):
     else:
         dl_H = (level.restrict_l**2 * level.dl)[:level.lmax // 2 + 1]
     
-    mask_H = healpy.ud_grade(level.mask, order_in='RING', order_out='RING', nside_out=nside_H, power=0)
-    mask_H[mask_H != 0] = 1
-    return Level(dl_H, mask_H)
+    geometry_H = level.geometry.coarser
+    if geometry_H is None:
+        geometry_H = level.geometry.coarsen()
+    return Level(dl_H, geometry_H)
+
+
+class MultiSinvSolver(object):
+    """
+    SinvSolvers for several spectra on the same mask. The mask hierarchy and SHT plans
+    are built once and shared, and `precond` runs the multigrid cycles of all spectra together.
+    The spectra are zero-padded to a common lmax. `hierarchy` and `dense_chos` (one
+    per spectrum) can be passed to reuse the levels and coarse factors of an earlier
+    solver, as returned by `hierarchy_masks` and `dense_factors`.
+    """
+
+    def __init__(self, dl_list, mask, cycle='V', pre_smooth=1, post_smooth=1,
+                 smoother='diagonal', damping=0.2, degree=2, napply=DEFAULT_NAPPLY,
+                 hierarchy=None, dense_chos=None):
+        check_cycle(cycle)
+        self.lmax = max(dl.shape[0] - 1 for dl in dl_list)
+        self.cycle = cycle
+        if hierarchy is None:
+            hierarchy = make_mask_hierarchy(
+                mask, self.lmax, cycle=cycle, napply=napply,
+                shts_per_visit=shts_per_visit(pre_smooth, post_smooth, smoother, degree))
+        self.hierarchy = hierarchy
+        if dense_chos is None:
+            dense_chos = [None] * len(dl_list)
+        self.solvers = [
+            SinvSolver(pad_or_trunc(dl, self.lmax + 1), mask, hierarchy=self.hierarchy, cycle=cycle,
+                       pre_smooth=pre_smooth, post_smooth=post_smooth, smoother=smoother,
+                       damping=damping, degree=degree, dense_cho=dense_cho)
+            for dl, dense_cho in zip(dl_list, dense_chos)]
+        self.plan = self.hierarchy[0].plan(self.lmax)
+        self.n = self.hierarchy[0].n
+        self.cycle_root = make_cycle_levels(
+            [solver.levels for solver in self.solvers], [solver.smoothers for solver in self.solvers],
+            pre_smooth, post_smooth)
+
+    def restrict(self, u_lst):
+        alms = np.array([pad_or_truncate_alm(u, self.lmax) for u in u_lst])
+        return self.hierarchy[0].pickvec(self.plan.synthesis_multi(alms))
+
+    def prolong(self, u):
+        return self.plan.adjoint_synthesis_multi(self.hierarchy[0].padvec(u))
+
+    def precond(self, b):
+        return self.cycle_root.cycle(np.ascontiguousarray(b, dtype=np.double), self.cycle).copy()
+
+    def hierarchy_masks(self):
+        return [geometry.mask for geometry in self.hierarchy]
+
+    def dense_factors(self):
+        return [solver.smoothers[-1].cho for solver in self.solvers]
+
+
+def label_mask_holes(mask):
+    """
+    Labels the connected components of the pixels where `mask` is 0, using the 8
+    HEALPix neighbours of each pixel. Returns (ncomponents, labels), where `labels`
+    gives the component of each pixel in `mask == 0` (in pixel order).
+    """
+    nside = nside_of(mask)
+    pixels = np.nonzero(mask == 0)[0]
+    n = pixels.shape[0]
+    pick_pos = -np.ones(mask.shape[0], dtype=np.int64)
+    pick_pos[pixels] = np.arange(n)
+
+    neighbours = healpy.get_all_neighbours(nside, pixels)
+    rows = np.repeat(np.arange(n)[None, :], neighbours.shape[0], axis=0).ravel()
+    cols = np.where(neighbours >= 0, pick_pos[neighbours], -1).ravel()
+    keep = cols >= 0
+    graph = scipy.sparse.csr_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])), shape=(n, n))
+    return scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+
+def split_mask_holes(mask, max_dense_n):
+    """
+    Returns (hole_indices, large_indices): for each hole of `mask` with at most
+    `max_dense_n` pixels, the indices of its pixels among the pixels where `mask` is
+    0, and the same for each of the larger holes.
+    """
+    ncomponents, labels = label_mask_holes(mask)
+    order = np.argsort(labels, kind='mergesort')
+    bounds = np.searchsorted(labels[order], np.arange(ncomponents + 1))
+
+    hole_indices = []
+    large_indices = []
+    for i in range(ncomponents):
+        indices = order[bounds[i]:bounds[i + 1]]
+        if indices.shape[0] <= max_dense_n:
+            hole_indices.append(indices)
+        else:
+            large_indices.append(indices)
+    return hole_indices, large_indices
+
+
+@memory.cache
+def hole_cho_factors(dl, nside, mask, max_dense_n):
+    """
+    The Cholesky factors of the operator restricted to each of the holes of `mask`
+    with at most `max_dense_n` pixels, in the order of `split_mask_holes`. Cached
+    as one entry per mask, as a point source mask can have thousands of holes.
+    """
+    pixels = np.nonzero(mask == 0)[0]
+    hole_indices, large_indices = split_mask_holes(mask, max_dense_n)
+    chos = []
+    for indices in hole_indices:
+        cho, ridge = ridged_cho_factor(dense_operator_matrix(dl, nside, pixels[indices]))
+        chos.append(cho)
+    return chos
+
+
+class HoleDecomposedSinvSolver(object):
+    """
+    Solver for S^{-1} under a mask made up of many disconnected holes, such as point
+    source masks. The holes (connected components of `mask == 0`) are solved for
+    independently: holes with at most `max_dense_n` pixels with a dense Cholesky
+    factorization of the operator restricted to the hole (cached on disk per mask),
+    and all larger holes together with a single multigrid SinvSolver. `precond`
+    combines these as an additive Schwarz (block Jacobi) preconditioner, running the
+    multigrid and the dense solves in parallel on `nthreads` threads; `solve_mask`
+    runs CG with the exact operator. Remaining keyword arguments are passed on to
+    SinvSolver.
+    """
+
+    def __init__(self, dl, mask, max_dense_n=1000, nthreads=8, **sinv_kw):
+        self.dl = dl
+        self.lmax = dl.shape[0] - 1
+        self.mask = mask
+        self.nside = nside_of(mask)
+        self.geometry = MaskLevel(mask)
+        self.n = self.geometry.n
+        self.plan = self.geometry.plan(self.lmax)
+        self.dl_lm = scatter_l_to_lm(dl)
+        self.nthreads = nthreads
+        self.pool = None
+
+        pixels = np.nonzero(self.geometry.pick)[0]
+        self.hole_indices, large_indices = split_mask_holes(mask, max_dense_n)
+        self.hole_chos = hole_cho_factors(dl, self.nside, mask, max_dense_n)
+
+        if large_indices:
+            self.large_indices = np.sort(np.concatenate(large_indices))
+            large_mask = np.ones_like(mask)
+            large_mask[pixels[self.large_indices]] = 0
+            self.large_solver = SinvSolver(dl, large_mask, **sinv_kw)
+        else:
+            self.large_indices = None
+            self.large_solver = None
+        logging.info('Masked solver: {} holes solved densely, {} holes ({} pixels) by multigrid'.format(
+            len(self.hole_indices), len(large_indices),
+            0 if self.large_indices is None else self.large_indices.shape[0]))
+
+    def restrict(self, u):
+        return self.pickvec(self.plan.synthesis(u))
+
+    def prolong(self, u):
+        return self.plan.adjoint_synthesis(self.padvec(u))
+
+    def pickvec(self, u):
+        return self.geometry.pickvec(u)
+
+    def padvec(self, u):
+        return self.geometry.padvec(u)
+
+    def matvec(self, u):
+        return self.restrict(self.dl_lm * self.prolong(u))
+
+    def solve_holes(self, b, ihole_start, ihole_stop, x):
+        for ihole in range(ihole_start, ihole_stop):
+            indices = self.hole_indices[ihole]
+            x[indices] = scipy.linalg.cho_solve(self.hole_chos[ihole], b[indices])
+
+    def precond(self, b):
+        if self.pool is None:
+            self.pool = ThreadPool(self.nthreads)
+        x = np.zeros_like(b)
+        # the holes are disjoint, so the tasks write to disjoint parts of x
+        tasks = []
+        if self.large_solver is not None:
+            tasks.append(('large', None, None))
+        nholes = len(self.hole_indices)
+        chunk = max(nholes // (4 * self.nthreads), 1)
+        tasks.extend(('holes', start, min(start + chunk, nholes)) for start in range(0, nholes, chunk))
+
+        def run(task):
+            kind, start, stop = task
+            if kind == 'large':
+                x[self.large_indices] = self.large_solver.precond(b[self.large_indices])
+            else:
+                self.solve_holes(b, start, stop, x)
+
+        self.pool.map(run, tasks, chunksize=1)
+        return x
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def solve_mask(self, b, x0=None, rtol=1e-6, maxit=50):
+        """
+        Returns (x, reslst, errlst); see `multigrid.solve_mask_cg`.
+        """
+        return solve_mask_cg(self.matvec, self.precond, b, x0=x0, rtol=rtol, maxit=maxit)
@@ -1,13 +1,16 @@
 from __future__ import division
+import logging
+from multiprocessing.pool import ThreadPool
 import numpy as np
-from scipy.sparse import dok_matrix
 import scipy
+import scipy.linalg
 
 from .beams import standard_needlet_by_l, fourth_order_beam, gaussian_beam_by_l
 from . import sharp
-from .cg import cg_generator
-from .utils import scatter_l_to_lm, hammer
+from .utils import scatter_l_to_lm, hammer, ridged_cho_factor
 from .cache import memory
+from .multigrid import (DEFAULT_NAPPLY, MAX_DENSE_N, check_cycle, coarse_cycles, choose_coarsening_depth,
+                        smoother_matvecs, estimate_max_eigenvalue, chebyshev_smooth, solve_mask_cg)
 
 
 def needletify_dl(b, lmax_factor, dl):
@@ -32,15 +35,24 @@ def operator_image_to_power_spectrum(unitvec, opimage):
     return dl_fft
 
 
-def sphere_dl_to_2d_fft_spectrum(dl, ntheta, nphi):
+def sphere_dl_to_2d_fft_spectrum(dl, ntheta, nphi, center_ring=None):
     """
     Convert the operator Y D1 Y^T to F D2 F^T, where Y are spherical harmonics,
     D1 has `dl` on the diagonal, and D2. The result will be on the resolution given by ntheta, nphi.
+
+    The operator is sampled around ring `center_ring` of the Gauss-Legendre grid with
+    `dl.shape[0]` rings, on the `ntheta` rings centered on it; by default on the equator.
     """
     nrings = dl.shape[0]
 
     unitvec_hi = np.zeros((nrings, 2 * nrings))
-    unitvec_hi[nrings // 2, nrings] = 1
+    if center_ring is None:
+        start_ring = (nrings - ntheta) // 2
+        unitvec_hi[nrings // 2, nrings] = 1
+    else:
+        center_ring = min(max(center_ring, 0), nrings - 1)
+        start_ring = min(max(center_ring - ntheta // 2, 0), nrings - ntheta)
+        unitvec_hi[center_ring, nrings] = 1
 
     # Make a [2*pi, pi] image of the operator on the equator using spherical harmonics, at the full resolution
     # supporting lmax
@@ -49,8 +61,8 @@ def sphere_dl_to_2d_fft_spectrum(dl, ntheta, nphi):
     opimage_hi = sharp.sh_synthesis_gauss(nrings - 1, u).reshape((nrings, 2 * nrings))
 
     # Slice out a piece that is large enough to only support (ntheta, nphi)
-    opimage_lo = opimage_hi[(nrings - ntheta) // 2:(nrings + ntheta) // 2, (2 * nrings - nphi) // 2:(2 * nrings + nphi) // 2]
-    unitvec_lo = unitvec_hi[(nrings - ntheta) // 2:(nrings + ntheta) // 2, (2 * nrings - nphi) // 2:(2 * nrings + nphi) // 2]
+    opimage_lo = opimage_hi[start_ring:start_ring + ntheta, (2 * nrings - nphi) // 2:(2 * nrings + nphi) // 2]
+    unitvec_lo = unitvec_hi[start_ring:start_ring + ntheta, (2 * nrings - nphi) // 2:(2 * nrings + nphi) // 2]
 
     # Turn it into Fourier power spectrum
     result = operator_image_to_power_spectrum(unitvec_lo, opimage_lo)
@@ -59,6 +71,23 @@ def sphere_dl_to_2d_fft_spectrum(dl, ntheta, nphi):
 
 
 
+try:
+    # scipy >= 1.4 can run the FFTs multithreaded
+    import scipy.fft as _fft_module
+    _fft_kw = dict(workers=-1)
+except ImportError:
+    _fft_module = np.fft
+    _fft_kw = {}
+
+
+def _rfftn(u):
+    return _fft_module.rfftn(u, **_fft_kw)
+
+
+def _irfftn(u, shape):
+    return _fft_module.irfftn(u, shape, **_fft_kw)
+
+
 def flatsky_analysis(u):
     return np.fft.fftn(u) / np.prod(u.shape)
 
@@ -75,50 +104,85 @@ def flatsky_adjoint_synthesis(u):
     return np.fft.fftn(u)
 
 
-@memory.cache
-def coarsen_matrix(ntheta, nphi):
-    coarse_ntheta = ntheta // 2
-    coarse_nphi = nphi // 2
-    R = dok_matrix((coarse_ntheta * coarse_nphi, ntheta * nphi))
-
-    def add(coarse_i, coarse_j, fine_i, fine_j, weight):
-        # wrap around fine_i and fine_j..
-        fine_i = fine_i % ntheta
-        fine_j = fine_j % nphi
-
-        coarse_ind = coarse_i * coarse_nphi + coarse_j
-        fine_ind = fine_i * nphi + fine_j
-        R[coarse_ind, fine_ind] = weight
-    
-    for i in range(coarse_ntheta):
-        for j in range(coarse_nphi):
-            # row above
-            add(i, j, 2 * i - 1, 2 * j - 1, 1/16.)
-            add(i, j, 2 * i - 1, 2 * j, 1/8.)
-            add(i, j, 2 * i - 1, 2 * j + 1, 1/16.)
+def real_flatsky_spectrum(dl_fft):
+    """
+    Converts a 2D spectrum for use with `real_flatsky_matvec`. Since the operator is only
+    applied to real maps, taking the real part after the transforms, only the part of
+    `dl_fft` that is symmetric under k -> -k matters; the half spectrum of that is returned.
+    """
+    dl_neg = np.roll(np.roll(dl_fft[::-1, ::-1], 1, axis=0), 1, axis=1)
+    return np.ascontiguousarray((0.5 * (dl_fft + dl_neg))[:, :dl_fft.shape[1] // 2 + 1].real)
+
+
+def real_flatsky_matvec(u, dl_rfft):
+    """
+    Computes `flatsky_synthesis(dl_fft * flatsky_adjoint_synthesis(u)).real` using real FFTs,
+    where `dl_rfft = real_flatsky_spectrum(dl_fft)`.
+    """
+    u_fft = _rfftn(u)
+    u_fft *= dl_rfft
+    u = _irfftn(u_fft, u.shape)
+    u *= np.prod(u.shape)
+    return u
+
+
+def _restrict_indices(n):
+    i = np.arange(n // 2)
+    return (2 * i - 1) % n, 2 * i, (2 * i + 1) % n
 
-            # center row
-            add(i, j, 2 * i, 2 * j - 1, 1/8.)
-            add(i, j, 2 * i, 2 * j, 1/4.)
-            add(i, j, 2 * i, 2 * j + 1, 1/8.)
 
-            # row below
-            add(i, j, 2 * i + 1, 2 * j - 1, 1/16.)
-            add(i, j, 2 * i + 1, 2 * j, 1/8.)
-            add(i, j, 2 * i + 1, 2 * j + 1, 1/16.)
+def restrict_stencil(u):
+    """
+    Applies the 9-point full weighting stencil (1/16, 1/8, 1/16; 1/8, 1/4, 1/8; 1/16, 1/8, 1/16)
+    to the 2D array `u`, with periodic boundaries, returning an array of half the size
+    along each axis. Coarse pixel (i, j) is centered on fine pixel (2i, 2j).
+    """
+    for axis in (0, 1):
+        im, i0, ip = _restrict_indices(u.shape[axis])
+        u = 0.5 * np.take(u, i0, axis=axis) + 0.25 * (np.take(u, im, axis=axis) + np.take(u, ip, axis=axis))
+    return u
+
 
-    return R.tocsr()
+def interpolate_stencil(u, shape):
+    """
+    The transpose of `restrict_stencil`, interpolating `u` to the fine grid of the given shape.
+    """
+    for axis in (0, 1):
+        im, i0, ip = _restrict_indices(shape[axis])
+        out_shape = list(u.shape)
+        out_shape[axis] = shape[axis]
+        out = np.zeros(out_shape)
+        # each of im, i0, ip is a set of distinct indices, so fancy-index += is safe
+        if axis == 0:
+            out[i0, :] += 0.5 * u
+            out[im, :] += 0.25 * u
+            out[ip, :] += 0.25 * u
+        else:
+            out[:, i0] += 0.5 * u
+            out[:, im] += 0.25 * u
+            out[:, ip] += 0.25 * u
+        u = out
+    return u
 
 
 class SinvSolver(object):
+    """
+    Flat-sky multigrid solver for S^{-1} on a band of rings of a Gauss-Legendre grid,
+    by default the equatorial band from ring 3 * nrings / 8 to 5 * nrings / 8. The band
+    is treated as periodic; in phi it is, as it covers full rings.
+    The multigrid options are as for `masked_solver.SinvSolver`.
+    """
 
-    def __init__(self, dl, mask_gauss, split=False):
+    def __init__(self, dl, mask_gauss, split=False, start_ring=None, stop_ring=None,
+                 cycle='V', pre_smooth=1, post_smooth=1,
+                 smoother='diagonal', damping=0.3, degree=2, napply=DEFAULT_NAPPLY):
+        check_cycle(cycle)
         self.nrings = int(np.round(np.sqrt(mask_gauss.shape[0] / 2)))
         assert mask_gauss.shape[0] == 2 * self.nrings**2
         self.lmax = self.nrings - 1
 
-        self.start_ring = 3 * self.nrings // 8
-        self.stop_ring = 5 * self.nrings // 8
+        self.start_ring = 3 * self.nrings // 8 if start_ring is None else start_ring
+        self.stop_ring = 5 * self.nrings // 8 if stop_ring is None else stop_ring
 
         self.dl = dl
         
@@ -132,7 +196,14 @@ class SinvSolver(object):
         nphi = 2 * self.nrings
         self.shape = (ntheta, nphi)
 
-        self.outer_dl_fft = sphere_dl_to_2d_fft_spectrum(self.dl, ntheta, nphi)
+        if start_ring is None:
+            self.outer_dl_fft = sphere_dl_to_2d_fft_spectrum(self.dl, ntheta, nphi)
+        else:
+            # sample the operator at the latitude of the center of the band, on the grid
+            # with dl.shape[0] rings
+            center_ring = int((self.start_ring + ntheta / 2) * self.dl.shape[0] / self.nrings)
+            self.outer_dl_fft = sphere_dl_to_2d_fft_spectrum(self.dl, ntheta, nphi, center_ring=center_ring)
+        self.outer_dl_rfft = real_flatsky_spectrum(self.outer_dl_fft)
         
         #self.outer_dl_fft *= img[0,0] / self.outer_dl_fft[0,0]
 
@@ -143,14 +214,13 @@ class SinvSolver(object):
             self.inner_dl_fft = self.outer_dl_fft
             
         # Build multi-grid levels
-        cur_level = Level(self.inner_dl_fft, self.mask)
-        self.levels = [cur_level]
-
-        while cur_level.n > 50:
-            cur_level = coarsen_level(cur_level)
-            self.levels.append(cur_level)
+        self.cycle = cycle
+        self.pre_smooth = pre_smooth
+        self.post_smooth = post_smooth
+        self.levels = make_levels(self.inner_dl_fft, self.mask, cycle=cycle, napply=napply,
+                                  matvecs_per_visit=matvecs_per_visit(pre_smooth, post_smooth, smoother, degree))
     
-        self.smoothers = [DiagonalSmoother(lev) for lev in self.levels][:-1]
+        self.smoothers = [make_smoother(lev, smoother, damping=damping, degree=degree) for lev in self.levels[:-1]]
         self.smoothers.append(DenseSmoother(self.levels[-1]))
 
 
@@ -173,11 +243,9 @@ class SinvSolver(object):
 
     def outer_matvec(self, u_in):
         root_level = self.levels[0]
-        u = root_level.padvec(u_in)
-        u = flatsky_adjoint_synthesis(u)
-        u *= self.outer_dl_fft
-        u = flatsky_synthesis(u)
-        u = root_level.pickvec(u).real
+        u = root_level.padvec(u_in, out=root_level.pad_buf)
+        u = real_flatsky_matvec(u, self.outer_dl_rfft)
+        u = root_level.pickvec(u)
         return u
 
     def outer_precond(self, b):
@@ -186,8 +254,12 @@ class SinvSolver(object):
             x = self.inner_precond(x)
         return x
 
+    def precond(self, b):
+        return self.outer_precond(b)
+
     def inner_precond(self, b):
-        return v_cycle(0, self.levels, self.smoothers, b)
+        return v_cycle(0, self.levels, self.smoothers, b, cycle=self.cycle,
+                       pre_smooth=self.pre_smooth, post_smooth=self.post_smooth)
 
     def equator_to_gauss_grid(self, u):
         u_pad = np.zeros((self.nrings, 2 * self.nrings))
@@ -200,38 +272,9 @@ class SinvSolver(object):
 
     def solve_mask(self, b, x0=None, rtol=1e-6, maxit=50):
         """
-        Returns (x, reslst, errlst)
-
-        If x0 is supplied, compute the errors and return errlst; otherwise errlst is empt
+        Returns (x, reslst, errlst); see `multigrid.solve_mask_cg`.
         """
-        solver = cg_generator(
-            self.outer_matvec,
-            b=b,
-            M=self.outer_precond,
-            x0=np.zeros_like(b)
-            )
-
-        reslst = []
-        errlst = []
-        if x0 is not None:
-            x0_norm = np.linalg.norm(x0)
-        b_norm = np.linalg.norm(b)
-
-        for i, (x, r, delta_new) in enumerate(solver):
-            r = np.linalg.norm(r) / b_norm
-            reslst.append(r)
-            if x0 is not None:
-                e = np.linalg.norm(x0 - x) / x0_norm
-                errlst.append(e)
-                print 'iteration {}, res={}, err={}'.format(i, r, e)
-            else:
-                pass
-                print 'iteration {}, res={}'.format(i, r)
-            if r < rtol or i > maxit:
-                print 'breaking', r, repr(rtol), i, maxit
-                break
-
-        return x, reslst, errlst
+        return solve_mask_cg(self.outer_matvec, self.outer_precond, b, x0=x0, rtol=rtol, maxit=maxit, verbose=True)
 
     def solve_alm(self, b, single_v_cycle=False, repeat=1, *args, **kw):
         1/0
@@ -246,6 +289,112 @@ class SinvSolver(object):
     
     
 
+class MultiPatchSinvSolver(object):
+    """
+    Flat-sky solver for S^{-1} under the whole mask of a Gauss-Legendre grid (the pixels
+    where `mask_gauss` is 0).
+
+    The rings containing masked pixels are covered by overlapping bands of `patch_nrings`
+    rings, each a flat-sky SinvSolver with the operator sampled at its own latitude (full
+    rings, so periodic in phi). `precond` combines the patch preconditioners additively,
+    each weighted on both sides by the square root of a partition of unity over the
+    overlaps so that the result stays symmetric, and runs the patches on a thread pool
+    of `nthreads` threads. `solve_mask` runs CG with the exact operator, using SHTs on the
+    Gauss-Legendre grid. Remaining keyword arguments are passed on to SinvSolver.
+    """
+
+    def __init__(self, dl, mask_gauss, patch_nrings=None, overlap=None, nthreads=8, **sinv_kw):
+        self.nrings = nrings = int(np.round(np.sqrt(mask_gauss.shape[0] / 2)))
+        assert mask_gauss.shape[0] == 2 * nrings**2
+        self.lmax = nrings - 1
+        self.dl = dl
+        self.lmax_sh = dl.shape[0] - 1
+        self.mask = mask_gauss
+        self.pick = (mask_gauss == 0)
+        self.n = int(self.pick.sum())
+        self.nthreads = nthreads
+
+        if patch_nrings is None:
+            patch_nrings = max(nrings // 4, 1)
+        patch_nrings = min(patch_nrings, nrings)
+        if overlap is None:
+            overlap = patch_nrings // 4
+        step = max(patch_nrings - overlap, 1)
+        starts = list(range(0, nrings - patch_nrings + 1, step))
+        if starts[-1] + patch_nrings < nrings:
+            starts.append(nrings - patch_nrings)
+
+        # drop bands without masked pixels
+        ring_has_hole = self.pick.reshape(nrings, 2 * nrings).any(axis=1)
+        starts = [start for start in starts if ring_has_hole[start:start + patch_nrings].any()]
+
+        ring_count = np.zeros(nrings)
+        for start in starts:
+            ring_count[start:start + patch_nrings] += 1
+
+        # position of each grid pixel in the vector of masked pixels
+        pick_pos = np.cumsum(self.pick) - 1
+
+        self.patch_solvers = []
+        self.patch_indices = []
+        self.patch_weights = []
+        for start in starts:
+            solver = SinvSolver(dl, mask_gauss, start_ring=start, stop_ring=start + patch_nrings, **sinv_kw)
+            band_pixels = start * 2 * nrings + np.nonzero(solver.levels[0].pick)[0]
+            rings = band_pixels // (2 * nrings)
+            self.patch_solvers.append(solver)
+            self.patch_indices.append(pick_pos[band_pixels])
+            self.patch_weights.append(np.sqrt(1 / ring_count[rings]))
+        logging.info('Flat-sky masked solver: {} patches of {} rings'.format(len(starts), patch_nrings))
+
+        self.pool = None
+
+    def restrict(self, u, lmax=None):
+        lmax = lmax or self.lmax_sh
+        return self.pickvec(sharp.sh_synthesis_gauss(self.nrings - 1, u, lmax_sh=lmax))
+
+    def prolong(self, u, lmax=None):
+        lmax = lmax or self.lmax_sh
+        return sharp.sh_adjoint_synthesis_gauss(self.nrings - 1, self.padvec(u), lmax_sh=lmax)
+
+    def pickvec(self, u):
+        return u[self.pick]
+
+    def padvec(self, u):
+        u_pad = np.zeros(2 * self.nrings**2)
+        u_pad[self.pick] = u
+        return u_pad
+
+    def matvec(self, u):
+        return self.restrict(scatter_l_to_lm(self.dl) * self.prolong(u))
+
+    def precond_patch(self, ipatch, b):
+        w = self.patch_weights[ipatch]
+        return w * self.patch_solvers[ipatch].precond(w * b[self.patch_indices[ipatch]])
+
+    def precond(self, b):
+        if self.pool is None:
+            self.pool = ThreadPool(self.nthreads)
+        patch_xs = self.pool.map(lambda ipatch: self.precond_patch(ipatch, b), range(len(self.patch_solvers)))
+        x = np.zeros_like(b)
+        for indices, patch_x in zip(self.patch_indices, patch_xs):
+            # indices are distinct within a patch
+            x[indices] += patch_x
+        return x
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def solve_mask(self, b, x0=None, rtol=1e-6, maxit=50):
+        """
+        Returns (x, reslst, errlst); see `multigrid.solve_mask_cg`.
+        """
+        return solve_mask_cg(self.matvec, self.precond, b, x0=x0, rtol=rtol, maxit=maxit)
+
+
 class Level(object):
     def __init__(self, dl_fft, mask):
         self.mask = mask
@@ -253,9 +402,11 @@ class Level(object):
         self.ntheta, self.nphi = dl_fft.shape
         self.pick = (mask.reshape(self.ntheta * self.nphi) == 0)
         self.n = int(self.pick.sum())
-        self.R = coarsen_matrix(self.ntheta, self.nphi)
+        self.dl_rfft = real_flatsky_spectrum(dl_fft)
         self.ntheta_H = self.ntheta // 2
         self.nphi_H = self.nphi // 2
+        # padvec target for internal use; zero outside of pick at all times
+        self.pad_buf = np.zeros((self.ntheta, self.nphi))
 
     def compute_diagonal(self):
         # sample the operator to figure out the constant to use...
@@ -267,21 +418,22 @@ class Level(object):
     def pickvec(self, u):
         return u.reshape(self.ntheta * self.nphi)[self.pick]
 
-    def padvec(self, u):
-        u_pad = np.zeros(self.ntheta * self.nphi)
-        u_pad[self.pick] = u.real
-        return u_pad.reshape(self.ntheta, self.nphi)
+    def padvec(self, u, out=None):
+        if out is None:
+            out = np.zeros((self.ntheta, self.nphi))
+        out.reshape(self.ntheta * self.nphi)[self.pick] = u.real
+        return out
 
     def matvec_padded(self, u):
-        u = flatsky_adjoint_synthesis(u)
-        u *= self.dl_fft
-        u = flatsky_synthesis(u).real
-        return u
+        return real_flatsky_matvec(u, self.dl_rfft)
     
-    def matvec(self, u_in):
-        u = self.padvec(u_in)
+    def matvec(self, u_in, out=None):
+        u = self.padvec(u_in, out=self.pad_buf)
         u = self.matvec_padded(u)
         u = self.pickvec(u)
+        if out is not None:
+            out[...] = u
+            u = out
         return u
 
     def matvec_coarsened(self, u):
@@ -289,33 +441,92 @@ class Level(object):
         return self.coarsen_padded(self.matvec_padded(self.interpolate_padded(u)))
 
     def coarsen_padded(self, u):
-        return (self.R * u.reshape(self.ntheta * self.nphi)).reshape(self.ntheta_H, self.nphi_H)
+        return restrict_stencil(u.reshape(self.ntheta, self.nphi))
 
     def interpolate_padded(self, u):
-        return (self.R.T * u.reshape(self.ntheta_H * self.nphi_H)).reshape(self.ntheta, self.nphi)
+        return interpolate_stencil(u.reshape(self.ntheta_H, self.nphi_H), (self.ntheta, self.nphi))
+
+
+def dense_operator_matrix(dl_fft, pick):
+    """
+    Assembles F D F^T, restricted to the pixels `pick` of the grid, directly from the
+    convolution kernel of `dl_fft` evaluated on the offsets between the pixel pairs.
+    """
+    ntheta, nphi = dl_fft.shape
+    kernel = np.fft.ifftn(dl_fft).real * (ntheta * nphi)
+    itheta, iphi = np.divmod(np.nonzero(pick)[0], nphi)
+    return kernel[(itheta[:, None] - itheta[None, :]) % ntheta, (iphi[:, None] - iphi[None, :]) % nphi]
+
+
+@memory.cache
+def dense_operator_cho_factor(dl_fft, mask):
+    matrix = dense_operator_matrix(dl_fft, mask.reshape(mask.size) == 0)
+    cho, ridge = ridged_cho_factor(matrix)
+    if ridge != 0:
+        logging.info('Coarsest level of flat-sky masked solver needed ridge {}'.format(ridge))
+    return cho
 
 
 class DenseSmoother(object):
     def __init__(self, level):
-        self.matrix = hammer(level.matvec, level.n)
-        self.inv_matrix = np.linalg.inv(self.matrix)
+        self.cho = dense_operator_cho_factor(level.dl_fft, level.mask)
 
     def apply(self, u):
-        return np.dot(self.inv_matrix, u)
+        return scipy.linalg.cho_solve(self.cho, u)
 
                                  
 class DiagonalSmoother(object):
-    def __init__(self, level):
+    def __init__(self, level, damping=0.3):
         self.level = level
+        self.damping = damping
 
         self.diag = level.compute_diagonal()
         self.inv_diag = 1 / self.diag
 
     def apply(self, u):
-        return 0.3 * self.inv_diag * u
+        return self.damping * self.inv_diag * u
+
+
+class ChebyshevSmoother(object):
+    """
+    Chebyshev polynomial in D^{-1} A damping the eigenvalues in [eig_max / eig_ratio, eig_max];
+    see `masked_solver.ChebyshevSmoother`. The output and work buffers are allocated
+    once; unless `out` is given, the result of `apply` is overwritten by the next call.
+    """
+    def __init__(self, level, degree=2, eig_ratio=30., power_its=10):
+        self.level = level
+        self.degree = degree
+
+        self.diag = level.compute_diagonal()
+        self.inv_diag = 1 / self.diag
+        self.eig_max = 1.1 * estimate_max_eigenvalue(level.matvec, self.inv_diag, level.n, nits=power_its, seed=0)
+        self.eig_min = self.eig_max / eig_ratio
+        self.out, self.res, self.d, self.Ad = [np.zeros(level.n) for i in range(4)]
+
+    def apply(self, u, out=None):
+        if out is None:
+            out = self.out
+        return chebyshev_smooth(self.level.matvec, self.inv_diag, self.eig_min, self.eig_max, self.degree,
+                                u, out, self.res, self.d, self.Ad)
+
+
+def make_smoother(level, smoother, damping=0.3, degree=2):
+    if smoother == 'diagonal':
+        return DiagonalSmoother(level, damping=damping)
+    elif smoother == 'chebyshev':
+        return ChebyshevSmoother(level, degree=degree)
+    else:
+        raise ValueError('Unknown smoother: {}'.format(smoother))
+
+
+def matvecs_per_visit(pre_smooth=1, post_smooth=1, smoother='diagonal', degree=2):
+    """
+    Number of level matvecs spent in one visit to a non-coarsest level by `v_cycle`.
+    """
+    return pre_smooth + post_smooth + 1 + (pre_smooth + post_smooth) * smoother_matvecs(smoother, degree)
 
 
-def v_cycle(ilevel, levels, smoothers, b):
+def v_cycle(ilevel, levels, smoothers, b, cycle='V', pre_smooth=1, post_smooth=1):
     if ilevel == len(levels) - 1:
         return smoothers[ilevel].apply(b)
     else:
@@ -323,21 +534,21 @@ def v_cycle(ilevel, levels, smoothers, b):
         next_level = levels[ilevel + 1]
 
         x = b * 0
-        for i in range(1):
+        for i in range(pre_smooth):
             x += smoothers[ilevel].apply(b - level.matvec(x))
 
-        for i in range(1):
+        for coarse_cycle in coarse_cycles(cycle, ilevel + 1 == len(levels) - 1):
             r_h = b - level.matvec(x)
 
             r_H = coarsen(level, next_level, r_h)
 
-            c_H = v_cycle(ilevel + 1, levels, smoothers, r_H)
+            c_H = v_cycle(ilevel + 1, levels, smoothers, r_H, coarse_cycle, pre_smooth, post_smooth)
 
             c_h = interpolate(level, next_level, c_H)
             
             x += c_h
 
-        for i in range(1):
+        for i in range(post_smooth):
             x += smoothers[ilevel].apply(b - level.matvec(x))
         return x
 
@@ -348,6 +559,30 @@ def coarsen(level, next_level, u):
 def interpolate(level, next_level, u):
     return level.pickvec(level.interpolate_padded(next_level.padvec(u)))    
 
+def make_levels(dl_fft, mask, cycle='V', matvecs_per_visit=3, napply=DEFAULT_NAPPLY,
+                max_dense_n=MAX_DENSE_N, min_coarse_n=50):
+    """
+    Returns the list of Level from fine to coarse. Candidate levels are made by coarsening
+    until there are at most `min_coarse_n` pixels to solve for; the depth is then picked by
+    `multigrid.choose_coarsening_depth`, weighing the FFTs spent on each level against
+    assembling, factoring and applying the dense coarsest level.
+    """
+    levels = [Level(dl_fft, mask)]
+    while levels[-1].n > min_coarse_n and min(levels[-1].ntheta, levels[-1].nphi) >= 4:
+        levels.append(coarsen_level(levels[-1]))
+
+    visit_costs, dense_ns, dense_setup_costs = [], [], []
+    for level in levels:
+        npix = level.ntheta * level.nphi
+        # two complex FFTs per matvec
+        visit_costs.append(matvecs_per_visit * 2 * 5 * npix * np.log2(npix))
+        dense_ns.append(level.n)
+        dense_setup_costs.append(level.n**3 / 3 + npix * np.log2(npix) + level.n**2)
+    nlevels = choose_coarsening_depth(visit_costs, dense_ns, dense_setup_costs, cycle=cycle,
+                                      napply=napply, max_dense_n=max_dense_n)
+    return levels[:nlevels]
+
+
 def coarsen_level(level):
     # produce next coarser level
     ntheta_H = level.ntheta // 2
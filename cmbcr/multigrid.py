@@ -0,0 +1,177 @@
+"""
+Pieces shared by the multigrid solvers in masked_solver and masked_solver_fft: cycle
+types, the Chebyshev smoother, the cost model used to pick the coarsening depth and
+the CG loop of their `solve_mask` methods.
+
+Cycles are given as 'V', 'W' or 'F'. On each level, the coarse-grid correction visits
+the next coarser level once for a V-cycle, twice (with W-cycles) for a W-cycle, and
+for an F-cycle first with an F-cycle and then with a V-cycle. When the next level is
+the coarsest, which is solved directly, it is only visited once.
+"""
+from __future__ import division
+import logging
+import numpy as np
+
+from .cg import cg_generator
+
+CYCLES = ('V', 'W', 'F')
+
+# Number of preconditioner applications the setup cost is amortized over
+# when choosing the coarsening depth
+DEFAULT_NAPPLY = 100
+
+# Never use a dense coarsest level with more unknowns than this
+MAX_DENSE_N = 6000
+
+
+def check_cycle(cycle):
+    if cycle not in CYCLES:
+        raise ValueError('cycle must be one of {}, got {!r}'.format(CYCLES, cycle))
+
+
+def coarse_cycles(cycle, coarser_is_coarsest):
+    """
+    The cycle types to run, in order, on the next coarser level.
+    """
+    if coarser_is_coarsest or cycle == 'V':
+        return (cycle,)
+    elif cycle == 'W':
+        return ('W', 'W')
+    else:
+        return ('F', 'V')
+
+
+def cycle_visits(cycle, nlevels):
+    """
+    Returns how many times each of `nlevels` levels is visited in one cycle.
+    """
+    check_cycle(cycle)
+    visits = [0] * nlevels
+    _count_visits(cycle, 0, nlevels, visits)
+    return visits
+
+
+def _count_visits(cycle, ilevel, nlevels, visits):
+    visits[ilevel] += 1
+    if ilevel < nlevels - 1:
+        for coarse_cycle in coarse_cycles(cycle, ilevel + 1 == nlevels - 1):
+            _count_visits(coarse_cycle, ilevel + 1, nlevels, visits)
+
+
+def choose_coarsening_depth(visit_costs, dense_ns, dense_setup_costs, cycle='V',
+                            napply=DEFAULT_NAPPLY, max_dense_n=MAX_DENSE_N):
+    """
+    Picks how many levels to use from a list of candidate levels, fine to coarse.
+
+    `visit_costs[i]` is the cost (in flops) of the work done on level i during one visit
+    when it is not the coarsest level, `dense_ns[i]` the number of unknowns and
+    `dense_setup_costs[i]` the cost of assembling and factoring the dense operator if
+    level i is made the coarsest. Returns the number of levels minimizing the setup cost
+    plus `napply` cycles.
+    """
+    best_nlevels, best_cost = None, np.inf
+    for nlevels in range(1, len(dense_ns) + 1):
+        n = dense_ns[nlevels - 1]
+        if n > max_dense_n:
+            continue
+        visits = cycle_visits(cycle, nlevels)
+        apply_cost = sum(visits[i] * visit_costs[i] for i in range(nlevels - 1))
+        apply_cost += visits[-1] * 2 * n**2
+        cost = dense_setup_costs[nlevels - 1] + napply * apply_cost
+        if cost < best_cost:
+            best_nlevels, best_cost = nlevels, cost
+    if best_nlevels is None:
+        raise ValueError('coarsest candidate level has {} > max_dense_n={} unknowns'.format(
+            dense_ns[-1], max_dense_n))
+    logging.info('Multigrid: using {} levels, coarsest has {} unknowns'.format(
+        best_nlevels, dense_ns[best_nlevels - 1]))
+    return best_nlevels
+
+
+def smoother_matvecs(smoother, degree):
+    """
+    Number of operator applications a smoother does per application.
+    """
+    return degree - 1 if smoother == 'chebyshev' else 0
+
+
+def estimate_max_eigenvalue(matvec, inv_diag, n, nits=10, seed=None):
+    """
+    Estimates the largest eigenvalue of diag(inv_diag) A by power iteration.
+    """
+    x = np.random.RandomState(seed).normal(size=n)
+    x /= np.linalg.norm(x)
+    eig = 0
+    for i in range(nits):
+        y = inv_diag * matvec(x)
+        eig = np.linalg.norm(y)
+        x = y / eig
+    return eig
+
+
+def chebyshev_smooth(matvec, inv_diag, eig_min, eig_max, degree, r, out, res, d, Ad):
+    """
+    Applies the Chebyshev polynomial of degree `degree` in diag(inv_diag) A that
+    damps the eigenvalues in [eig_min, eig_max] to the residual `r`, putting the
+    result in `out`. This takes `degree - 1` calls to `matvec(x, out)`.
+
+    `inv_diag`, `eig_min` and `eig_max` can be arrays broadcasting against `r`, in
+    order to smooth a batch of systems at once. `res`, `d` and `Ad` are work buffers
+    shaped like `r`.
+    """
+    theta = 0.5 * (eig_max + eig_min)
+    delta = 0.5 * (eig_max - eig_min)
+    sigma = theta / delta
+    rho = 1 / sigma
+
+    np.multiply(inv_diag / theta, r, out=d)
+    out[...] = d
+    res[...] = r
+    for i in range(degree - 1):
+        res -= matvec(d, Ad)
+        rho_new = 1 / (2 * sigma - rho)
+        d *= rho_new * rho
+        d += (2 * rho_new / delta) * inv_diag * res
+        out += d
+        rho = rho_new
+    return out
+
+
+def solve_mask_cg(matvec, precond, b, x0=None, rtol=1e-6, maxit=50, verbose=False):
+    """
+    Solves `matvec(x) = b` with CG preconditioned by `precond`, starting from zero,
+    until the relative residual is below `rtol` or after `maxit` iterations.
+    Returns (x, reslst, errlst).
+
+    If the true solution x0 is supplied, compute the errors and return errlst;
+    otherwise errlst is empty. With `verbose`, the residuals are printed.
+    """
+    solver = cg_generator(
+        matvec,
+        b=b,
+        M=precond,
+        x0=np.zeros_like(b)
+        )
+
+    reslst = []
+    errlst = []
+    if x0 is not None:
+        x0_norm = np.linalg.norm(x0)
+    b_norm = np.linalg.norm(b)
+
+    for i, (x, r, delta_new) in enumerate(solver):
+        r = np.linalg.norm(r) / b_norm
+        reslst.append(r)
+        if x0 is not None:
+            e = np.linalg.norm(x0 - x) / x0_norm
+            errlst.append(e)
+            if verbose:
+                print 'iteration {}, res={}, err={}'.format(i, r, e)
+        elif verbose:
+            print 'iteration {}, res={}'.format(i, r)
+        if r < rtol or i > maxit:
+            if verbose:
+                print 'breaking', r, repr(rtol), i, maxit
+            break
+
+    return x, reslst, errlst
@@ -0,0 +1,218 @@
+"""
+Picks the preconditioner for a prepared CrSystem that is predicted to reach a given
+tolerance fastest. For each candidate, the setup time and the time per application
+are measured, and a few trial CG iterations give an estimate of the convergence
+rate; the predicted time to tolerance is then
+
+    setup + log(tol) / log(rate) * (apply + matvec).
+
+The rate is taken from the last half of the trial iterations, as the first few tend
+to converge faster than the rest. The setup is timed with the disk cache bypassed
+(see `cache.disk_cache_bypassed`), so that a candidate whose setup happens to be
+cached from an earlier run is not favoured. The measurements and the decision are recorded
+in a YAML file keyed by `precond_store.system_fingerprint`, so that the choice is
+reused for the same system without running the trials again.
+"""
+from __future__ import division
+import os
+import logging
+import yaml
+import numpy as np
+
+from .cg import cg_generator, ConvergenceError
+from .utils import timed, format_duration, makedirs
+from .cache import disk_cache_bypassed
+from .precond_store import system_fingerprint
+
+__all__ = ['autotune_preconditioner', 'CANDIDATES', 'DEFAULT_RECORD_PATH']
+
+DEFAULT_RECORD_PATH = os.path.join('cache', 'autotune.yaml')
+
+# The failures of a candidate that make the autotuner skip it, e.g. a factorization
+# that fails or runs out of memory; anything else is a bug and is raised
+CANDIDATE_FAILURES = (np.linalg.LinAlgError, MemoryError, ValueError, ConvergenceError)
+
+
+def _make_diagonal(system):
+    from .precond_diag import DiagonalPreconditioner
+    return DiagonalPreconditioner(system)
+
+
+def _make_diagonal2(system):
+    from .precond_pseudoinv import DiagonalPreconditioner2
+    return DiagonalPreconditioner2(system)
+
+
+def _make_banded(system):
+    from .precond_sh import BandedHarmonicPreconditioner
+    return BandedHarmonicPreconditioner(system)
+
+
+def _make_pseudoinv(system):
+    from .precond_pseudoinv import PseudoInversePreconditioner
+    return PseudoInversePreconditioner(system)
+
+
+def _make_pseudoinv_mask(system):
+    from .precond_pseudoinv import PseudoInverseWithMaskPreconditioner
+    return PseudoInverseWithMaskPreconditioner(system, inner_its=0)
+
+
+def _make_pixel(system):
+    from .precond_pixel import PixelPreconditioner
+    return PixelPreconditioner(system)
+
+
+# name -> function constructing the preconditioner from a system
+CANDIDATES = dict(
+    diagonal=_make_diagonal,
+    diagonal2=_make_diagonal2,
+    banded=_make_banded,
+    pseudoinv=_make_pseudoinv,
+    pseudoinv_mask=_make_pseudoinv_mask,
+    pixel=_make_pixel,
+)
+
+
+def read_record(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return yaml.safe_load(f) or {}
+
+
+def write_record_entry(path, fingerprint, entry):
+    record = read_record(path)
+    record[fingerprint] = entry
+    dirname = os.path.dirname(path)
+    if dirname:
+        makedirs(dirname)
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        yaml.safe_dump(record, f, default_flow_style=False)
+    os.rename(tmp_path, path)
+
+
+def convergence_rate(reslst):
+    """
+    The average factor by which the residual is reduced per iteration, over the last
+    half of the residual norms in `reslst`.
+    """
+    start = len(reslst) // 2
+    n = len(reslst) - 1 - start
+    if n <= 0 or reslst[start] == 0:
+        return 0.
+    return (reslst[-1] / reslst[start])**(1. / n)
+
+
+def measure_candidate(system, make_precond, b, trial_its, napply):
+    """
+    Returns (preconditioner, measurements) for one candidate; the measurements are
+    the setup time, the time per application of the preconditioner and of the
+    system matrix, and the convergence rate over `trial_its` CG iterations.
+    """
+    with disk_cache_bypassed():
+        with timed(None) as t_setup:
+            precond = make_precond(system)
+
+    b_lst = system.unstack(b)
+    with timed(None) as t_apply:
+        for i in range(napply):
+            precond.apply([x.copy() for x in b_lst])
+
+    n_matvec = [0]
+    def matvec(x):
+        n_matvec[0] += 1
+        return system.stack(system.matvec(system.unstack(x)))
+
+    solver = cg_generator(
+        matvec,
+        b,
+        M=lambda x: system.stack(precond.apply(system.unstack(x))),
+        x0=np.zeros_like(b))
+    reslst = []
+    with timed(None) as t_cg:
+        for i, (x, r, delta_new) in enumerate(solver):
+            reslst.append(np.linalg.norm(r))
+            if i == trial_its:
+                break
+    apply_time = t_apply.dt / napply
+    # each CG iteration does one matvec and one preconditioner application
+    matvec_time = max(t_cg.dt / n_matvec[0] - apply_time, 0.)
+    return precond, dict(
+        setup_time=float(t_setup.dt),
+        apply_time=float(apply_time),
+        matvec_time=float(matvec_time),
+        rate=float(convergence_rate(reslst)),
+        trial_residuals=[float(r / reslst[0]) for r in reslst])
+
+
+def predict_time(measurements, tol):
+    """
+    Predicted time to reduce the residual by `tol`, or infinity if the trial
+    iterations did not converge.
+    """
+    rate = measurements['rate']
+    if not 0 < rate < 1:
+        return np.inf if rate >= 1 else measurements['setup_time']
+    its = np.log(tol) / np.log(rate)
+    return measurements['setup_time'] + its * (measurements['apply_time'] + measurements['matvec_time'])
+
+
+def autotune_preconditioner(system, tol=1e-8, candidates=None, trial_its=10, napply=3,
+                            record_path=DEFAULT_RECORD_PATH, reuse=True, seed=0):
+    """
+    Picks and returns (name, preconditioner) for a prepared `system`, minimizing the
+    predicted time for CG to reduce the residual by `tol`. `candidates` is a list of
+    names from `CANDIDATES`, by default all of them; candidates that fail to build or
+    run with one of `CANDIDATE_FAILURES` are skipped.
+
+    If `reuse` is set and `record_path` holds a decision for a system with the same
+    fingerprint and the same `tol` and candidates, that candidate is built directly.
+    Otherwise all candidates are measured and the decision is recorded, unless
+    `record_path` is None.
+    """
+    if candidates is None:
+        candidates = sorted(CANDIDATES.keys())
+    fingerprint = system_fingerprint(system)
+
+    if reuse and record_path is not None:
+        entry = read_record(record_path).get(fingerprint)
+        if entry is not None and entry['tol'] == tol and sorted(entry['candidates']) == sorted(candidates):
+            logging.info('Autotune: reusing recorded choice {}'.format(entry['choice']))
+            return entry['choice'], CANDIDATES[entry['choice']](system)
+
+    # A right-hand side with power in all modes
+    rng = np.random.RandomState(seed)
+    x0 = [rng.normal(size=n) for n in system.x_lengths]
+    b = system.stack(system.matvec(x0))
+
+    results = {}
+    best_name, best_precond, best_time = None, None, np.inf
+    for name in candidates:
+        try:
+            precond, measurements = measure_candidate(system, CANDIDATES[name], b, trial_its, napply)
+        except CANDIDATE_FAILURES as e:
+            logging.exception('Autotune: {} failed'.format(name))
+            results[name] = dict(error=str(e))
+            continue
+        measurements['predicted_time'] = float(predict_time(measurements, tol))
+        results[name] = measurements
+        logging.info('Autotune: {}: setup {}, apply {}, rate {:.3f}, predicted {}'.format(
+            name, format_duration(measurements['setup_time']), format_duration(measurements['apply_time']),
+            measurements['rate'], format_duration(measurements['predicted_time'])))
+        if measurements['predicted_time'] < best_time:
+            if best_precond is not None and hasattr(best_precond, 'close'):
+                best_precond.close()
+            best_name, best_precond, best_time = name, precond, measurements['predicted_time']
+        elif hasattr(precond, 'close'):
+            precond.close()
+
+    if best_name is None:
+        raise ValueError('Autotune: no candidate converged')
+    logging.info('Autotune: chose {}'.format(best_name))
+
+    if record_path is not None:
+        write_record_entry(record_path, fingerprint, dict(
+            choice=best_name, tol=tol, trial_its=trial_its, candidates=list(candidates), results=results))
+    return best_name, best_precond
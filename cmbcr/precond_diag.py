@@ -7,6 +7,7 @@ from .harmonic_preconditioner import construct_banded_preconditioner
 from .harmonic_preconditioner import k_kp_idx
 from .utils import pad_or_trunc, timed, pad_or_truncate_alm, scatter_l_to_lm
 from .cache import memory
+from .precond_store import save_preconditioner, load_preconditioner
 from .mblocks import compute_real_Yh_D_Y_block
 
 __all__ = ['DiagonalPreconditioner']
@@ -23,34 +24,68 @@ def compute_Yh_D_Y_diagonal(lmax, phase_map, thetas):
 
 
 @memory.cache
-def compute_diagonal_preconditioner(self):
+def compute_diagonal_noise_term(self):
+    """
+    The diagonal of the prior-independent part of the system, mixing_scalars**2 Y^T N^{-1} Y,
+    per component.
+    """
     system = self.system
     lmax = max(system.lmax_list)
     
-    precond_data = 0
-    A_diag_lst = [0] * system.comp_count
+    Ni_diag_lst = [0] * system.comp_count
     for nu in range(system.band_count):
         ninv_phase, thetas = gauss_ring_map_to_phase_map(system.ninv_gauss_lst[nu], system.lmax_ninv, lmax)
         Ni_diag = compute_Yh_D_Y_diagonal(lmax, ninv_phase, thetas) * scatter_l_to_lm(system.bl_list[nu][:lmax + 1])**2
         for k in range(system.comp_count):
-            A_diag_lst[k] += (
+            Ni_diag_lst[k] += (
                 pad_or_truncate_alm(Ni_diag, system.lmax_list[k])
                 * system.mixing_scalars[nu, k]**2
-                * scatter_l_to_lm(system.wl_list[k])
                 )
-
-    for k, x in enumerate(A_diag_lst):
-        x += scatter_l_to_lm(system.dl_list[k])
-            
-    return [1. / x for x in A_diag_lst]
+    return Ni_diag_lst
 
 
 class DiagonalPreconditioner(object):
     def __init__(self, system, diagonal=False, couplings=True, factor=True):
         self.system = system
+        self.mixing_version = system.mixing_version
         self.lmax = max(system.lmax_list)
-        self.M_lst = compute_diagonal_preconditioner(self)
+        self.Ni_diag_lst = compute_diagonal_noise_term(self)
+        self.update_prior(system.dl_list, system.wl_list)
+
+    def is_stale(self):
+        """
+        Whether the system's mixing has changed (see `CrSystem.update_mixing`) since
+        this preconditioner was built.
+        """
+        return self.mixing_version != self.system.mixing_version
 
+    def update_prior(self, dl_list, wl_list):
+        """
+        Recomputes the preconditioner for a new prior, reusing the noise term.
+        """
+        self.M_lst = [
+            1. / (Ni_diag * scatter_l_to_lm(wl) + scatter_l_to_lm(dl))
+            for Ni_diag, dl, wl in zip(self.Ni_diag_lst, dl_list, wl_list)]
 
     def apply(self, x_lst):
         return [M * x for M, x in zip(self.M_lst, x_lst)]
+
+    def save(self, path):
+        """
+        Save the preconditioner to the directory `path`; see `precond_store`.
+        """
+        save_preconditioner(path, self, {}, dict(Ni_diag_lst=self.Ni_diag_lst, M_lst=self.M_lst))
+
+    @classmethod
+    def load(cls, system, path, mmap=True):
+        """
+        Load a preconditioner for `system` saved with `save`, memory-mapped if `mmap`.
+        """
+        params, arrays = load_preconditioner(path, cls, system, mmap=mmap)
+        self = cls.__new__(cls)
+        self.system = system
+        self.mixing_version = system.mixing_version
+        self.lmax = max(system.lmax_list)
+        self.Ni_diag_lst = arrays['Ni_diag_lst']
+        self.M_lst = arrays['M_lst']
+        return self
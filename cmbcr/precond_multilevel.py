@@ -0,0 +1,178 @@
+"""
+Multilevel preconditioner on truncated copies of the system. The residual is
+restricted (truncated in l) to a copy of the system with a lower lmax, solved
+approximately there with a few iterations of preconditioned CG, prolonged
+(zero-padded) back and combined with a fine-level smoother. This takes care of the
+low-l modes, which is what makes the iteration count of the single-level
+preconditioners grow with lmax.
+
+Since the transfers are plain truncation in l, the coarse system is not the
+`downgrade_system` of the fine one (which stretches the beams in l), but uses the
+beams, prior and component weights of the fine system truncated to the coarse lmax.
+Its operator is then the low-l block of the fine one, up to the resolution of the
+noise and mixing maps.
+"""
+from __future__ import division
+import logging
+import numpy as np
+
+from .cg import cg_generator
+from .utils import pad_or_truncate_alm, timed
+from .precond_pseudoinv import DiagonalPreconditioner2, PseudoInverseWithMaskPreconditioner
+from .precond_pseudoinv import lstadd, lstsub, lstscale
+
+__all__ = ['MultilevelPreconditioner']
+
+SMOOTHERS = ('diagonal', 'pseudoinv')
+MODES = ('multiplicative', 'additive')
+
+
+def make_smoother(system, smoother):
+    if smoother == 'diagonal':
+        return DiagonalPreconditioner2(system)
+    elif smoother == 'pseudoinv':
+        return PseudoInverseWithMaskPreconditioner(system, inner_its=0)
+    else:
+        raise ValueError('smoother must be one of {}, got {!r}'.format(SMOOTHERS, smoother))
+
+
+def make_coarse_system(system, fraction):
+    """
+    Truncate a prepared system to `fraction` of its lmax and prepare the result with
+    the same settings. The fine system must still have its mixing maps, i.e., this
+    must be called before `release_intermediates`.
+    """
+    check_mixing_maps(system)
+    prior_list = [prior.downgrade(fraction) for prior in system.prior_list]
+    lmax_c = max(prior.lmax for prior in prior_list)
+    coarse = system.copy_with(
+        bl_list=[pad_or_trunc_l(bl, lmax_c) for bl in system.bl_list],
+        prior_list=prior_list,
+        mask=system.mask)
+    coarse.set_params(
+        lmax_ninv=int(system.lmax_ninv * max(coarse.lmax_list) / max(system.lmax_list)),
+        rot_ang=system.rot_ang,
+        flat_mixing=system.flat_mixing)
+    coarse.prepare_prior(set_wl_dl=False)
+    coarse.dl_list = [pad_or_trunc_l(dl, lmax) for dl, lmax in zip(system.dl_list, coarse.lmax_list)]
+    coarse.wl_list = [pad_or_trunc_l(wl, lmax) for wl, lmax in zip(system.wl_list, coarse.lmax_list)]
+    coarse.prepare(
+        use_healpix=system.use_healpix,
+        use_healpix_mixing=system.use_healpix_mixing,
+        mixing_nside=system.mixing_nside,
+        mixing_dtype=system.mixing_dtype,
+        constant_mixing_rtol=system.constant_mixing_rtol)
+    return coarse
+
+
+def check_mixing_maps(system):
+    if system.mixing_maps is None:
+        raise ValueError('the mixing maps of the system have been released; build the '
+                         'multilevel preconditioner before calling release_intermediates')
+
+
+def pad_or_trunc_l(x, lmax):
+    # HarmonicPrior.downgrade can round lmax up, so pad by repeating the last value
+    if x.shape[0] >= lmax + 1:
+        return x[:lmax + 1].copy()
+    return np.concatenate([x, np.repeat(x[-1:], lmax + 1 - x.shape[0])])
+
+
+class MultilevelPreconditioner(object):
+    """
+    `fraction` is the ratio of the lmax of each coarse level to the next finer one,
+    and `nlevels` the total number of levels; the coarse levels are themselves
+    multilevel preconditioners, and the coarsest one uses `smoother` alone.
+
+    On each application, the coarse system is solved with `inner_its` iterations of
+    CG (or until the residual has been reduced by `inner_rtol`), preconditioned by
+    the next coarser level. With `mode='multiplicative'` the coarse correction is
+    applied between a pre- and post-smoothing step, which costs two fine matvecs per
+    application; with `mode='additive'` the smoother and coarse correction are
+    simply added together. `damping` scales the smoother.
+
+    The coarse levels are set up the first time they are needed and then kept.
+    Note that since the coarse solves are inexact, the preconditioner varies slightly
+    between applications; keep `inner_its` small or `inner_rtol` tight.
+    """
+    def __init__(self, system, fraction=0.5, nlevels=2, smoother='diagonal', mode='multiplicative',
+                 inner_its=10, inner_rtol=1e-2, damping=1.):
+        if mode not in MODES:
+            raise ValueError('mode must be one of {}, got {!r}'.format(MODES, mode))
+        # the coarse levels are built lazily, but need the mixing maps of the system
+        check_mixing_maps(system)
+        self.system = system
+        self.mixing_version = system.mixing_version
+        self.fraction = fraction
+        self.nlevels = nlevels
+        self.smoother_type = smoother
+        self.mode = mode
+        self.inner_its = inner_its
+        self.inner_rtol = inner_rtol
+        self.damping = damping
+        self.smoother = make_smoother(system, smoother)
+        self._coarse_system = None
+        self._coarse_precond = None
+
+    def is_stale(self):
+        """
+        Whether the system's mixing has changed (see `CrSystem.update_mixing`) since
+        this preconditioner was built.
+        """
+        return self.mixing_version != self.system.mixing_version
+
+    @property
+    def coarse_system(self):
+        if self._coarse_system is None:
+            with timed('coarse level setup'):
+                self._coarse_system = make_coarse_system(self.system, self.fraction)
+            logging.info('Multilevel: coarse level has lmax={}'.format(max(self._coarse_system.lmax_list)))
+        return self._coarse_system
+
+    @property
+    def coarse_precond(self):
+        if self._coarse_precond is None:
+            if self.nlevels > 2:
+                self._coarse_precond = MultilevelPreconditioner(
+                    self.coarse_system, fraction=self.fraction, nlevels=self.nlevels - 1,
+                    smoother=self.smoother_type, mode=self.mode, inner_its=self.inner_its,
+                    inner_rtol=self.inner_rtol, damping=self.damping)
+            else:
+                self._coarse_precond = make_smoother(self.coarse_system, self.smoother_type)
+        return self._coarse_precond
+
+    def restrict(self, x_lst):
+        return [pad_or_truncate_alm(x, lmax) for x, lmax in zip(x_lst, self.coarse_system.lmax_list)]
+
+    def prolong(self, x_lst):
+        return [pad_or_truncate_alm(x, lmax) for x, lmax in zip(x_lst, self.system.lmax_list)]
+
+    def coarse_solve(self, b_lst):
+        coarse = self.coarse_system
+        precond = self.coarse_precond
+        b = coarse.stack(b_lst)
+        solver = cg_generator(
+            lambda x: coarse.stack(coarse.matvec(coarse.unstack(x))),
+            b,
+            M=lambda x: coarse.stack(precond.apply(coarse.unstack(x))),
+            x0=np.zeros_like(b))
+        b_norm = np.linalg.norm(b)
+        for i, (x, r, delta_new) in enumerate(solver):
+            if i == self.inner_its or np.linalg.norm(r) < self.inner_rtol * b_norm:
+                break
+        return coarse.unstack(x)
+
+    def coarse_correction(self, r_lst):
+        return self.prolong(self.coarse_solve(self.restrict(r_lst)))
+
+    def smooth(self, r_lst):
+        return lstscale(self.damping, self.smoother.apply(r_lst))
+
+    def apply(self, b_lst):
+        if self.mode == 'additive':
+            return lstadd(self.smooth(b_lst), self.coarse_correction(b_lst))
+
+        x = self.smooth(b_lst)
+        x = lstadd(x, self.coarse_correction(lstsub(b_lst, self.system.matvec(x))))
+        x = lstadd(x, self.smooth(lstsub(b_lst, self.system.matvec(x))))
+        return x
@@ -1,16 +1,49 @@
+import logging
 import numpy as np
+from scipy.sparse import csc_matrix
 
 from . import block_matrix
 from . import sympix_mg
 from . import sympix
-from .utils import timed
+from .utils import timed, pad_or_trunc, pad_or_truncate_alm
 from .mmajor import lmax_of
 from . import sharp
+from .precond_store import save_preconditioner, load_preconditioner
+
+# Number of bands whose R blocks are evaluated together; a multiple of the number
+# of beams sympix_mg.compute_many_YDYt_blocks_multi accumulates in registers
+R_BAND_CHUNK = 4
 
 
 class PixelPreconditioner(object):
 
-    def __init__(self, system, tilesize=8, ninv_factor=2, prior=True):
+    """
+    Preconditioner that approximates the system on a SymPix grid, where the system
+    matrix is sparse in tiles of tilesize-by-tilesize pixels.
+
+    `method` selects the approximate solve with the tile-sparse matrix:
+
+    'diagonal': Block-Jacobi, i.e., only the diagonal tile blocks are used.
+
+    'ichol': Block incomplete Cholesky (IC(0)) of the full tile-sparse matrix, with the
+        smallest ridge that makes the factorization succeed (multiplied by
+        `ridge_margin`). The triangular solves are parallelized by level scheduling.
+
+    'clusters': Block-Jacobi on clusters of strongly coupled tiles. Tiles are merged
+        while an off-diagonal block norm relative to the diagonal block norms is above
+        `cluster_eps`, up to `max_cluster_size` tiles per cluster; each cluster is then
+        factored as a dense Cholesky block. Sits between 'diagonal' and 'ichol' in
+        both cost and quality.
+
+    The tile-sparse matrix is assembled as the sum of a noise term with one block per
+    tile pair, stored in `matrix_dtype`, and a prior term stored once per rotationally
+    equivalent tile pair; see block_matrix.BlockMatrixSum. If `keep_matrix` is set, it
+    is kept as `A_matrix`, and `tile_matvec` applies it; this is a cheap approximate
+    operator for inner solves and smoothers in the pixel domain.
+    """
+
+    def __init__(self, system, tilesize=8, ninv_factor=2, prior=True, method='diagonal', ridge_margin=1.1,
+                 cluster_eps=0.2, max_cluster_size=8, keep_matrix=False, matrix_dtype=np.float32):
         lmax = max(system.lmax_list)
         self.grid = sympix.make_sympix_grid(lmax + 1, tilesize, n_start=8)
         grid_ninv = self.grid.with_tilesize(tilesize * ninv_factor)
@@ -20,50 +53,200 @@ class PixelPreconditioner(object):
             neighmat, (label_to_i, label_to_j) = sympix.sympix_csc_neighbours(self.grid, lower_only=False,corner_factor=corner_factor)
             neighmat_lower, (label_to_i_lower, label_to_j_lower) = sympix.sympix_csc_neighbours(self.grid, lower_only=True, corner_factor=corner_factor)
 
-        A_sparse = block_matrix.BlockMatrix(neighmat_lower.indptr, neighmat_lower.indices, blockshape=(tilesize**2, tilesize**2))
+        # The unknowns of each tile are ordered component-major, i.e., the tile blocks
+        # are (ncomp * tilesize**2)-by-(ncomp * tilesize**2) with one tilesize**2 sub-block
+        # per pair of components (k, kp). Each band contributes
+        # mixing_scalars[nu, k] * mixing_scalars[nu, kp] * R^T N^{-1} R to sub-block (k, kp).
+        #
+        # The matrix is kept as the sum of two terms. The noise term has one block per
+        # entry, as the ninv map breaks the rotational symmetry, and is stored in
+        # matrix_dtype (single precision by default). The prior term is rotationally
+        # invariant and so stored only once per label of the neighbour graph.
+        ncomp = system.comp_count
+        bs = tilesize**2
+        indptr, indices = neighmat_lower.indptr, neighmat_lower.indices
+        Ni_matrix = block_matrix.BlockMatrix(indptr, indices, blockshape=(ncomp * bs, ncomp * bs), dtype=matrix_dtype)
         with timed('R'):
-            for nu in range(system.band_count):
-                bl = system.bl_list[nu][:lmax + 1]
-
-                plan_dg = sharp.SymPixGridPlan(grid_ninv, lmax_of(system.winv_ninv_sh_lst[nu]))
-                ninv_map = plan_dg.adjoint_analysis(system.winv_ninv_sh_lst[nu])
-                R_blocks = sympix_mg.compute_many_YDYt_blocks(
-                    grid_ninv, self.grid, bl,
+            # The pixel pairs are the same for all bands, only the beam differs, so the
+            # blocks of several bands are evaluated in one pass. They are reduced into
+            # Ni_matrix right away, so only R_BAND_CHUNK bands of blocks are held at a time
+            Ni_sparse = block_matrix.BlockMatrix(indptr, indices, blockshape=(bs, bs))
+            for nu0 in range(0, system.band_count, R_BAND_CHUNK):
+                bands = range(nu0, min(nu0 + R_BAND_CHUNK, system.band_count))
+                bls = np.zeros((lmax + 1, len(bands)), order='F')
+                for i, nu in enumerate(bands):
+                    bls[:, i] = system.bl_list[nu][:lmax + 1]
+                R_blocks_chunk = sympix_mg.compute_many_YDYt_blocks_multi(
+                    grid_ninv, self.grid, bls,
                     np.asarray(label_to_i, dtype=np.int32),
                     np.asarray(label_to_j, dtype=np.int32))
-                R = block_matrix.BlockMatrix(neighmat.indptr, neighmat.indices, R_blocks, labels=neighmat.data)
-                block_matrix.block_At_D_B(
-                    R, R,
-                    ninv_map.reshape(grid_ninv.tilesize**2, grid_ninv.ntiles, order='F'),
-                    A_sparse)
-
-
-            k = kp = 0  # DEBUG
-            if k == kp and prior:
-                Si_blocks = sympix_mg.compute_many_YDYt_blocks(
-                    self.grid, self.grid,
-                    system.dl_list[k],
-                    np.asarray(label_to_i_lower, dtype=np.int32),
-                    np.asarray(label_to_j_lower, dtype=np.int32))
-                Si_blocks = Si_blocks[:, :, neighmat_lower.data]
-                A_sparse.blocks += Si_blocks
-
-                
-        self.diagonal_blocks = A_sparse.blocks[:, :, A_sparse.labels[A_sparse.indptr[:-1]]].copy('F')
-        block_matrix.block_diagonal_factor(self.diagonal_blocks)
 
+                for i, nu in enumerate(bands):
+                    plan_dg = sharp.SymPixGridPlan(grid_ninv, lmax_of(system.winv_ninv_sh_lst[nu]))
+                    ninv_map = plan_dg.adjoint_analysis(system.winv_ninv_sh_lst[nu])
+                    R_blocks = R_blocks_chunk[:, :, :, i]
+                    R = block_matrix.BlockMatrix(neighmat.indptr, neighmat.indices, R_blocks, labels=neighmat.data)
+                    Ni_sparse.blocks[...] = 0
+                    block_matrix.block_At_D_B(
+                        R, R,
+                        ninv_map.reshape(grid_ninv.tilesize**2, grid_ninv.ntiles, order='F'),
+                        Ni_sparse)
+                    for k in range(ncomp):
+                        for kp in range(ncomp):
+                            q = system.mixing_scalars[nu, k] * system.mixing_scalars[nu, kp]
+                            Ni_matrix.blocks[k * bs:(k + 1) * bs, kp * bs:(kp + 1) * bs, :] += q * Ni_sparse.blocks
+                del R, R_blocks, R_blocks_chunk
+            del Ni_sparse
+
+        terms = [Ni_matrix]
+        if prior:
+            with timed('prior'):
+                Si_blocks = np.zeros((ncomp * bs, ncomp * bs, label_to_i_lower.shape[0]), order='F')
+                for k in range(ncomp):
+                    Si_blocks[k * bs:(k + 1) * bs, k * bs:(k + 1) * bs, :] = sympix_mg.compute_many_YDYt_blocks(
+                        self.grid, self.grid,
+                        pad_or_trunc(system.dl_list[k], lmax + 1),
+                        np.asarray(label_to_i_lower, dtype=np.int32),
+                        np.asarray(label_to_j_lower, dtype=np.int32))
+                terms.append(block_matrix.BlockMatrix(indptr, indices, Si_blocks, labels=neighmat_lower.data))
+        A_matrix = block_matrix.BlockMatrixSum(terms)
+
+        if method == 'diagonal':
+            self.diagonal_blocks = A_matrix.diagonal_blocks()
+            block_matrix.block_diagonal_factor(self.diagonal_blocks)
+        elif method == 'ichol':
+            # The incomplete factor has one block per entry in any case
+            A_factor = block_matrix.BlockMatrix(indptr, indices, A_matrix.expand())
+            with timed('block incomplete Cholesky'):
+                ridge, ncalls = block_matrix.probe_cholesky_ridging(indptr, indices, A_factor.blocks, ridge=0)
+                ridge *= ridge_margin
+                block_matrix.block_incomplete_cholesky_factor(indptr, indices, A_factor.blocks, alpha=ridge)
+            self.ridge = ridge
+            self.A_factor = A_factor
+            self.schedule = block_matrix.LevelSchedule(indptr, indices)
+        elif method == 'clusters':
+            # Expanded temporarily for the block norms and the packing of the clusters
+            A_expanded = block_matrix.BlockMatrix(indptr, indices, A_matrix.expand())
+            with timed('clustering'):
+                norms = block_matrix.compute_block_norms(A_expanded.blocks)
+                norm_matrix = csc_matrix((norms, indices, indptr))
+                self.permutation, cluster_sizes = block_matrix.csc_make_clusters(
+                    cluster_eps, norm_matrix, max_size=max_cluster_size)
+                self.cluster_offsets = np.concatenate([[0], np.cumsum(cluster_sizes)]).astype(np.int32)
+            logging.info('PixelPreconditioner: {} tiles in {} clusters, largest has {} tiles'.format(
+                indptr.shape[0] - 1, cluster_sizes.shape[0], cluster_sizes.max()))
+            with timed('cluster Cholesky'):
+                self.cluster_matrix = block_matrix.csc_to_factored_compressed_block_diagonal(
+                    A_expanded, self.cluster_offsets, self.permutation, startridge=0)
+            del A_expanded
+        else:
+            raise ValueError('Unknown method: {}'.format(method))
+
+        self.A_matrix = A_matrix if keep_matrix else None
+
+        self.method = method
+        self.system = system
+        self.mixing_version = system.mixing_version
+        self.lmax = lmax
+        self.ncomp = ncomp
         self.tilesize = tilesize
-        self.bs = tilesize**2
+        self.bs = bs
         self.plan = sharp.SymPixGridPlan(self.grid, lmax)
+        self.params = dict(tilesize=tilesize, ninv_factor=ninv_factor, prior=prior, method=method,
+                           ridge_margin=ridge_margin, cluster_eps=cluster_eps, max_cluster_size=max_cluster_size,
+                           matrix_dtype=np.dtype(matrix_dtype).name)
+
+    def is_stale(self):
+        """
+        Whether the system's mixing has changed (see `CrSystem.update_mixing`) since
+        this preconditioner was built.
+        """
+        return self.mixing_version != self.system.mixing_version
+
+    def save(self, path):
+        """
+        Save the factored tile matrix to the directory `path`; see `precond_store`.
+        The unfactored matrix kept with `keep_matrix` is not saved.
+        """
+        if self.method == 'diagonal':
+            arrays = dict(diagonal_blocks=self.diagonal_blocks)
+        elif self.method == 'ichol':
+            arrays = dict(indptr=self.A_factor.indptr, indices=self.A_factor.indices, blocks=self.A_factor.blocks,
+                          ridge=np.asarray(self.ridge))
+        else:
+            arrays = dict(cluster_offsets=self.cluster_offsets, permutation=self.permutation,
+                          cluster_matrix=self.cluster_matrix)
+        save_preconditioner(path, self, self.params, arrays)
+
+    @classmethod
+    def load(cls, system, path, mmap=True):
+        """
+        Load a preconditioner for `system` saved with `save`, memory-mapped if `mmap`.
+        """
+        params, arrays = load_preconditioner(path, cls, system, mmap=mmap)
+        self = cls.__new__(cls)
+        self.system = system
+        self.mixing_version = system.mixing_version
+        self.params = params
+        self.method = params['method']
+        self.tilesize = params['tilesize']
+        self.lmax = max(system.lmax_list)
+        self.ncomp = system.comp_count
+        self.bs = self.tilesize**2
+        self.grid = sympix.make_sympix_grid(self.lmax + 1, self.tilesize, n_start=8)
+        self.plan = sharp.SymPixGridPlan(self.grid, self.lmax)
+        self.A_matrix = None
+        if self.method == 'diagonal':
+            self.diagonal_blocks = arrays['diagonal_blocks']
+        elif self.method == 'ichol':
+            self.A_factor = block_matrix.BlockMatrix(arrays['indptr'], arrays['indices'], arrays['blocks'])
+            self.ridge = float(arrays['ridge'])
+            self.schedule = block_matrix.LevelSchedule(self.A_factor.indptr, self.A_factor.indices)
+        else:
+            self.cluster_offsets = arrays['cluster_offsets']
+            self.permutation = arrays['permutation']
+            self.cluster_matrix = arrays['cluster_matrix']
+        return self
 
     def apply(self, x_lst):
-        assert len(x_lst) == 1
-        x = x_lst[0].copy()
-        x = self.plan.synthesis(x)
-        npix = x.shape[0]
-        x = x.reshape((self.bs, x.shape[0] // self.bs), order='F')
-        block_matrix.block_diagonal_solve(self.diagonal_blocks, x)
+        system = self.system
+        assert len(x_lst) == self.ncomp
+        ntiles = self.grid.ntiles
+
+        # All components are synthesized to the grid in a single batched transform
+        alms = np.zeros((self.ncomp, (self.lmax + 1)**2))
+        for k, x in enumerate(x_lst):
+            alms[k, :] = pad_or_truncate_alm(x, self.lmax)
+        maps = self.plan.synthesis_multi(alms)
+
+        # Gather to one (ncomp * tilesize**2)-vector per tile, component-major
+        x = maps.reshape(self.ncomp, ntiles, self.bs).transpose(1, 0, 2).copy()
+        x = x.reshape(ntiles, self.ncomp * self.bs).T
+        self.solve_tiles(x)
         assert not np.any(np.isnan(x))
-        x = x.reshape(npix, order='F')
-        x = self.plan.adjoint_synthesis(x)
-        return [x]
+        maps = x.T.reshape(ntiles, self.ncomp, self.bs).transpose(1, 0, 2).reshape(self.ncomp, -1).copy()
+
+        alms = self.plan.adjoint_synthesis_multi(maps)
+        return [pad_or_truncate_alm(alms[k, :], system.lmax_list[k]) for k in range(self.ncomp)]
+
+    def solve_tiles(self, x):
+        """
+        Solve in-place with the tile-sparse approximation of the system;
+        x has shape (ncomp * tilesize**2, ntiles) in Fortran order.
+        """
+        if self.method == 'diagonal':
+            block_matrix.block_diagonal_solve(self.diagonal_blocks, x)
+        elif self.method == 'clusters':
+            block_matrix.csc_compressed_block_diagonal_solve(
+                self.cluster_offsets, self.permutation, self.cluster_matrix, x.reshape(-1, order='F'))
+        else:
+            L = self.A_factor
+            block_matrix.block_triangular_solve_levels('N', L.indptr, L.indices, L.blocks, self.schedule, x)
+            block_matrix.block_triangular_solve_levels('T', L.indptr, L.indices, L.blocks, self.schedule, x)
+
+    def tile_matvec(self, x):
+        """
+        Multiply with the tile-sparse approximation of the system, with x in the same
+        layout as for `solve_tiles`. Requires keep_matrix=True.
+        """
+        return self.A_matrix.matvec(x, mirror=True)
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import healpy
 from .utils import pad_or_truncate_alm, timed, pad_or_trunc
@@ -8,6 +9,7 @@ from cmbcr.healpix import nside_of
 from .precond_pseudoinv_mod import compsep_apply_U_block_diagonal, compsep_assemble_U
 from .beams import fourth_order_beam
 from .block_matrix import block_diagonal_factor, block_diagonal_solve
+from .precond_store import save_preconditioner, load_preconditioner
 
 
 def pinv_block_diagonal(blocks):
@@ -48,14 +50,18 @@ def apply_block_diagonal_pinv_transpose(system, blocks, x):
         result.append(pad_x[:, i].astype(np.float64))
     return result
 
-def create_mixing_matrix(system, lmax, alpha_lst):
+def create_mixing_matrix(system, lmax, alpha_lst, dl_list=None, wl_list=None):
+    # dl_list and wl_list default to those of the system
+    dl_list = system.dl_list if dl_list is None else dl_list
+    wl_list = system.wl_list if wl_list is None else wl_list
+
     bl_arr = np.zeros((system.band_count, lmax + 1), order='F')
     wl_arr = np.zeros((system.comp_count, lmax + 1), order='F')
     dl_arr = np.zeros((system.comp_count, lmax + 1), order='F')
 
     for k in range(system.comp_count):
-        wl_arr[k, :] = pad_or_trunc(system.wl_list[k], lmax + 1)
-        dl_arr[k, :] = pad_or_trunc(np.sqrt(system.dl_list[k]) * system.wl_list[k], lmax + 1)
+        wl_arr[k, :] = pad_or_trunc(wl_list[k], lmax + 1)
+        dl_arr[k, :] = pad_or_trunc(np.sqrt(dl_list[k]) * wl_list[k], lmax + 1)
         
     for nu in range(system.band_count):
         bl_arr[nu, :] = pad_or_trunc(system.bl_list[nu], lmax + 1)
@@ -89,6 +95,7 @@ class PseudoInversePreconditioner(object):
 
     def __init__(self, system):
         self.system = system
+        self.mixing_version = system.mixing_version
 
         lmax = max(system.lmax_list)
 
@@ -108,9 +115,6 @@ class PseudoInversePreconditioner(object):
             alpha = np.sqrt((ninv_gauss_no_w**2).sum() / ninv_gauss_no_w.sum())
             self.alpha_lst.append(1 * alpha)
 
-        self.U = create_mixing_matrix(system, lmax, self.alpha_lst)
-        self.Uplus = pinv_block_diagonal(self.U)
-
         def make_inv_map(x):
             return 1 / x
 
@@ -119,6 +123,23 @@ class PseudoInversePreconditioner(object):
         else:
             self.inv_inv_maps = [make_inv_map(x) for x in system.ninv_gauss_lst]
 
+        self.update_prior(system.dl_list, system.wl_list)
+
+    def is_stale(self):
+        """
+        Whether the system's mixing has changed (see `CrSystem.update_mixing`) since
+        this preconditioner was built.
+        """
+        return self.mixing_version != self.system.mixing_version
+
+    def update_prior(self, dl_list, wl_list):
+        """
+        Recomputes the mixing matrix and its pseudo-inverse for a new prior; the noise
+        normalization and inverse noise maps are kept.
+        """
+        self.U = create_mixing_matrix(self.system, self.lmax, self.alpha_lst, dl_list, wl_list)
+        self.Uplus = pinv_block_diagonal(self.U)
+
     def apply(self, x_lst):
         #x_lst = lstscale(1/10., x_lst)
         x_lst = apply_block_diagonal_pinv_transpose(self.system, self.Uplus, x_lst)
@@ -129,6 +150,30 @@ class PseudoInversePreconditioner(object):
         x_lst = apply_block_diagonal_pinv(self.system, self.Uplus, c_h)
         return x_lst
             
+    def save(self, path):
+        """
+        Save the preconditioner to the directory `path`; see `precond_store`.
+        """
+        save_preconditioner(path, self, {}, dict(
+            alpha=np.asarray(self.alpha_lst), inv_inv_maps=self.inv_inv_maps, U=self.U, Uplus=self.Uplus))
+
+    @classmethod
+    def load(cls, system, path, mmap=True):
+        """
+        Load a preconditioner for `system` saved with `save`, memory-mapped if `mmap`.
+        """
+        params, arrays = load_preconditioner(path, cls, system, mmap=mmap)
+        self = cls.__new__(cls)
+        self.system = system
+        self.mixing_version = system.mixing_version
+        self.lmax = max(system.lmax_list)
+        self.plan = sharp.RealMmajorGaussPlan(system.lmax_ninv, self.lmax)
+        self.alpha_lst = list(arrays['alpha'])
+        self.inv_inv_maps = arrays['inv_inv_maps']
+        self.U = arrays['U']
+        self.Uplus = arrays['Uplus']
+        return self
+
     def inverse_noise_map(self, nu, u):
         u *= self.alpha_lst[nu]
         if self.system.use_healpix:
@@ -144,51 +189,66 @@ class PseudoInversePreconditioner(object):
         return u
 
     
+DIAGONAL2_CHUNK = 16384
+
+
 class DiagonalPreconditioner2(object):
     def __init__(self, system):
         from .precond_diag import compute_Yh_D_Y_diagonal
         from .mblocks import gauss_ring_map_to_phase_map
 
         self.system = system
+        self.mixing_version = system.mixing_version
 
         lmax = max(self.system.lmax_list)
+        self.lmax = lmax
 
-        U = create_mixing_matrix(system, lmax, [1.] * system.band_count)
-        
         Ni_diag_lst = []
         for nu in range(self.system.band_count):
             print 'compute_Yh_D_Y_diagonal for ', nu
             ninv_phase, thetas = gauss_ring_map_to_phase_map(system.ninv_gauss_lst[nu], system.lmax_ninv, lmax)
             Ni_diag_lst.append(compute_Yh_D_Y_diagonal(lmax, ninv_phase, thetas))
 
-        blocks = np.zeros((self.system.comp_count, self.system.comp_count, (lmax + 1)**2), order='F')
-        idx = 0
-        for m in range(lmax + 1):
-            print 'Precond construction, m=', m
-            for l in range(m, lmax + 1):
-                for neg in range(2):
-                    if m == 0 and neg == 1:
-                        continue
-
-                    U_block = U[:, :, l].copy()
-                    for nu in range(self.system.band_count):
-                        U_block[nu, :] *= np.sqrt(Ni_diag_lst[nu][idx])
-
-                    blocks[:, :, idx] = np.dot(U_block.T, U_block)
-                    for k in range(self.system.comp_count):
-                        # if l is larger than lmax_list[k], then the corresponding rows/columns
-                        # in U_block will be zero. In this case just insert 1 so that the system can
-                        # be inverted. The resulting coefficients in the inverted blocks will not be
-                        # used anyway (due to padding/truncation)
-                        if blocks[k, k, idx] == 0:
-                            blocks[k, k, idx] = 1
-                    idx += 1
-        assert idx == (lmax + 1)**2
+        # Weights of the rows of the mixing matrix for each coefficient: the noise diagonal
+        # for the band rows, 1 for the prior rows
+        self.row_weights = np.ones((self.system.band_count + self.system.comp_count, (lmax + 1)**2))
+        for nu in range(self.system.band_count):
+            self.row_weights[nu, :] = Ni_diag_lst[nu]
+        self.l_by_idx = scatter_l_to_lm(np.arange(lmax + 1, dtype=np.double)).astype(int)
+
+        self.update_prior(system.dl_list, system.wl_list)
+
+    def is_stale(self):
+        """
+        Whether the system's mixing has changed (see `CrSystem.update_mixing`) since
+        this preconditioner was built.
+        """
+        return self.mixing_version != self.system.mixing_version
+
+    def update_prior(self, dl_list, wl_list):
+        """
+        Reassembles and refactors the blocks for a new prior, reusing the noise diagonal.
+        """
+        U = create_mixing_matrix(self.system, self.lmax, [1.] * self.system.band_count, dl_list, wl_list)
+
+        # blocks[:, :, idx] = U_l^T diag(row_weights[:, idx]) U_l, with l the l of coefficient idx;
+        # done in chunks of coefficients to bound the size of the temporaries
+        ncoefs = (self.lmax + 1)**2
+        blocks = np.zeros((self.system.comp_count, self.system.comp_count, ncoefs), order='F')
+        for start in range(0, ncoefs, DIAGONAL2_CHUNK):
+            stop = min(start + DIAGONAL2_CHUNK, ncoefs)
+            U_by_idx = U[:, :, self.l_by_idx[start:stop]]
+            blocks[:, :, start:stop] = np.einsum(
+                'rki,ri,rji->kji', U_by_idx, self.row_weights[:, start:stop], U_by_idx)
+        for k in range(self.system.comp_count):
+            # if l is larger than lmax_list[k], then the corresponding rows/columns
+            # in U_block will be zero. In this case just insert 1 so that the system can
+            # be inverted. The resulting coefficients in the inverted blocks will not be
+            # used anyway (due to padding/truncation)
+            diag = blocks[k, k, :]
+            diag[diag == 0] = 1
         block_diagonal_factor(blocks)
         self.blocks = blocks
-        self.lmax = lmax
-
-        
 
     def apply(self, x_lst):
         comp_count = self.system.comp_count
@@ -204,14 +264,38 @@ class DiagonalPreconditioner2(object):
             result[k] = pad_or_truncate_alm(buf[k, :], self.system.lmax_list[k])
 
         return result
+
+    def save(self, path):
+        """
+        Save the preconditioner to the directory `path`; see `precond_store`.
+        """
+        save_preconditioner(path, self, {}, dict(row_weights=self.row_weights, blocks=self.blocks))
+
+    @classmethod
+    def load(cls, system, path, mmap=True):
+        """
+        Load a preconditioner for `system` saved with `save`, memory-mapped if `mmap`.
+        """
+        params, arrays = load_preconditioner(path, cls, system, mmap=mmap)
+        self = cls.__new__(cls)
+        self.system = system
+        self.mixing_version = system.mixing_version
+        self.lmax = max(system.lmax_list)
+        self.l_by_idx = scatter_l_to_lm(np.arange(self.lmax + 1, dtype=np.double)).astype(int)
+        self.row_weights = arrays['row_weights']
+        self.blocks = arrays['blocks']
+        return self
         
         
         
     
 
 class PseudoInverseWithMaskPreconditioner(object):
-    def __init__(self, system, flatsky=False, inner_its=5):
+    def __init__(self, system, flatsky=False, inner_its=5, hole_decomposition=False):
         self.pseudo_inv = PseudoInversePreconditioner(system)
+        self.init_mask_solvers(system, flatsky, inner_its, hole_decomposition)
+
+    def init_mask_solvers(self, system, flatsky, inner_its, hole_decomposition, hierarchy=None, dense_chos=None):
         self.system = system
 
         self.rl_list = [
@@ -220,17 +304,79 @@ class PseudoInverseWithMaskPreconditioner(object):
         ]
         self.inner_its = inner_its
 
+        self.flatsky = flatsky
+        self.hole_decomposition = hole_decomposition
+        self.multi_sinv_solver = None
+        self.sinv_solvers = []
+
         if self.system.mask is not None:
-            if flatsky:
-                from .masked_solver_fft import SinvSolver
+            if hole_decomposition and not flatsky:
+                # holes solved for independently; see HoleDecomposedSinvSolver
+                from .masked_solver import HoleDecomposedSinvSolver
+                self.sinv_solvers = [
+                    HoleDecomposedSinvSolver(system.dl_list[k] * self.rl_list[k]**2, system.mask_dg)
+                    for k in range(self.system.comp_count)
+                    ]
+            elif flatsky:
+                from .masked_solver_fft import MultiPatchSinvSolver
                 mask = system.mask_gauss_grid
+                self.sinv_solvers = [
+                    MultiPatchSinvSolver(system.dl_list[k] * self.rl_list[k]**2, mask)
+                    for k in range(self.system.comp_count)
+                    ]
             else:
-                from .masked_solver import SinvSolver
-                mask = system.mask_dg
-            self.sinv_solvers = [
-                SinvSolver(system.dl_list[k] * self.rl_list[k]**2, mask)
-                for k in range(self.system.comp_count)
-                ]
+                # all components share the mask hierarchy, and are solved for together
+                from .masked_solver import MultiSinvSolver
+                self.multi_sinv_solver = MultiSinvSolver(
+                    [system.dl_list[k] * self.rl_list[k]**2 for k in range(self.system.comp_count)],
+                    system.mask_dg, hierarchy=hierarchy, dense_chos=dense_chos)
+                self.sinv_solvers = self.multi_sinv_solver.solvers
+
+    def is_stale(self):
+        return self.pseudo_inv.is_stale()
+
+    def close(self):
+        # the hole-decomposed and multi-patch solvers keep thread pools
+        for solver in self.sinv_solvers:
+            if hasattr(solver, 'close'):
+                solver.close()
+
+    def save(self, path):
+        """
+        Save the preconditioner to the directory `path`, with the pseudo-inverse part
+        in a sub-directory; see `precond_store`. Of the masked solvers, the masks of
+        the multigrid levels and the factors of the coarsest levels are saved; this is
+        not supported with `flatsky` or `hole_decomposition`.
+        """
+        if self.flatsky or (self.hole_decomposition and self.system.mask is not None):
+            raise NotImplementedError('Saving is only supported for the spherical multigrid masked solver')
+        self.pseudo_inv.save(os.path.join(path, 'pseudo_inv'))
+        arrays = {}
+        if self.multi_sinv_solver is not None:
+            arrays['hierarchy_masks'] = self.multi_sinv_solver.hierarchy_masks()
+            arrays['dense_factors'] = [c for c, lower in self.multi_sinv_solver.dense_factors()]
+        params = dict(inner_its=self.inner_its, hole_decomposition=self.hole_decomposition)
+        save_preconditioner(path, self, params, arrays)
+
+    @classmethod
+    def load(cls, system, path, mmap=True):
+        """
+        Load a preconditioner for `system` saved with `save`, memory-mapped if `mmap`.
+        The masked solvers are rebuilt on the saved levels, using the saved factors of
+        the coarsest levels.
+        """
+        from .masked_solver import hierarchy_from_masks
+
+        params, arrays = load_preconditioner(path, cls, system, mmap=mmap)
+        self = cls.__new__(cls)
+        self.pseudo_inv = PseudoInversePreconditioner.load(system, os.path.join(path, 'pseudo_inv'), mmap=mmap)
+        hierarchy = dense_chos = None
+        if 'hierarchy_masks' in arrays:
+            hierarchy = hierarchy_from_masks(arrays['hierarchy_masks'])
+            dense_chos = [(c, True) for c in arrays['dense_factors']]
+        self.init_mask_solvers(system, False, params['inner_its'], params['hole_decomposition'],
+                               hierarchy=hierarchy, dense_chos=dense_chos)
+        return self
 
     def solve_component_under_mask(self, k, x):
         sinv_solver = self.sinv_solvers[k]
@@ -242,12 +388,30 @@ class PseudoInverseWithMaskPreconditioner(object):
         x = sinv_solver.prolong(x_pix) * scatter_l_to_lm(self.rl_list[k])
         return x
 
+    def solve_under_mask(self, b_lst):
+        solver = self.multi_sinv_solver
+        x_pix = solver.restrict([b_lst[k] * scatter_l_to_lm(self.rl_list[k]) for k in range(self.system.comp_count)])
+        if self.inner_its == 0:
+            x_pix = solver.precond(x_pix)
+        else:
+            x_pix = np.array([
+                solver.solvers[k].solve_mask(x_pix[k], rtol=1e-2, maxit=self.inner_its)[0]
+                for k in range(self.system.comp_count)])
+        x_lm = solver.prolong(x_pix)
+        return [
+            pad_or_truncate_alm(x_lm[k], self.system.lmax_list[k]) * scatter_l_to_lm(self.rl_list[k])
+            for k in range(self.system.comp_count)
+        ]
+
     def apply(self, b_lst):
         x = self.pseudo_inv.apply(b_lst)
         if self.system.mask is not None:
-            x_under_mask = [
-                self.solve_component_under_mask(k, b_lst[k])
-                for k in range(self.system.comp_count)
-            ]
+            if self.multi_sinv_solver is None:
+                x_under_mask = [
+                    self.solve_component_under_mask(k, b_lst[k])
+                    for k in range(self.system.comp_count)
+                ]
+            else:
+                x_under_mask = self.solve_under_mask(b_lst)
             x = lstadd(x, x_under_mask)
         return x
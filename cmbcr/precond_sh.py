@@ -1,26 +1,33 @@
+import os
+import logging
 import numpy as np
+import scipy.linalg
+from multiprocessing.pool import ThreadPool
 
 from .mblocks import gauss_ring_map_to_phase_map
+from .harmonic_preconditioner import compute_real_Yh_D_Y_block_on_diagonal
 from .harmonic_preconditioner import factor_banded_preconditioner
 from .harmonic_preconditioner import solve_banded_preconditioner
 from .harmonic_preconditioner import construct_banded_preconditioner
 from .harmonic_preconditioner import k_kp_idx
-from .utils import pad_or_trunc, timed, pad_or_truncate_alm, scatter_l_to_lm
+from .utils import pad_or_trunc, timed, pad_or_truncate_alm, scatter_l_to_lm, ridged_cho_factor
 from .cache import memory
+from .precond_store import save_preconditioner, load_preconditioner
 
-__all__ = ['BandedHarmonicPreconditioner']
+__all__ = ['BandedHarmonicPreconditioner', 'HybridHarmonicPreconditioner']
 
 @memory.cache
-def compute_banded_preconditioner(self, couplings, diagonal, factor):
+def compute_banded_noise_term(self, couplings, mmin=0):
+    """
+    The banded representation of the prior-independent part of the system,
+    sum_nu B Y^T N_nu^{-1} Y B (with mixing scalars), unfactored. Only the m-blocks
+    m >= mmin are computed; the rest are left zero.
+    """
     system = self.system
     lmax = max(system.lmax_list)
 
     precond_data = np.zeros((5 * system.comp_count, system.comp_count * (lmax + 1)**2), dtype=np.float32, order='F')
-    Ni_diag = 0
-
     dl = np.zeros((lmax + 1, system.comp_count), order='F')
-    for k in range(system.comp_count):
-        dl[:, k] += pad_or_trunc(system.dl_list[k], lmax + 1)
 
     for nu in range(system.band_count):
 
@@ -46,28 +53,72 @@ def compute_banded_preconditioner(self, couplings, diagonal, factor):
                 dl=dl,
                 phase_map=ninv_phase_maps,
                 #mixing_scalars=system.mixing_scalars[nu, :].copy(),
-                out=precond_data)
-        # Only add dl in first iteration
-        dl *= 0
+                out=precond_data,
+                mmin=mmin)
 
-    # prior
-    ##precond_data[0, :] += 1
-            
-    if diagonal:
-        precond_data[1:, :] = 0
+    return precond_data
 
-    if factor:
-        factor_banded_preconditioner(lmax, system.comp_count, precond_data)
 
-    return precond_data
+def banded_column_l(lmax):
+    """
+    The l of each block column of the banded representation used by
+    construct_banded_preconditioner (each column holding one coefficient per component).
+    """
+    ls = []
+    for m in range(lmax + 1):
+        for neg in range(2):
+            if m == 0 and neg == 1:
+                continue
+            for odd in range(2):
+                ls.append(np.arange(m + odd, lmax + 1, 2))
+    return np.concatenate(ls)
 
 
 class BandedHarmonicPreconditioner(object):
-    def __init__(self, system, diagonal=False, couplings=True, factor=True):
+    """
+    Block-banded approximation of the system in each m-block. With `mmin`, only
+    the m-blocks m >= mmin are built, factored and solved for; `apply` then leaves
+    the coefficients with m < mmin as they are.
+    """
+    def __init__(self, system, diagonal=False, couplings=True, factor=True, mmin=0):
         self.system = system
+        self.mixing_version = system.mixing_version
         self.lmax = max(system.lmax_list)
-        self.data = compute_banded_preconditioner(self, couplings, diagonal, factor)
+        self.diagonal = diagonal
+        self.couplings = couplings
+        self.factor = factor
+        self.mmin = mmin
+        self.noise_data = compute_banded_noise_term(self, couplings, mmin)
+        self.column_l = banded_column_l(self.lmax)
+        self.update_prior(system.dl_list, system.wl_list)
+
+    def is_stale(self):
+        """
+        Whether the system's mixing has changed (see `CrSystem.update_mixing`) since
+        this preconditioner was built.
+        """
+        return self.mixing_version != self.system.mixing_version
+
+    def update_prior(self, dl_list, wl_list):
+        """
+        Recomputes the preconditioner for a new prior, reusing the noise term;
+        only adds the prior to the diagonal and refactors. `wl_list` is not used
+        by this preconditioner.
+        """
+        dl = np.zeros((self.lmax + 1, self.system.comp_count))
+        for k in range(self.system.comp_count):
+            dl[:, k] = pad_or_trunc(dl_list[k], self.lmax + 1)
+
+        data = self.noise_data.copy('F')
+        data[0, :] += dl[self.column_l, :].ravel()
+
+        if self.diagonal:
+            data[1:, :] = 0
 
+        if self.factor:
+            factor_banded_preconditioner(self.lmax, self.system.comp_count, data, mmin=self.mmin)
+
+        self.data = data
 
     def apply(self, x_lst):
         comp_count = self.system.comp_count
@@ -76,10 +127,234 @@ class BandedHarmonicPreconditioner(object):
         for k in range(comp_count):
             buf[:, k] = pad_or_truncate_alm(x_lst[k], self.lmax)
 
-        buf = solve_banded_preconditioner(self.lmax, comp_count, self.data, buf)
+        buf = solve_banded_preconditioner(self.lmax, comp_count, self.data, buf, mmin=self.mmin)
 
         result = [None] * comp_count
         for k in range(comp_count):
             result[k] = pad_or_truncate_alm(buf[:, k], self.system.lmax_list[k]).astype(np.double)
 
         return result
+
+    def save(self, path):
+        """
+        Save the preconditioner to the directory `path`; see `precond_store`.
+        """
+        params = dict(diagonal=self.diagonal, couplings=self.couplings, factor=self.factor, mmin=self.mmin)
+        save_preconditioner(path, self, params, dict(noise_data=self.noise_data, data=self.data))
+
+    @classmethod
+    def load(cls, system, path, mmap=True):
+        """
+        Load a preconditioner for `system` saved with `save`, memory-mapped if `mmap`.
+        """
+        params, arrays = load_preconditioner(path, cls, system, mmap=mmap)
+        self = cls.__new__(cls)
+        self.system = system
+        self.mixing_version = system.mixing_version
+        self.lmax = max(system.lmax_list)
+        self.diagonal = params['diagonal']
+        self.couplings = params['couplings']
+        self.factor = params['factor']
+        self.mmin = params['mmin']
+        self.column_l = banded_column_l(self.lmax)
+        self.noise_data = arrays['noise_data']
+        self.data = arrays['data']
+        return self
+
+
+# Default memory budget for the dense m-blocks of HybridHarmonicPreconditioner
+DEFAULT_DENSE_MEMORY = 1024**3
+
+
+def m_block_length(lmax, m):
+    return (lmax + 1 - m) if m == 0 else 2 * (lmax + 1 - m)
+
+
+def m_block_offsets(lmax, mmax):
+    """
+    Offsets of the m-blocks m = 0..mmax in a real m-major vector of the given lmax.
+    """
+    return np.concatenate([[0], np.cumsum([m_block_length(lmax, m) for m in range(mmax + 1)], dtype=np.int64)])
+
+
+def choose_dense_mmax(lmax, ncomp, max_bytes):
+    """
+    The number of m-blocks, starting at m=0, whose dense noise term and Cholesky factor
+    (in double precision, coupling all components) fit in `max_bytes`.
+    """
+    nbytes = 0
+    for m in range(lmax + 1):
+        nbytes += 2 * 8 * (ncomp * m_block_length(lmax, m))**2
+        if nbytes > max_bytes:
+            return m
+    return lmax + 1
+
+
+def m_block_l(lmax, m):
+    # the l of each row of a real m-block; for m > 0, cos and sin parts are interleaved
+    return m + np.arange(m_block_length(lmax, m)) // (1 if m == 0 else 2)
+
+
+@memory.cache(ignore=['nthreads'])
+def compute_dense_noise_blocks(ninv_gauss_lst, lmax_ninv, lmax, bl_list, mixing_scalars, mcount, nthreads=8):
+    """
+    The dense m-blocks m = 0..mcount-1 of the prior-independent part of the system,
+    sum_nu B Y^T N_nu^{-1} Y B (with mixing scalars), coupling all components. Each
+    block has shape (ncomp * nl, ncomp * nl), with the coefficients of component k
+    in rows k * nl:(k + 1) * nl. The arguments are the corresponding attributes of
+    the system, and only those are part of the cache key; `nthreads` is not.
+    """
+    ncomp = mixing_scalars.shape[1]
+
+    phase_maps = []
+    for nu in range(len(ninv_gauss_lst)):
+        ninv_phase, thetas = gauss_ring_map_to_phase_map(ninv_gauss_lst[nu], lmax_ninv, lmax)
+        phase_maps.append((np.asfortranarray(ninv_phase), np.asfortranarray(thetas, dtype=np.double)))
+
+    def compute_block(m):
+        nl = m_block_length(lmax, m)
+        ls = m_block_l(lmax, m)
+        out = np.zeros((ncomp, nl, ncomp, nl))
+        for nu, (ninv_phase, thetas) in enumerate(phase_maps):
+            block = compute_real_Yh_D_Y_block_on_diagonal(m, lmax, thetas, ninv_phase)
+            bl = bl_list[nu][ls]
+            block *= bl[:, None] * bl[None, :]
+            scalars = mixing_scalars[nu, :]
+            out += (scalars[:, None] * scalars[None, :])[:, None, :, None] * block[None, :, None, :]
+        return out.reshape(ncomp * nl, ncomp * nl)
+
+    # the block computation releases the GIL; take the largest (low m) blocks first
+    pool = ThreadPool(nthreads)
+    try:
+        with timed('dense m-blocks, m < {}'.format(mcount)):
+            blocks = pool.map(compute_block, range(mcount), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return blocks
+
+
+class HybridHarmonicPreconditioner(object):
+    """
+    Like `BandedHarmonicPreconditioner`, but with the m-blocks for m < `mmax_dense`
+    stored dense and Cholesky factored, coupling all l, cos/sin parts and components
+    within the block. The banded approximation is poor at low m, where the noise
+    anisotropy couples distant l, while the dense blocks there are the largest; by
+    default `mmax_dense` is chosen so that the dense blocks fit in `max_dense_bytes`.
+
+    The dense blocks are computed, factored and solved on `nthreads` threads.
+    """
+    def __init__(self, system, mmax_dense=None, max_dense_bytes=DEFAULT_DENSE_MEMORY, couplings=True,
+                 nthreads=8):
+        self.system = system
+        self.mixing_version = system.mixing_version
+        self.lmax = max(system.lmax_list)
+        self.nthreads = nthreads
+        if mmax_dense is None:
+            mmax_dense = choose_dense_mmax(self.lmax, system.comp_count, max_dense_bytes)
+        self.mmax_dense = min(mmax_dense, self.lmax + 1)
+        self.dense_offsets = m_block_offsets(self.lmax, self.mmax_dense - 1)
+        self.dense_noise_blocks = compute_dense_noise_blocks(
+            system.ninv_gauss_lst, system.lmax_ninv, self.lmax,
+            [bl[:self.lmax + 1] for bl in system.bl_list], system.mixing_scalars,
+            self.mmax_dense, nthreads=nthreads)
+        self.pool = None
+        # the dense blocks replace the banded ones for m < mmax_dense, so the banded
+        # matrix is only built for the m-blocks above
+        self.couplings = couplings
+        self.banded = BandedHarmonicPreconditioner(system, couplings=couplings, mmin=self.mmax_dense)
+        self.factor_dense_blocks(system.dl_list)
+
+    def is_stale(self):
+        """
+        Whether the system's mixing has changed (see `CrSystem.update_mixing`) since
+        this preconditioner was built.
+        """
+        return self.mixing_version != self.system.mixing_version
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(self.nthreads)
+        return self.pool
+
+    def update_prior(self, dl_list, wl_list):
+        """
+        Recomputes the preconditioner for a new prior, reusing the noise terms; only
+        adds the prior to the diagonal and refactors. `wl_list` is not used.
+        """
+        self.banded.update_prior(dl_list, wl_list)
+        self.factor_dense_blocks(dl_list)
+
+    def factor_dense_blocks(self, dl_list):
+        ncomp = self.system.comp_count
+        dl = np.zeros((self.lmax + 1, ncomp))
+        for k in range(ncomp):
+            dl[:, k] = pad_or_trunc(dl_list[k], self.lmax + 1)
+
+        def factor_block(m):
+            block = self.dense_noise_blocks[m].copy()
+            block[np.diag_indices_from(block)] += dl[m_block_l(self.lmax, m), :].T.ravel()
+            cho, ridge = ridged_cho_factor(block)
+            if ridge != 0:
+                logging.warning('Dense m-block {} needed a ridge of {:.2e}'.format(m, ridge))
+            return cho
+
+        with timed('factor dense m-blocks'):
+            self.dense_chos = self.get_pool().map(factor_block, range(self.mmax_dense), chunksize=1)
+
+    def apply(self, x_lst):
+        ncomp = self.system.comp_count
+        x = np.empty(((self.lmax + 1)**2, ncomp))
+        for k in range(ncomp):
+            x[:, k] = pad_or_truncate_alm(x_lst[k], self.lmax)
+
+        y = solve_banded_preconditioner(self.lmax, ncomp, self.banded.data, x.astype(np.float32, order='F'),
+                                        mmin=self.mmax_dense)
+        y = y.astype(np.double)
+
+        def solve_block(m):
+            start, stop = self.dense_offsets[m], self.dense_offsets[m + 1]
+            # all components of the block are solved for together
+            rhs = x[start:stop, :].T.ravel()
+            y[start:stop, :] = scipy.linalg.cho_solve(self.dense_chos[m], rhs).reshape(ncomp, stop - start).T
+
+        self.get_pool().map(solve_block, range(self.mmax_dense), chunksize=1)
+
+        return [pad_or_truncate_alm(y[:, k], self.system.lmax_list[k]) for k in range(ncomp)]
+
+    def save(self, path):
+        """
+        Save the preconditioner to the directory `path`, with the banded part in a
+        sub-directory; see `precond_store`.
+        """
+        self.banded.save(os.path.join(path, 'banded'))
+        params = dict(mmax_dense=self.mmax_dense, couplings=self.couplings)
+        save_preconditioner(path, self, params, dict(
+            dense_noise_blocks=self.dense_noise_blocks,
+            dense_factors=[c for c, lower in self.dense_chos]))
+
+    @classmethod
+    def load(cls, system, path, mmap=True, nthreads=8):
+        """
+        Load a preconditioner for `system` saved with `save`, memory-mapped if `mmap`.
+        """
+        params, arrays = load_preconditioner(path, cls, system, mmap=mmap)
+        self = cls.__new__(cls)
+        self.system = system
+        self.mixing_version = system.mixing_version
+        self.lmax = max(system.lmax_list)
+        self.nthreads = nthreads
+        self.mmax_dense = params['mmax_dense']
+        self.couplings = params['couplings']
+        self.dense_offsets = m_block_offsets(self.lmax, self.mmax_dense - 1)
+        self.dense_noise_blocks = arrays['dense_noise_blocks']
+        self.dense_chos = [(c, True) for c in arrays['dense_factors']]
+        self.pool = None
+        self.banded = BandedHarmonicPreconditioner.load(system, os.path.join(path, 'banded'), mmap=mmap)
+        return self
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,134 @@
+"""
+Saving and loading the factored data of the preconditioners, so that it is computed
+once and then shared between processes: arrays are loaded memory-mapped, so the pages
+of one factorization are shared through the page cache by all processes on a node.
+
+A saved preconditioner is a directory with:
+
+    meta.yaml          class name, parameters, fingerprint and the names of the arrays
+    {name}.npy         one file per array
+    {name}.{i}.npy     lists of arrays are stored one file per element
+    {name}/            preconditioners that are part of this one, in the same format
+
+The fingerprint is a hash of the system (see `system_fingerprint`), the class name
+and the parameters; loading checks it against the system passed in, so that a
+preconditioner is never used with a system other than the one it was built for.
+"""
+import os
+import hashlib
+import yaml
+import numpy as np
+
+from .utils import makedirs
+
+__all__ = ['system_fingerprint', 'PreconditionerMismatch']
+
+FORMAT_VERSION = 1
+
+
+class PreconditionerMismatch(ValueError):
+    pass
+
+
+def _hash_update(h, x):
+    if isinstance(x, np.ndarray):
+        h.update(repr((x.dtype.str, x.shape)).encode('utf-8'))
+        h.update(np.ascontiguousarray(x).view(np.uint8))
+    elif isinstance(x, (list, tuple)):
+        h.update(repr((type(x).__name__, len(x))).encode('utf-8'))
+        for y in x:
+            _hash_update(h, y)
+    else:
+        h.update(repr(x).encode('utf-8'))
+
+
+def system_fingerprint(system):
+    """
+    A hash of everything about a prepared system that the preconditioners depend on:
+    resolution parameters, beams, mixing scalars, prior, inverse noise maps and mask.
+    The inverse noise maps are the ones used by `matvec`, which are kept by
+    `CrSystem.release_intermediates`, and are hashed in double precision.
+    """
+    ninv_lst = system.ninv_maps if system.use_healpix else system.ninv_gauss_lst
+    h = hashlib.sha1()
+    for x in [
+            system.lmax_list, system.lmax_ninv, system.lmax_mixed, tuple(system.rot_ang),
+            system.use_healpix, system.mixing_nside, system.mixing_scalars, system.bl_list,
+            system.dl_list, system.wl_list, system.mask]:
+        _hash_update(h, x)
+    for ninv in ninv_lst:
+        _hash_update(h, np.asarray(ninv, dtype=np.double))
+    return h.hexdigest()
+
+
+def precond_fingerprint(cls, system, params):
+    h = hashlib.sha1()
+    _hash_update(h, (FORMAT_VERSION, cls.__name__, sorted(params.items()), system_fingerprint(system)))
+    return h.hexdigest()
+
+
+def _save_array(filename, arr):
+    # write to a temporary file and rename, so that concurrent readers never see partial
+    # files; unlike map_store we keep Fortran order, which the factored data relies on
+    tmp_filename = '{}.tmp{}.npy'.format(filename[:-len('.npy')], os.getpid())
+    np.save(tmp_filename, np.asanyarray(arr))
+    os.rename(tmp_filename, filename)
+
+
+def save_preconditioner(path, precond, params, arrays):
+    """
+    Write the arrays of `precond` (a dict of arrays and lists of arrays) to the
+    directory `path`. `params` are the constructor parameters the arrays depend
+    on, and must be plain int, float, bool or str values.
+    """
+    makedirs(path)
+    array_names = {}
+    for name, x in arrays.items():
+        if isinstance(x, (list, tuple)):
+            array_names[name] = len(x)
+            for i, y in enumerate(x):
+                _save_array(os.path.join(path, '{}.{}.npy'.format(name, i)), y)
+        else:
+            array_names[name] = None
+            _save_array(os.path.join(path, '{}.npy'.format(name)), x)
+    meta = dict(
+        format_version=FORMAT_VERSION,
+        cls=type(precond).__name__,
+        params=params,
+        fingerprint=precond_fingerprint(type(precond), precond.system, params),
+        arrays=array_names)
+    # meta.yaml is written last; a directory without it is never loaded
+    meta_filename = os.path.join(path, 'meta.yaml')
+    with open(meta_filename + '.tmp', 'w') as f:
+        yaml.safe_dump(meta, f, default_flow_style=False)
+    os.rename(meta_filename + '.tmp', meta_filename)
+
+
+def load_preconditioner(path, cls, system, mmap=True):
+    """
+    Returns (params, arrays) as saved by `save_preconditioner`, after checking that
+    they were saved by `cls` for the same system. With `mmap`, the arrays are
+    memory-mapped copy-on-write, so that they can be passed to the Cython routines
+    while sharing pages with other processes as long as they are not written to.
+    """
+    meta_filename = os.path.join(path, 'meta.yaml')
+    if not os.path.exists(meta_filename):
+        raise IOError('No saved preconditioner in {}'.format(path))
+    with open(meta_filename) as f:
+        meta = yaml.safe_load(f)
+    if meta['format_version'] != FORMAT_VERSION or meta['cls'] != cls.__name__:
+        raise PreconditionerMismatch('{} holds a {} (format {}), expected a {}'.format(
+            path, meta['cls'], meta['format_version'], cls.__name__))
+    params = meta['params']
+    if meta['fingerprint'] != precond_fingerprint(cls, system, params):
+        raise PreconditionerMismatch('{} was saved for a different system'.format(path))
+
+    mmap_mode = 'c' if mmap else None
+    arrays = {}
+    for name, count in meta['arrays'].items():
+        if count is None:
+            arrays[name] = np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode=mmap_mode)
+        else:
+            arrays[name] = [np.load(os.path.join(path, '{}.{}.npy'.format(name, i)), mmap_mode=mmap_mode)
+                            for i in range(count)]
+    return params, arrays
@@ -213,6 +213,29 @@ cdef class BaseRealMmajorPlan:
                           SHARP_DP,
                           NULL, NULL)
 
+    cdef _execute_multi(self, sharp_jobtype jobtype, int ntrans, double[:, ::1] alms, double[:, ::1] maps):
+        # libsharp takes arrays of pointers to the individual alms/maps when ntrans > 1
+        global sht_count
+        cdef int i
+        cdef void **alm_ptrs
+        cdef void **map_ptrs
+        if self.use_mpi:
+            raise NotImplementedError()
+        sht_count += ntrans
+        alm_ptrs = <void**>malloc(ntrans * sizeof(void*))
+        map_ptrs = <void**>malloc(ntrans * sizeof(void*))
+        try:
+            for i in range(ntrans):
+                alm_ptrs[i] = &alms[i, 0]
+                map_ptrs[i] = &maps[i, 0]
+            sharp_execute(jobtype, 0, alm_ptrs, map_ptrs, self.geom_info,
+                          self.alm_info, ntrans,
+                          SHARP_DP,
+                          NULL, NULL)
+        finally:
+            free(alm_ptrs)
+            free(map_ptrs)
+
     def adjoint_synthesis(self, map, out=None):
         return self.analysis(map, out, jobtype='Yt')
 
@@ -262,6 +285,50 @@ cdef class BaseRealMmajorPlan:
         self._execute(str_to_jobtype(jobtype), &out[0], &map[0])
         return np.asarray(out)
 
+    def synthesis_multi(self, double[:, ::1] alms, double[:, ::1] out=None, jobtype='Y'):
+        """
+        Like `synthesis`, but transforms every row of `alms` in a single
+        libsharp call, so that the Legendre recursions are shared between them.
+        """
+        if self.geom_info == NULL:
+            raise NotImplementedError('subclass did not initialize self.geom_info')
+        if jobtype not in ('Y', 'WY'):
+            raise ValueError('Invalid jobtype')
+        if alms.shape[1] != self.nsh_local:
+            raise ValueError('alms.shape does not match lmax')
+        if out is None:
+            out = np.zeros((alms.shape[0], self.npix_local), np.double) * np.nan
+        elif out.shape[0] != alms.shape[0] or out.shape[1] != self.npix_local:
+            raise ValueError('maps has wrong shape')
+        if alms.shape[0] > 0:
+            self._execute_multi(str_to_jobtype(jobtype), alms.shape[0], alms, out)
+        return np.asarray(out)
+
+    def analysis_multi(self, double[:, ::1] maps, double[:, ::1] out=None, jobtype='YtW'):
+        """
+        Like `analysis`, but transforms every row of `maps` in a single libsharp call.
+        """
+        if self.geom_info == NULL:
+            raise NotImplementedError('subclass did not initialize self.geom_info')
+        if jobtype not in ('YtW', 'Yt'):
+            raise ValueError('Invalid jobtype')
+        if maps.shape[1] != self.npix_local:
+            raise ValueError('maps has wrong number of pixels')
+        if out is None:
+            out = np.zeros((maps.shape[0], self.nsh_local), np.double) * np.nan
+        elif out.shape[0] != maps.shape[0] or out.shape[1] != self.nsh_local:
+            raise ValueError('out.shape does not match lmax')
+        if maps.shape[0] > 0:
+            self._execute_multi(str_to_jobtype(jobtype), maps.shape[0], out, maps)
+        return np.asarray(out)
+
+    def adjoint_synthesis_multi(self, maps, out=None):
+        return self.analysis_multi(maps, out, jobtype='Yt')
+
+    def adjoint_analysis_multi(self, alms, out=None):
+        return self.synthesis_multi(alms, out, jobtype='WY')
+
+
 cdef class RealMmajorHealpixPlan(BaseRealMmajorPlan):
     cdef readonly int nside
 
@@ -1,10 +1,79 @@
 from __future__ import division
+import os
+import hashlib
+import logging
+import threading
 import sympy
 from fractions import Fraction
 import numpy as np
 from libsharp import legendre_roots
 from numpy import pi
 
+#
+# Cache of grids and neighbour graphs. These only depend on a handful of integer
+# parameters but take seconds to minutes to compute for high resolutions, so we keep
+# them both in-process and on disk as compact arrays in .npz files.
+#
+
+sympix_cache_path = os.path.join('cache', 'sympix')
+
+_memo = {}
+_memo_lock = threading.Lock()
+
+
+def _array_hash(arr):
+    return hashlib.sha1(np.ascontiguousarray(arr, dtype=np.int64).tostring()).hexdigest()
+
+
+def _cache_filename(key):
+    h = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(sympix_cache_path, '{}-{}.npz'.format(key[0], h))
+
+
+def _cached_arrays(key, compute):
+    """
+    Returns the dict of arrays produced by `compute()`, looking it up in memory and
+    then in `sympix_cache_path` first. The caller gets its own (writeable) copies, since
+    the arrays end up in Cython typed buffers.
+    """
+    with _memo_lock:
+        arrs = _memo.get(key)
+    if arrs is not None:
+        return dict((name, arr.copy()) for name, arr in arrs.items())
+
+    filename = _cache_filename(key) if sympix_cache_path is not None else None
+    if filename is not None and os.path.exists(filename):
+        with np.load(filename) as f:
+            if str(f['key']) == repr(key):
+                arrs = dict((name, f[name]) for name in f.files if name != 'key')
+    if arrs is None:
+        arrs = compute()
+        if filename is not None:
+            try:
+                if not os.path.isdir(sympix_cache_path):
+                    os.makedirs(sympix_cache_path)
+                # write to a temporary file and rename, so that concurrent readers never see partial files
+                tmp_filename = '{}.tmp{}.npz'.format(filename[:-len('.npz')], os.getpid())
+                np.savez(tmp_filename, key=np.array(repr(key)), **arrs)
+                os.rename(tmp_filename, filename)
+            except (IOError, OSError):
+                logging.warning('Could not write sympix cache file {}'.format(filename))
+    for arr in arrs.values():
+        arr.flags.writeable = False
+    with _memo_lock:
+        _memo[key] = arrs
+    return dict((name, arr.copy()) for name, arr in arrs.items())
+
+
+def clear_sympix_cache():
+    """
+    Clears the in-process cache of grids and neighbour graphs; the disk cache in
+    `sympix_cache_path` is left alone.
+    """
+    with _memo_lock:
+        _memo.clear()
+
+
 class SymPixGrid(object):
     """
     A `band` is the fundamental configuration unit; number of bands
@@ -231,8 +300,18 @@ def make_sympix_grid(nrings_min, k, undersample=False, cost_function=None, n_sta
 
     k: tilesize
 
-    Returns a SymPixGrid object descripting the grid.
+    Returns a SymPixGrid object descripting the grid. Unless a custom `cost_function`
+    is passed, the result is cached in memory and on disk, see `sympix_cache_path`.
     """
+    if cost_function is not None:
+        arrs = _compute_sympix_grid(nrings_min, k, undersample, cost_function, n_start)
+    else:
+        key = ('grid', int(nrings_min), int(k), bool(undersample), n_start)
+        arrs = _cached_arrays(key, lambda: _compute_sympix_grid(nrings_min, k, undersample, None, n_start))
+    return SymPixGrid(arrs['tile_counts'], tilesize=k, thetas=arrs['thetas'], weights=arrs['weights'])
+
+
+def _compute_sympix_grid(nrings_min, k, undersample, cost_function, n_start):
     def is_acceptable_ring_length(n):
         """
         Determine whether `n` is on the form ``2^a * 3^b * 5^c * k``;
@@ -267,7 +346,7 @@ def make_sympix_grid(nrings_min, k, undersample=False, cost_function=None, n_sta
                                                   POSSIBLE_INCREMENTS,
                                                   undersample=undersample,
                                                   cost_function=cost_function)
-    return SymPixGrid(tile_counts, tilesize=k, thetas=thetas, weights=weights)
+    return dict(tile_counts=tile_counts, thetas=thetas, weights=weights)
 
 def plot_sympix_grid_efficiency(nrings_min, grid):
     """
@@ -299,250 +378,154 @@ def plot_sympix_grid_efficiency(nrings_min, grid):
     draw()
 
 
-class CscMaker(object):
-    def __init__(self, n, nnz, dtype=np.double):
-        self.indices = np.zeros(nnz, dtype=np.int32)
-        self.indptr = np.zeros(n + 1, dtype=np.int32)
-        self.data = np.zeros(nnz, dtype=dtype)
-        self.n = n
-        self.colidx = -1 # should call start_column initially
-        self.ptr = 0
-        self.examples = {}  #
-
-    def start_column(self):
-        self.colidx += 1
-        self.indptr[self.colidx] = self.ptr
-
-    def put(self, rowidx, value):
-        assert 0 <= rowidx < self.n
-        self.indices[self.ptr] = rowidx
-        self.data[self.ptr] = value
-        self.ptr += 1
-
-    def finish(self):
-        self.start_column()
-        self.indptr[self.colidx:] = self.ptr
-        self.indices = self.indices[:self.ptr]
-        self.data = self.data[:self.ptr]
-
-    def as_csc_matrix(self):
-        from scipy.sparse import csc_matrix
-        return csc_matrix((self.data, self.indices, self.indptr), shape=(self.n, self.n))
-
-
-class LabelMatrixMaker(CscMaker):
-    """
-    Extends CscMaker to record a number of examples, (ipix, jpix) for each
-    label recorded in the matrix.
-
-    It also adds upper-triangular mirrored half with shifted
-    labels if reflect=True. In that case label_allocated must also be set
-    to a `Counter` instance.
-    """
-    def __init__(self, n, nnz, reflect=False, label_allocator=None):
-        CscMaker.__init__(self, n, nnz, np.int32)
-        self.examples = {}
-        self.reflect = reflect
-        if self.reflect:
-            # Also store matrix entries in rows, and emit them when we start a new column.
-            # Each row is a list of tuples (col, label)
-            self.rows = [[] for i in range(n)]
-            self.label_allocator = label_allocator
-            self.upper_labels = {}  # lower_label : corresponding upper label
-
-    def put_example(self, rowidx, label):
-        if label not in self.examples:
-            self.examples[label] = (rowidx, self.colidx)
-
-    def put(self, rowidx, label):
-        self.put_example(rowidx, label)
-        if self.reflect:
-            if rowidx < self.colidx:
-                raise ValueError()
-            if rowidx > self.colidx:
-                try:
-                    upper_label = self.upper_labels[label]
-                except KeyError:
-                    self.upper_labels[label] = upper_label = self.label_allocator.next()
-                self.rows[rowidx].append((self.colidx, upper_label))
-        return CscMaker.put(self, rowidx, label)
-
-    def start_column(self):
-        CscMaker.start_column(self)
-        if self.reflect and self.colidx < self.n:
-            for col, label in self.rows[self.colidx]:
-                self.put_example(col, label)
-                CscMaker.put(self, col, label)
-
-
-class Counter(object):
-    def __init__(self, value):
-        self.value = value
-
-    def next(self):
-        r = self.value
-        self.value += 1
-        return r
-
-    def multi_next(self, n):
-        r = range(self.value, self.value + n)
-        self.value += n
-        return r
-
-
 def sympix_csc_neighbours(grid, corner_factor=0.6, lower_only=True):
     """
     Given a sympix grid, compute the lower half of a CSC neighbour
-    matrix.
+    matrix (or the full matrix, if lower_only=False).
 
     This treat the sympix grid as if it isn't tiled at all (i.e. it's
     the CSC neighbour graph of tiles, not individual pixels).
 
     Returns a scipy.sparse.csc_matrix of integer dtype, where the
     integer values refers to a unique label of the case one is in
-    (symmetric with other elements with the same label).
+    (symmetric with other elements with the same label), and
+    (example_i, example_j), giving the (row, column) of the first
+    occurrence of each label.
 
     For the purposes of labelling we assume that every ring length
     is repeated at least twice, so that it's the same either below
     or above.
+
+    Results are cached in memory and on disk, see `sympix_cache_path`.
     """
-    # m is a helper object that produces the CSC matrix
+    key = ('neighbours', _array_hash(grid.tile_counts), float(corner_factor), bool(lower_only))
+    arrs = _cached_arrays(key, lambda: _compute_sympix_csc_neighbours(grid, corner_factor, lower_only))
+    from scipy.sparse import csc_matrix
+    ntiles = arrs['indptr'].shape[0] - 1
+    neighmat = csc_matrix((arrs['data'], arrs['indices'], arrs['indptr']), shape=(ntiles, ntiles))
+    return neighmat, (arrs['example_i'], arrs['example_j'])
+
+
+def _compute_sympix_csc_neighbours(grid, corner_factor, lower_only):
+    # Build the lists of (column, row, label) of the lower half with numpy, one
+    # band-pair at a time, then sort them into CSC order.
+
+    # Comments are with respect to the northern half; 'right' and 'below' means
+    # both increasing array index and increasing theta/phi.
+    # There's a special case for the last ring pair (the equatorial ring pair),
+    # where the 'next' ring is the southern ring of the same pair.
     offsets = 2 * np.concatenate([[0], np.cumsum(grid.tile_counts)])
     ntiles = offsets[-1]
-    labels = Counter(0)
-    nnz = 6 * ntiles + grid.tile_counts[0]**2
-    if not lower_only:
-        nnz *= 2
-    m = LabelMatrixMaker(ntiles, nnz,
-                         reflect=not lower_only, label_allocator=labels)
+    cols, rows, labels = [], [], []
+    nlabels = [0]
 
-    # Comments are with respect to traversing the northern half;
-    # 'right' and 'below' means both increasing array index and
-    # increasing theta/phi
-
-    # i - ring-pair index
-    # j - pixel within ring
-    # offset - offset of first pixel in ring
-    # nj = number of pixels in ring
+    def new_labels(n):
+        r = np.arange(nlabels[0], nlabels[0] + n, dtype=np.int32)
+        nlabels[0] += n
+        return r
 
-    # There's a special case for the last ring pair (the equatorial ring pair)
-    # which is woven in throughout
+    def emit(c, r, lab):
+        c, r, lab = np.broadcast_arrays(c, r, lab)
+        cols.append(c.ravel())
+        rows.append(r.ravel())
+        labels.append(lab.ravel())
 
     for i in range(grid.band_pair_count):
-        nj = grid.tile_counts[i]
+        nj = int(grid.tile_counts[i])
+        js = np.arange(nj)
         dphi = 2 * pi / nj
         last_ring = (i == grid.band_pair_count - 1)
         dphi_next = dphi if last_ring else 2 * pi / grid.tile_counts[i + 1]
-        offset = offsets[i]
-        offset_next = offset + nj if last_ring else offsets[i + 1]
-        tile_count = grid.tile_counts[i]
-        # ^ in the last_ring case, the 'next' ring is the southern ring of the same pair
 
-        if i > 0 and not last_ring and 0:
-            if sum([tile_count == grid.tile_counts[i - 1],
-                    tile_count == grid.tile_counts[i + 1]]) == 0:
-                raise NotImplementedError('We do not support grids that does not repeat tile counts '
-                                          'at least twice (except for first ring), due to loss of symmetry')
-
-        # For each band-pair we pick new labels for 'left', 'same', 'right' neighbours, but
-        # the relationship is the same for all tiles in the band-pair
-        label_same, label_left, label_right = labels.multi_next(3)
+        # The 'same', 'left' and 'right' relationships are the same for all tiles in the band-pair
+        label_same, label_left, label_right = new_labels(3)
 
         # Figure out how many sets of labels we need for the angles between
         # tiles on current ring and tiles on next ring
         if last_ring:
-            tile_count_below = tile_count
-            increase = cycle_length = cycle_length_below = 1
+            tile_count_below = nj
+            cycle_length = cycle_length_below = 1
         else:
-            tile_count_below = grid.tile_counts[i + 1]
-            increase = Fraction(int(tile_count), int(tile_count_below))
+            tile_count_below = int(grid.tile_counts[i + 1])
+            increase = Fraction(nj, tile_count_below)
             cycle_length = increase.numerator
             cycle_length_below = increase.denominator
 
-        # we cache the lookup of tiles on the band below; the tiles_below structure
-        # has the format
-        #   tiles_below[j % cycle_length] == [
-        #      (index_of_tile_below_as_in_first_case, label), ...]
-        tiles_below_table = [None] * cycle_length
+        # tiles_below_table[j % cycle_length] == (indices of tiles below in first cycle, labels)
+        tiles_below_table = []
+        for j in range(min(cycle_length, nj)):
+            # For the ring below, we use SymPixGrid.get_strip to select pixels based on
+            # a phi range. First find edges on current ring, then go out a certain
+            # distance on next ring
+            phi_start = j * dphi - corner_factor * dphi_next
+            phi_stop = (j + 1) * dphi + corner_factor * dphi_next
+            if phi_stop > 2 * pi:
+                phi_start -= 2 * pi
+                phi_stop -= 2 * pi
+            next_band = i if last_ring else i + 1
+            indices = grid.get_strip(next_band, phi_start, phi_stop - dphi / 100)
+            tiles_below_table.append((indices, new_labels(len(indices))))
 
         for south in [False, True]:
-            if south:
-                # The southern half is a copy of the northern half, just with
-                # different pixel indices. All comments below treat the northern
-                # case.
-                offset += nj
-                if not last_ring:
-                    offset_next += nj if last_ring else grid.tile_counts[i + 1]
-
-            for j in range(nj):
-                m.start_column()
-                m.put(offset + j, label_same)
-
-                # For our own ring, we select everything if on the pole ring,
-                # otherwise the left and right neighbour
-                if i == 0:  # pole ring
-                    for k in range(offset + j + 1, offset + nj):
-                        ## TODO: we're too lazy now to properly compute symmetry labels for polar region
-                        m.put(k, labels.next())
-                elif j == 0:  # first pixel on the ring; left neighbour is last on ring
-                    m.put(offset + j + 1, label_right)  # right
-                    m.put(offset + nj - 1, label_left)  # left
-                elif j == nj - 1:
-                    # last pixel on ring; both left and right neighbour comes before in ordering
-                    pass
-                else:
-                    # interior pixel; left neighbour comes before in ordering and is ignored,
-                    # right neighbour comes after
-                    m.put(offset + j + 1, label_right)
-
-                if last_ring and south:
-                    # last column block of CSC matrix, only within-ring couplings needed
-                    continue
+            # The southern half is a copy of the northern half, just with
+            # different tile indices
+            offset = offsets[i] + (nj if south else 0)
+            if last_ring:
+                offset_next = offsets[i] + nj
+            else:
+                offset_next = offsets[i + 1] + (tile_count_below if south else 0)
+
+            emit(offset + js, offset + js, label_same)
+
+            if i == 0:
+                # pole ring; couple to everything else on the ring
+                # TODO: we're too lazy now to properly compute symmetry labels for polar region
+                jj, kk = np.triu_indices(nj, 1)
+                emit(offset + jj, offset + kk, new_labels(len(jj)))
+            elif nj > 1:
+                # right neighbour, and for the first tile on the ring, the left neighbour
+                # which is the last on the ring
+                emit(offset + js[:-1], offset + js[:-1] + 1, label_right)
+                emit(offset, offset + nj - 1, label_left)
+
+            if last_ring and south:
+                # last column block of CSC matrix, only within-ring couplings needed
+                continue
+
+            for jmod, (indices, lab) in enumerate(tiles_below_table):
+                cycle_js = js[jmod::cycle_length]
+                shift = (cycle_js // cycle_length) * cycle_length_below
+                below = (indices[None, :] + shift[:, None]) % tile_count_below + offset_next
+                emit((offset + cycle_js)[:, None], below, lab[None, :])
+
+    cols = np.concatenate(cols)
+    rows = np.concatenate(rows)
+    labels = np.concatenate(labels)
 
-                tiles_below = tiles_below_table[j % cycle_length]
-                if tiles_below is None:
-                    # Need to figure them out and store in table. (Primary purpose of tabulation
-                    # is to reuse labels for the cases, not speed).
-
-                    # For the ring below, we use SymPixGrid.get_strip to select pixels based on
-                    # a phi range. First find edges on current ring
-                    phi_left = j * dphi
-                    phi_right = (j + 1) * dphi
-                    # then go out a certain distance on next ring
-                    phi_start = phi_left - corner_factor * dphi_next
-                    phi_stop = phi_right + corner_factor * dphi_next
-                    if phi_stop > 2 * pi:
-                        # TOOD: move to get_strip
-                        phi_start -= 2 * pi
-                        phi_stop -= 2 * pi
-
-                    if last_ring:
-                        next_band = i
-                    else:
-                        next_band = i + 1
-                    tiles_below_indices = grid.get_strip(next_band, phi_start, phi_stop - dphi/100)
-
-                    tiles_below_labels = labels.multi_next(len(tiles_below_indices))
-                    tiles_below = tiles_below_table[j % cycle_length] = zip(tiles_below_indices, tiles_below_labels)
-
-                # Emit to matrix; we need to a) shift indices right to current position, b) sort by
-                # that new index
-                shift = (j // cycle_length) * cycle_length_below
-
-                tiles_below_shifted = [((k + shift) % tile_count_below + offset_next, lab) for k, lab in tiles_below]
-                tiles_below_shifted.sort()
-                for k, lab in tiles_below_shifted:
-                    m.put(k, lab)
-
-    m.finish()
-
-    example_i = np.zeros(labels.value, dtype=np.int32)
-    example_j = np.zeros(labels.value, dtype=np.int32)
-    for key, (i, j) in m.examples.items():
-        example_i[key] = i
-        example_j[key] = j
-
-    return m.as_csc_matrix(), (example_i, example_j)
+    if not lower_only:
+        # Add the upper-triangular mirrored half, with a new label for the mirror
+        # of each off-diagonal label
+        off_diag = (rows > cols)
+        lower_labels, inverse = np.unique(labels[off_diag], return_inverse=True)
+        cols, rows, labels = (
+            np.concatenate([cols, rows[off_diag]]),
+            np.concatenate([rows, cols[off_diag]]),
+            np.concatenate([labels, nlabels[0] + inverse]))
+        nlabels[0] += len(lower_labels)
+
+    order = np.lexsort((labels, rows, cols))
+    cols, rows, labels = cols[order], rows[order], labels[order]
+    indptr = np.searchsorted(cols, np.arange(ntiles + 1)).astype(np.int32)
+
+    # example for each label is its first occurrence in CSC order
+    example_i = np.zeros(nlabels[0], dtype=np.int32)
+    example_j = np.zeros(nlabels[0], dtype=np.int32)
+    used_labels, first = np.unique(labels, return_index=True)
+    example_i[used_labels] = rows[first]
+    example_j[used_labels] = cols[first]
+
+    return dict(indptr=indptr, indices=rows.astype(np.int32), data=labels.astype(np.int32),
+                example_i=example_i, example_j=example_j)
 
 
 def sympix_plot(grid, map, image=None):
@@ -5,6 +5,9 @@ module sympix_mg
   use constants
   implicit none
 
+  ! Number of pixel pairs and of beams processed together by legendre_transform_multi
+  integer(i4b), parameter :: legendre_chunk = 8, legendre_beam_block = 4
+
   interface
      subroutine sharp_legendre_transform_recfac(recfac, lmax) bind(c)
        use iso_c_binding, only: c_ptrdiff_t, c_double
@@ -182,6 +185,182 @@ contains
     !$OMP end parallel
   end subroutine compute_many_YDYt_blocks
 
+  ! Like compute_many_YDYt_blocks, but for several beams at once; `bl` has one
+  ! column per beam, and `out_blocks` one set of blocks per beam. The angular
+  ! distances between pixel pairs are computed once and the Legendre recursion
+  ! is shared between the beams; see legendre_transform_multi.
+  subroutine compute_many_YDYt_blocks_multi(&
+       nblocks, &
+       tilesize1, bandcount1, thetas1, tilecounts1, tileindices1, &
+       tilesize2, bandcount2, thetas2, tilecounts2, tileindices2, &
+       lmax, nbeams, bl, ierr, out_blocks) &
+       bind(c, name='sympix_mg_compute_many_YDYt_blocks_multi')
+
+    integer(i4b), value :: nblocks, bandcount1, bandcount2, lmax, tilesize1, tilesize2, nbeams
+    integer(i4b), dimension(nblocks) :: tileindices1, tileindices2
+    real(dp), dimension(0:bandcount1 * tilesize1 - 1) :: thetas1
+    real(dp), dimension(0:bandcount2 * tilesize2 - 1) :: thetas2
+    integer(i4b), dimension(0:bandcount1 - 1) :: tilecounts1
+    integer(i4b), dimension(0:bandcount2 - 1) :: tilecounts2
+    real(dp), dimension(0:lmax, nbeams) :: bl
+    real(dp), dimension(tilesize1**2 * tilesize2**2, nblocks, nbeams) :: out_blocks
+    integer(i4b) :: ierr  ! out-argument
+    !--
+    real(dp), dimension(:, :), allocatable :: rescaled_blt
+    real(dp), dimension(:), allocatable :: rescaled_bl, recfac, xs
+    integer(i4b) :: i, ibeam, private_ierr, npairs, ldbl
+    real(dp) :: tile_dphi1, tile_dphi2, tile_phi1, tile_phi2
+    real(dp), dimension(tilesize1) :: tile_thetas1
+    real(dp), dimension(tilesize2) :: tile_thetas2
+    integer(i4b), dimension(0:bandcount1) :: offsets1
+    integer(i4b), dimension(0:bandcount2) :: offsets2
+
+    npairs = tilesize1**2 * tilesize2**2
+
+    ! The beams are stored transposed and zero-padded to a multiple of the beam
+    ! block size of legendre_transform_multi
+    ldbl = ((nbeams + legendre_beam_block - 1) / legendre_beam_block) * legendre_beam_block
+    allocate(rescaled_bl(0:lmax), rescaled_blt(ldbl, 0:lmax), recfac(0:lmax))
+    rescaled_blt = 0
+    do ibeam = 1, nbeams
+       call rescale_bl(bl(:, ibeam), rescaled_bl, lmax)
+       rescaled_blt(ibeam, :) = rescaled_bl
+    end do
+    call legendre_recfac(lmax, recfac)
+
+    offsets1(0) = 0
+    offsets2(0) = 0
+    call cumsum_i4b(2 * tilecounts1, offsets1(1:))
+    call cumsum_i4b(2 * tilecounts2, offsets2(1:))
+
+    ierr = 0
+    !$OMP parallel default(none) private(private_ierr,i,tile_thetas1,tile_thetas2,tile_phi1,tile_phi2,&
+    !$OMP                                tile_dphi1,tile_dphi2,xs) &
+    !$OMP                        shared(ierr,nblocks,nbeams,npairs,ldbl,tilesize1,tilesize2,bandcount1,bandcount2,&
+    !$OMP                               offsets1,offsets2,thetas1,thetas2,&
+    !$OMP                               tileindices1,tileindices2,out_blocks,rescaled_blt,recfac,lmax)
+    allocate(xs(npairs))
+    !$OMP do schedule(static,8)
+    do i = 1, nblocks
+       if (ierr == 0) then
+          call lookup_tile(tilesize1, bandcount1, offsets1, thetas1, tileindices1(i), &
+               tile_phi1, tile_dphi1, tile_thetas1, private_ierr)
+          if (private_ierr /= 0) then
+             ierr = private_ierr
+             cycle
+          end if
+          call lookup_tile(tilesize2, bandcount2, offsets2, thetas2, tileindices2(i), &
+               tile_phi2, tile_dphi2, tile_thetas2, private_ierr)
+          if (private_ierr /= 0) then
+             ierr = private_ierr
+             cycle
+          end if
+          call compute_pair_cos_angles(tilesize1, tilesize2, tile_dphi1, tile_dphi2, &
+               tile_thetas1, tile_thetas2, tile_phi2 - tile_phi1, xs)
+          ! the blocks of the beams are npairs * nblocks apart in out_blocks
+          call legendre_transform_multi(lmax, nbeams, ldbl, rescaled_blt, recfac, npairs, xs, &
+               npairs * nblocks, out_blocks(1, i, 1))
+       end if
+    end do
+    !$OMP end do
+    deallocate(xs)
+    !$OMP end parallel
+  end subroutine compute_many_YDYt_blocks_multi
+
+  ! Cosine of the angle between every pixel pair of two tiles, in the
+  ! layout of compute_YDYt_block.
+  subroutine compute_pair_cos_angles(n_D1, n_D2, dphi_D1, dphi_D2, &
+       thetas_D1, thetas_D2, phi0_D2, xs)
+    integer(i4b), value :: n_D1, n_D2
+    real(dp), value :: phi0_D2, dphi_D1, dphi_D2
+    real(dp), dimension(n_D1) :: thetas_D1
+    real(dp), dimension(n_D2) :: thetas_D2
+    real(dp), dimension(n_D1, n_D1, n_D2, n_D2) :: xs
+    !--
+    integer(i4b) :: i1, j1, i2, j2
+    real(dp) :: phi1, phi2
+    real(dp), dimension(3) :: v1, v2
+
+    do j2 = 1, n_D2
+       do i2 = 1, n_D2
+          do j1 = 1, n_D1
+             do i1 = 1, n_D1
+                phi1 = (j1 - 1) * dphi_D1
+                phi2 = phi0_D2 + (j2 - 1) * dphi_D2
+                v1 = ang2vec(thetas_D1(i1), phi1)
+                v2 = ang2vec(thetas_D2(i2), phi2)
+                xs(i1, j1, i2, j2) = real(sum(v1 * v2), sp)
+             end do
+          end do
+       end do
+    end do
+  end subroutine compute_pair_cos_angles
+
+  ! Factors of the Legendre recursion written as
+  !   P_l(x) = x P_{l-1}(x) + recfac(l) (x P_{l-1}(x) - P_{l-2}(x)),
+  ! i.e., recfac(l) = (l - 1) / l; this takes one multiplication and two
+  ! additions per l, and no division.
+  subroutine legendre_recfac(lmax, recfac)
+    integer(i4b), value :: lmax
+    real(dp), dimension(0:lmax), intent(out) :: recfac
+    !--
+    integer(i4b) :: l
+
+    recfac(0) = 0
+    do l = 1, lmax
+       recfac(l) = real(l - 1, dp) / real(l, dp)
+    end do
+  end subroutine legendre_recfac
+
+  ! out(1:n, j) = sum_l rescaled_blt(j, l) P_l(xs) for j = 1..nbeams, where the
+  ! columns of out are `ldout` apart and rescaled_blt is zero-padded to `ldbl`
+  ! (a multiple of legendre_beam_block) beams. The recursion is run on chunks of
+  ! legendre_chunk values of xs at a time and accumulated into
+  ! legendre_beam_block beams at a time, so that the recursion and accumulators
+  ! stay in registers rather than streaming one n-vector per beam and l; the
+  ! recursion is repeated for each block of beams.
+  subroutine legendre_transform_multi(lmax, nbeams, ldbl, rescaled_blt, recfac, n, xs, ldout, out)
+    integer(i4b), value :: lmax, nbeams, ldbl, n, ldout
+    real(dp), dimension(ldbl, 0:lmax), intent(in) :: rescaled_blt
+    real(dp), dimension(0:lmax), intent(in) :: recfac
+    real(dp), dimension(n), intent(in) :: xs
+    real(dp), dimension(ldout, nbeams), intent(inout) :: out
+    !--
+    real(dp), dimension(legendre_chunk) :: x, p0, p1, p2, w
+    real(dp), dimension(legendre_chunk, legendre_beam_block) :: acc
+    integer(i4b) :: i0, m, b0, j, l
+
+    do i0 = 1, n, legendre_chunk
+       m = min(legendre_chunk, n - i0 + 1)
+       x = 0
+       x(1:m) = xs(i0:i0 + m - 1)
+       do b0 = 1, nbeams, legendre_beam_block
+          p0 = 1.0_dp
+          p1 = x
+          do j = 1, legendre_beam_block
+             acc(:, j) = rescaled_blt(b0 + j - 1, 0)
+          end do
+          if (lmax >= 1) then
+             do j = 1, legendre_beam_block
+                acc(:, j) = acc(:, j) + rescaled_blt(b0 + j - 1, 1) * p1
+             end do
+          end if
+          do l = 2, lmax
+             w = x * p1
+             p2 = w + recfac(l) * (w - p0)
+             do j = 1, legendre_beam_block
+                acc(:, j) = acc(:, j) + rescaled_blt(b0 + j - 1, l) * p2
+             end do
+             p0 = p1
+             p1 = p2
+          end do
+          do j = 1, min(legendre_beam_block, nbeams - b0 + 1)
+             out(i0:i0 + m - 1, b0 + j - 1) = acc(1:m, j)
+          end do
+       end do
+    end do
+  end subroutine legendre_transform_multi
+
   subroutine lookup_tile(tilesize, bandcount, offsets, thetas, itile, &
        tile_phi, tile_dphi, tile_thetas, ierr)
     integer(i4b), value :: tilesize, bandcount, itile
@@ -20,6 +20,12 @@ cdef extern:
        int32_t tilesize2, int32_t bandcount2, double *thetas2, int32_t *tilecounts2, int32_t *tileindices2,
        int32_t lmax, double *bl, int32_t *ierr, double *out_blocks) nogil
 
+    void compute_many_YDYt_blocks_multi_ "sympix_mg_compute_many_YDYt_blocks_multi"(
+       int32_t nblocks,
+       int32_t tilesize1, int32_t bandcount1, double *thetas1, int32_t *tilecounts1, int32_t *tileindices1,
+       int32_t tilesize2, int32_t bandcount2, double *thetas2, int32_t *tilecounts2, int32_t *tileindices2,
+       int32_t lmax, int32_t nbeams, double *bl, int32_t *ierr, double *out_blocks) nogil
+
 
 def compute_YDYt_block(
     cnp.ndarray[double, mode='c'] thetas1,
@@ -65,6 +71,44 @@ def compute_many_YDYt_blocks(grid1, grid2,
     return out
 
 
+def compute_many_YDYt_blocks_multi(grid1, grid2,
+                                   cnp.ndarray[double, ndim=2, mode='fortran'] bls,
+                                   cnp.ndarray[int32_t, mode='c'] indices1,
+                                   cnp.ndarray[int32_t, mode='c'] indices2):
+    """
+    Like compute_many_YDYt_blocks, but for all the beams given as columns of `bls`
+    (shape (lmax + 1, nbeams)) in one pass, sharing the angular distances and the
+    Legendre recursion between them. Returns blocks of shape
+    (grid1.tilesize**2, grid2.tilesize**2, nblocks, nbeams); as that is nbeams times
+    the memory of compute_many_YDYt_blocks, pass many beams in chunks. The beams are
+    accumulated four at a time, so chunks of a multiple of four are the cheapest.
+    """
+    cdef int32_t lmax = bls.shape[0] - 1, nbeams = bls.shape[1], nblocks = indices1.shape[0], ierr
+    cdef cnp.ndarray[double, ndim=4, mode='fortran'] out = (
+        np.empty((grid1.tilesize**2, grid2.tilesize**2, nblocks, nbeams), np.double, order='F'))
+    cdef cnp.ndarray[double, ndim=1, mode='c'] thetas1 = grid1.thetas, thetas2 = grid2.thetas
+    cdef cnp.ndarray[int32_t, ndim=1, mode='c'] tile_counts1 = grid1.tile_counts
+    cdef cnp.ndarray[int32_t, ndim=1, mode='c'] tile_counts2 = grid2.tile_counts
+
+    cdef int32_t tilesize1 = grid1.tilesize, band_pair_count1 = grid1.band_pair_count
+    cdef int32_t tilesize2 = grid2.tilesize, band_pair_count2 = grid2.band_pair_count
+
+    if indices1.shape[0] != indices2.shape[0]:
+        raise ValueError()
+    with nogil:
+        compute_many_YDYt_blocks_multi_(
+            nblocks,
+            tilesize1, band_pair_count1, &thetas1[0], &tile_counts1[0], &indices1[0],
+            tilesize2, band_pair_count2, &thetas2[0], &tile_counts2[0], &indices2[0],
+            lmax, nbeams, &bls[0, 0], &ierr, &out[0, 0, 0, 0])
+    if ierr != 0:
+        msg = 'unknown'
+        if ierr == 1:
+            msg = 'Illegal pixel index'
+        raise Exception(msg)
+    return out
+
+
 def compute_single_diagonal_YDYt_block(cnp.ndarray[double, mode='c'] thetas,
                                        cnp.ndarray[double, mode='c'] bl,
                                        int32_t tile_count):
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import contextlib
 from matplotlib import pyplot as plt
@@ -45,6 +46,16 @@ def format_duration(dt):
     return '%.1f %s' % (dt, unit)
 
 
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n < 1024:
+            break
+        n /= 1024.
+    else:
+        unit = 'TB'
+    return '%.1f %s' % (n, unit)
+
+
 class TimingResults(object):
     pass
 
@@ -66,6 +77,18 @@ def timed(msg, stream=None): # for interactive use
         stream.flush()
 
 
+def makedirs(path):
+    """
+    Like os.makedirs, but it is not an error if `path` already exists, e.g. because
+    another process created it concurrently.
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
 def hammer(matvec_func, n, m=None):
     m = n if m is None else m
     u = np.zeros(m)
@@ -79,6 +102,29 @@ def hammer(matvec_func, n, m=None):
     return out
 
 
+def ridged_cho_factor(matrix, eps=1e-12, max_tries=20):
+    """
+    Cholesky factor `matrix`, adding a ridge to the diagonal if it is not numerically
+    positive definite; the ridge starts at `eps` times the largest absolute diagonal
+    element (or `eps`, if that is zero) and is increased tenfold until the
+    factorization succeeds. After `max_tries` ridges the LinAlgError is re-raised.
+
+    Returns (cho, ridge), where `cho` can be passed to scipy.linalg.cho_solve.
+    """
+    import scipy.linalg
+    scale = np.max(np.abs(np.diag(matrix)))
+    if not scale > 0:
+        scale = 1.
+    ridge = 0
+    for i in range(max_tries + 1):
+        try:
+            return scipy.linalg.cho_factor(matrix + ridge * np.eye(matrix.shape[0]), lower=True), ridge
+        except np.linalg.LinAlgError:
+            if i == max_tries:
+                raise
+            ridge = eps * scale if ridge == 0 else ridge * 10
+
+
 def unitvec(n, i):
     r = np.zeros(n)
     r[i] = 1
@@ -0,0 +1,21 @@
+"""
+Convert the FITS maps and beams of an input file to the memory-mapped map store
+used by CrSystem.from_config. Usage:
+
+scripts/build_map_store.py input_file [nside ...]
+
+For every nside given, ud_graded maps are precomputed as well.
+"""
+
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import cmbcr
+from cmbcr.map_store import build_store_from_config
+
+config = cmbcr.load_config_file(sys.argv[1])
+nsides = [int(x) for x in sys.argv[2:]]
+
+store = build_store_from_config(config, nsides=nsides)
+print 'Map store written to', store.path
@@ -25,6 +25,7 @@ reload(cmbcr.precond_diag)
 reload(cmbcr.precond_pixel)
 reload(cmbcr.utils)
 reload(cmbcr.masked_solver)
+reload(cmbcr.precond_multilevel)
 reload(cmbcr)
 from cmbcr.utils import *
 
@@ -41,7 +42,7 @@ factor = 2048 // nside
 rms_treshold = 1
 
 
-full_res_system = cmbcr.CrSystem.from_config(config, udgrade=nside, mask_eps=0.8, rms_treshold=rms_treshold)
+full_res_system = cmbcr.CrSystem.from_config(config, udgrade=nside, mixing_udgrade=nside, mask_eps=0.8, rms_treshold=rms_treshold)
 
 full_res_system.prepare_prior()
 
@@ -157,6 +158,12 @@ benchmarks = [
       '-o',
       cmbcr.PseudoInverseWithMaskPreconditioner(system, inner_its=0),
      ),
+
+    Benchmark(
+      'Two-level diagonal',
+      '-o',
+      cmbcr.MultilevelPreconditioner(system, smoother='diagonal'),
+     ),
     ]
 
 